@@ -29,10 +29,14 @@ import wikipedia
 from discord.ext import commands, tasks
 from sentry_sdk import capture_exception
 
-from bot.core import rotate_cache, send_bird
-from bot.data import GenericError, database, logger
+from bot.cache import clean_staging, evict_cache, media_manifest, migrate_fetch_keys
+from bot.core import send_bird
+from bot.data import GenericError, async_database, logger
 from bot.filters import Filter
 from bot.functions import backup_all, channel_setup, drone_attack, user_setup
+from bot.network import RetryBudget, http_client, retry_budget
+from bot.prefetch import prefetcher
+from bot.scheduler import download_owner
 
 # The channel id that the backups send to
 BACKUPS_CHANNEL = int(os.environ["SCIOLY_ID_BOT_BACKUPS_CHANNEL"])
@@ -43,6 +47,14 @@ def start_backup():
     asyncio.run(backup_all())
 
 
+class BirdBot(commands.Bot):
+    """Bot that closes the shared http session on shutdown."""
+
+    async def close(self):
+        await http_client.close()
+        await super().close()
+
+
 if __name__ == "__main__":
     # Initialize bot
     intent: discord.Intents = discord.Intents.none()
@@ -54,7 +66,7 @@ if __name__ == "__main__":
     cache_flags: discord.MemberCacheFlags = discord.MemberCacheFlags.none()
     cache_flags.voice = True
 
-    bot = commands.Bot(
+    bot = BirdBot(
         command_prefix=["b!", "b.", "b#", "B!", "B.", "B#", "o>", "O>"],
         case_insensitive=True,
         description="BirdID - Your Very Own Ornithologist",
@@ -72,6 +84,8 @@ if __name__ == "__main__":
         # Change discord activity
         await bot.change_presence(activity=discord.Activity(type=3, name="birds"))
         refresh_cache.start()
+        if os.getenv("SCIOLY_ID_BOT_ENABLE_PREFETCH") != "false":
+            prefetch_cache.start()
         if os.getenv("SCIOLY_ID_BOT_ENABLE_BACKUPS") != "false":
             refresh_backup.start()
 
@@ -122,6 +136,12 @@ if __name__ == "__main__":
 
     @bot.check
     async def prechecks(ctx):
+        # each command gets its own retry budget for http requests
+        retry_budget.set(RetryBudget())
+        # media downloads are shared fairly between guilds and channels
+        download_owner.set(
+            (ctx.guild.id if ctx.guild is not None else None, ctx.channel.id)
+        )
         await ctx.trigger_typing()
 
         logger.info("global check: checking permissions")
@@ -130,13 +150,17 @@ if __name__ == "__main__":
         ).predicate(ctx)
 
         logger.info("global check: checking banned")
-        if database.zscore("ignore:global", str(ctx.channel.id)) is not None:
+        pipe = async_database.pipeline(transaction=False)
+        pipe.zscore("ignore:global", str(ctx.channel.id))
+        pipe.zscore("banned:global", str(ctx.author.id))
+        ignored, banned = await pipe.execute()
+        if ignored is not None:
             raise GenericError(code=192)
-        if database.zscore("banned:global", str(ctx.author.id)) is not None:
+        if banned is not None:
             raise GenericError(code=842)
 
         logger.info("global check: logging command frequency")
-        database.zincrby("frequency.command:global", 1, str(ctx.command))
+        await async_database.zincrby("frequency.command:global", 1, str(ctx.command))
 
         logger.info("global check: database setup")
         await channel_setup(ctx)
@@ -265,7 +289,7 @@ if __name__ == "__main__":
         elif isinstance(error, commands.CommandInvokeError):
             if isinstance(error.original, redis.exceptions.ResponseError):
                 capture_exception(error.original)
-                if database.exists(f"channel:{ctx.channel.id}"):
+                if await async_database.exists(f"channel:{ctx.channel.id}"):
                     await ctx.send(
                         "**An unexpected ResponseError has occurred.**\n"
                         + "*Please log this message in #support in the support server below, or try again.*\n"
@@ -379,11 +403,22 @@ if __name__ == "__main__":
 
     @tasks.loop(hours=1.0)
     async def refresh_cache():
-        """Task to delete a random selection of cached birds every hour."""
+        """Task to evict unpopular cached birds if the cache is over budget."""
         logger.info("TASK: Refreshing some cache items")
         event_loop = asyncio.get_event_loop()
         with concurrent.futures.ThreadPoolExecutor(1) as executor:
-            await event_loop.run_in_executor(executor, rotate_cache)
+            await event_loop.run_in_executor(executor, evict_cache)
+
+    @tasks.loop(minutes=5.0)
+    async def prefetch_cache():
+        """Task to download media for birds likely to be requested next."""
+        logger.info("TASK: Prefetching media")
+        try:
+            await prefetcher.run()
+        except Exception as e:  # pylint: disable=broad-except
+            # keep the task running if prefetching fails
+            logger.exception(e)
+            capture_exception(e)
 
     @tasks.loop(hours=6.0)
     async def refresh_backup():
@@ -412,6 +447,12 @@ if __name__ == "__main__":
             await channel.send(file=discord.File(f, filename="keys.txt"))
         logger.info("Backup Files Sent!")
 
+    # the bot saves the manifest and evicts media, web workers only read it
+    media_manifest.owner = True
+    media_manifest.load()
+    migrate_fetch_keys()
+    clean_staging()
+
     # Actually run the bot
     token = os.environ["SCIOLY_ID_BOT_TOKEN"]
     bot.run(token)
@@ -0,0 +1,131 @@
+# async_redis.py | redis commands that don't block the event loop
+# Copyright (C) 2019-2020  EraserBird, person_v1.32, hmmm
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import concurrent.futures
+import functools
+import os
+import threading
+from typing import List
+
+import redis
+
+
+class AsyncRedis:
+    """Runs redis commands without blocking the event loop.
+
+    Commands have the same arguments as redis.Redis, but are coroutines.
+    They run on a pool of `workers` threads with a connection pool of the
+    same size, so the event loop keeps handling heartbeats and other
+    commands while waiting for Redis. Connecting and reading replies
+    time out after `timeout` seconds.
+
+    `client` (redis.Redis) - the synchronous client to copy connection settings from\n
+    `workers` (int) - commands running at once, SCIOLY_ID_BOT_REDIS_WORKERS by default\n
+    `timeout` (float) - seconds to wait for a connection or a reply before raising
+    redis.TimeoutError, SCIOLY_ID_BOT_REDIS_TIMEOUT by default
+    """
+
+    def __init__(self, client: redis.Redis, workers: int = None, timeout: float = None):
+        # read when created, since this module is imported before .env is loaded
+        if workers is None:
+            workers = int(os.getenv("SCIOLY_ID_BOT_REDIS_WORKERS", 8))
+        if timeout is None:
+            timeout = float(os.getenv("SCIOLY_ID_BOT_REDIS_TIMEOUT", 5))
+        pool = client.connection_pool
+        connection_kwargs = dict(
+            pool.connection_kwargs,
+            socket_timeout=timeout,
+            socket_connect_timeout=timeout,
+        )
+        self.client = redis.Redis(
+            connection_pool=redis.BlockingConnectionPool(
+                connection_class=pool.connection_class,
+                max_connections=workers,
+                timeout=timeout,
+                **connection_kwargs,
+            )
+        )
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="redis"
+                )
+            return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """Runs a blocking function that uses redis on the worker threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_executor(), functools.partial(func, *args, **kwargs)
+        )
+
+    def __getattr__(self, name: str):
+        command = getattr(self.client, name)
+        if not callable(command):
+            return command
+
+        @functools.wraps(command)
+        async def run_command(*args, **kwargs):
+            return await self.run(command, *args, **kwargs)
+
+        return run_command
+
+    def pipeline(self, transaction: bool = True) -> "AsyncPipeline":
+        return AsyncPipeline(self, self.client.pipeline(transaction=transaction))
+
+    def register_script(self, script: str) -> "AsyncScript":
+        return AsyncScript(self, self.client.register_script(script))
+
+    async def scan_keys(self, match: str, count: int = 1000) -> List[bytes]:
+        """Returns all keys matching a pattern, scanning on a worker thread."""
+        return await self.run(
+            lambda: list(self.client.scan_iter(match=match, count=count))
+        )
+
+
+class AsyncPipeline:
+    """Queues commands like redis.client.Pipeline, but `execute()` is a coroutine."""
+
+    def __init__(self, database: AsyncRedis, pipe):
+        self._database = database
+        self._pipe = pipe
+
+    def __getattr__(self, name: str):
+        return getattr(self._pipe, name)
+
+    def __len__(self) -> int:
+        return len(self._pipe)
+
+    async def execute(self, raise_on_error: bool = True) -> list:
+        """Sends the queued commands in one round trip."""
+        return await self._database.run(self._pipe.execute, raise_on_error)
+
+
+class AsyncScript:
+    """A registered Lua script, calling it is a coroutine."""
+
+    def __init__(self, database: AsyncRedis, script):
+        self._database = database
+        self._script = script
+
+    async def __call__(self, keys=None, args=None):
+        return await self._database.run(self._script, keys=keys, args=args)
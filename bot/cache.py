@@ -0,0 +1,671 @@
+# cache.py | media cache index and management
+# Copyright (C) 2019-2020  EraserBird, person_v1.32, hmmm
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import contextlib
+import hashlib
+import json
+import math
+import mimetypes
+import os
+import shutil
+import string
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from bot.data import common_names, database, logger
+
+try:
+    import fcntl
+except ImportError:  # windows, locks are only needed with multiple processes
+    fcntl = None
+from bot.filters import Filter
+
+CACHE_DIR = "bot_files/cache"
+MANIFEST_PATH = f"{CACHE_DIR}/manifest.json"
+MEDIA_TYPES = ("images", "songs")
+VARIANTS = {"bw": "png", "opus": "pkt"}  # variant name: file extension
+FETCH_KEY_MARKER = f"{CACHE_DIR}/.fetch_keys"  # exists once migrate_fetch_keys runs
+# files are downloaded and processed in a staging directory, then moved
+# into the cache directory, while the cache key's lock file is held
+STAGING_DIR = f"{CACHE_DIR}/.staging"
+LOCK_DIR = f"{CACHE_DIR}/.locks"
+STAGING_MAX_AGE = 3600  # seconds, staging directories older than this are removed
+
+# eviction starts when the cache is larger than HIGH_WATERMARK * CACHE_BUDGET
+# and removes birds until the cache is smaller than LOW_WATERMARK * CACHE_BUDGET
+CACHE_BUDGET = int(os.getenv("SCIOLY_ID_BOT_CACHE_BUDGET", 2 * 1024 ** 3))  # 2gb
+HIGH_WATERMARK = float(os.getenv("SCIOLY_ID_BOT_CACHE_HIGH_WATERMARK", 0.9))
+LOW_WATERMARK = float(os.getenv("SCIOLY_ID_BOT_CACHE_LOW_WATERMARK", 0.75))
+
+# manifest format:
+# {
+#   "images/Branta canadensis123": [
+#       {
+#           "path": "bot_files/cache/images/Branta canadensis123/0.jpg",
+#           "extension": "jpg",
+#           "size": 123456,
+#           "content_type": "image/jpeg",
+#           "downloaded": 1600000000.0,
+#           "last_served": 1600000000.0,
+#           "hits": 0,
+#           "variants": {"bw": 23456}  # sizes of derived versions (bw/opus), if any
+#       },
+#       ...
+#   ],
+#   ...
+# }
+
+
+def cache_key(media_type: str, bird: str, filter_key) -> str:
+    """Returns the manifest key for a bird and filter combination.
+
+    The key is also the path of the cache directory relative to `CACHE_DIR`.
+
+    `media_type` (str) - type of media (images/songs)\n
+    `bird` (str) - scientific name of bird\n
+    `filter_key` - integer filter representation, from `Filter.fetch_key`
+    """
+    return f"{media_type}/{bird}{filter_key}"
+
+
+def cache_directory(key: str) -> str:
+    """Returns the relative path (with trailing slash) to a cache directory."""
+    return f"{CACHE_DIR}/{key}/"
+
+
+def variant_path(path: str, variant: str) -> str:
+    """Returns the path to a derived version of a cached file.
+
+    Variants are stored in a hidden directory next to the source file,
+    so they are removed when the source's cache directory is evicted.
+
+    `path` (str) - path to the cached file\n
+    `variant` (str) - name of the variant, a key of `VARIANTS`
+    """
+    directory, filename = os.path.split(path)
+    stem = filename.rsplit(".", 1)[0]
+    return f"{directory}/.variants/{stem}.{variant}.{VARIANTS[variant]}"
+
+
+def _key_hash(key: str) -> str:
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def staging_directory(key: str) -> str:
+    """Returns the path (with trailing slash) to a staging directory for this process."""
+    return f"{STAGING_DIR}/{_key_hash(key)}.{os.getpid()}/"
+
+
+def clean_staging(max_age: float = STAGING_MAX_AGE) -> int:
+    """Removes staging directories left behind by processes that stopped.
+
+    Old lock files that aren't held are removed too.
+    Returns the number of directories removed.
+    """
+    removed = 0
+    cutoff = time.time() - max_age
+    with contextlib.suppress(FileNotFoundError):
+        for name in os.listdir(STAGING_DIR):
+            path = f"{STAGING_DIR}/{name}"
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(path).st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+    logger.info(f"removed {removed} staging directories")
+
+    locks = 0
+    with contextlib.suppress(FileNotFoundError):
+        for name in os.listdir(LOCK_DIR):
+            path = f"{LOCK_DIR}/{name}"
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+            lock = KeyLock.from_path(path)
+            if lock.acquire():
+                lock.release(remove=True)
+                locks += 1
+    logger.info(f"removed {locks} lock files")
+    return removed
+
+
+class KeyLock:
+    """Advisory lock on a cache key, shared by the bot and web workers.
+
+    The process holding the lock is populating the cache directory.
+    Locks are released automatically if the process exits.
+    Lock files are only deleted while the lock is held, and a lock
+    taken on a file that was deleted in the meantime is taken again.
+    """
+
+    def __init__(self, key: str):
+        self.path = f"{LOCK_DIR}/{_key_hash(key)}.lock"
+        self._file = None
+
+    @classmethod
+    def from_path(cls, path: str) -> "KeyLock":
+        """Returns the lock for a lock file."""
+        lock = cls("")
+        lock.path = path
+        return lock
+
+    def acquire(self) -> bool:
+        """Tries to take the lock without blocking, returns True if it was taken."""
+        if fcntl is None or self._file is not None:
+            return True
+        while True:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            lock_file = open(self.path, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            try:
+                inode = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                inode = None
+            current = inode == os.fstat(lock_file.fileno()).st_ino
+            if current:
+                self._file = lock_file
+                return True
+            # the lock file was removed by its last holder
+            lock_file.close()
+
+    def release(self, remove: bool = False):
+        """Releases the lock, deleting the lock file if `remove` is True."""
+        if remove:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def populating(self) -> bool:
+        """Returns True if another process holds the lock."""
+        if self._file is not None or not os.path.exists(self.path):
+            return False
+        if not self.acquire():
+            return True
+        self.release()
+        return False
+
+
+def _entry_size(entry: dict) -> int:
+    return entry["size"] + sum(entry.get("variants", {}).values())
+
+
+def media_entry(path: str, content_type: Optional[str] = None, size: int = None) -> dict:
+    """Returns a new manifest entry for a cached file.
+
+    `path` (str) - path to the cached file\n
+    `content_type` (str) - MIME type of the file, guessed if not provided\n
+    `size` (int) - file size in bytes, read from disk if not provided
+    """
+    if content_type is None:
+        content_type = mimetypes.guess_type(path)[0] or ""
+    if size is None:
+        size = os.stat(path).st_size
+    now = time.time()
+    return {
+        "path": path,
+        "extension": path.split(".")[-1],
+        "size": size,
+        "content_type": content_type,
+        "downloaded": now,
+        "last_served": now,
+        "hits": 0,
+    }
+
+
+class MediaManifest:
+    """Index of the media stored in the on-disk cache.
+
+    The manifest is loaded once and kept in memory, so fetching
+    media does not need to list directories. The bot loads it at startup,
+    and other processes load it the first time it is used.
+    Changes are written back to `MANIFEST_PATH` with `save()`.
+    This is thread safe since cache rotation runs in an executor.
+
+    The bot and each web worker have their own copy, but only the
+    `owner` process (the bot) saves the manifest and evicts media.
+    Other processes check that files still exist with `find()`.
+    """
+
+    def __init__(self, path: str = MANIFEST_PATH, owner: bool = False):
+        self.path = path
+        self.owner = owner
+        self._lock = threading.RLock()
+        self._entries: Dict[str, List[dict]] = {}
+        self._paths: Dict[str, dict] = {}
+        self._dirty = False
+        self._loaded = False
+        self._total_size = 0
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load()
+
+    @property
+    def total_size(self) -> int:
+        self._ensure_loaded()
+        return self._total_size
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._entries)
+
+    def __contains__(self, key):
+        self._ensure_loaded()
+        return key in self._entries
+
+    def load(self):
+        """Loads the manifest from disk.
+
+        If a saved manifest does not exist, the cache directories
+        are scanned to build one.
+        """
+        logger.info("loading media manifest")
+        self._loaded = True
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            logger.info("no saved manifest, rebuilding from cache")
+            self.rebuild()
+            return
+        except json.JSONDecodeError:
+            logger.info("manifest corrupted, rebuilding from cache")
+            self.rebuild()
+            return
+        with self._lock:
+            self._entries = entries
+            self._paths = {
+                entry["path"]: entry for items in entries.values() for entry in items
+            }
+            self._total_size = sum(
+                _entry_size(entry) for entry in self._paths.values()
+            )
+            self._dirty = False
+        logger.info(f"loaded manifest with {len(self._entries)} items")
+
+    def rebuild(self):
+        """Indexes every complete cache directory currently on disk."""
+        with self._lock:
+            self._loaded = True
+            self._entries = {}
+            self._paths = {}
+            self._total_size = 0
+            for media_type in MEDIA_TYPES:
+                with contextlib.suppress(FileNotFoundError):
+                    for name in os.listdir(f"{CACHE_DIR}/{media_type}"):
+                        key = f"{media_type}/{name}"
+                        if not KeyLock(key).populating():
+                            self.scan(key)
+            self._dirty = True
+        logger.info(f"rebuilt manifest with {len(self._entries)} items")
+
+    def save(self):
+        """Writes the manifest to disk if it has changed and this process owns it."""
+        with self._lock:
+            if not self.owner or not self._dirty:
+                return
+            data = json.dumps(self._entries)
+            self._dirty = False
+        logger.info("saving media manifest")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        """Returns the entries for a cache key, or None if not indexed."""
+        self._ensure_loaded()
+        with self._lock:
+            entries = self._entries.get(key)
+            return list(entries) if entries is not None else None
+
+    def find(self, key: str) -> List[dict]:
+        """Returns the entries for a cache key, checking that the files exist.
+
+        Keys with missing files, such as ones evicted by another process,
+        are scanned again, as are keys that aren't indexed. Keys that
+        another process is still populating aren't scanned, since the
+        directory is incomplete.
+        Returns an empty list if nothing is cached.
+        """
+        entries = self.get(key)
+        if entries and all(os.path.exists(entry["path"]) for entry in entries):
+            return entries
+        if entries:
+            logger.info(f"files missing from {key}, checking disk")
+            self.remove(key)
+        if KeyLock(key).populating():
+            logger.info(f"{key} is being populated by another process")
+            return []
+        return self.scan(key)
+
+    def scan_new(self) -> int:
+        """Indexes cache directories downloaded by other processes.
+
+        Returns the number of keys added.
+        """
+        added = 0
+        for media_type in MEDIA_TYPES:
+            with contextlib.suppress(FileNotFoundError):
+                for name in os.listdir(f"{CACHE_DIR}/{media_type}"):
+                    key = f"{media_type}/{name}"
+                    if key not in self and not KeyLock(key).populating():
+                        added += bool(self.scan(key))
+        logger.info(f"indexed {added} new cache directories")
+        return added
+
+    def entry(self, path: str) -> Optional[dict]:
+        """Returns the entry for a file path, or None if not indexed."""
+        self._ensure_loaded()
+        return self._paths.get(path)
+
+    def keys(self) -> List[str]:
+        self._ensure_loaded()
+        with self._lock:
+            return list(self._entries.keys())
+
+    def set(self, key: str, entries: List[dict]):
+        """Replaces the entries of a cache key."""
+        self._ensure_loaded()
+        with self._lock:
+            for old in self._entries.get(key, []):
+                self._paths.pop(old["path"], None)
+                self._total_size -= _entry_size(old)
+            self._entries[key] = list(entries)
+            for entry in entries:
+                self._paths[entry["path"]] = entry
+                self._total_size += _entry_size(entry)
+            self._dirty = True
+
+    def remove(self, key: str) -> int:
+        """Removes a cache key from the manifest.
+
+        Returns the number of bytes the key's files used.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            removed = 0
+            for old in self._entries.pop(key, []):
+                self._paths.pop(old["path"], None)
+                removed += _entry_size(old)
+            self._total_size -= removed
+            self._dirty = True
+        return removed
+
+    def touch(self, path: str):
+        """Updates the last served time and hit count of a file."""
+        entry = self.entry(path)
+        if entry is not None:
+            entry["last_served"] = time.time()
+            entry["hits"] = entry.get("hits", 0) + 1
+            self._dirty = True
+
+    def has_variant(self, path: str, variant: str) -> bool:
+        entry = self.entry(path)
+        return entry is not None and variant in entry.get("variants", {})
+
+    def add_variant(self, path: str, variant: str, size: int):
+        """Records a derived version of a cached file."""
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._paths.get(path)
+            if entry is None:
+                return
+            variants = entry.setdefault("variants", {})
+            self._total_size += size - variants.get(variant, 0)
+            variants[variant] = size
+            self._dirty = True
+
+    def scan(self, key: str, store: bool = True) -> List[dict]:
+        """Indexes a cache directory from disk.
+
+        This is used when media was downloaded by another process,
+        and returns the new entries for the key. If `store` is False, the
+        entries are returned without adding them to the manifest, for
+        directories that are still being populated.
+        """
+        directory = cache_directory(key)
+        try:
+            entries = [
+                media_entry(f"{directory}{filename}")
+                for filename in os.listdir(directory)
+                # skip variants and files that are still being written
+                if not filename.startswith(".")
+                and not filename.endswith((".part", ".tmp"))
+            ]
+        except FileNotFoundError:
+            return []
+        if entries and store:
+            self.set(key, entries)
+        return entries
+
+
+class CacheStats:
+    """Counters for cache lookups and evictions.
+
+    `filters` counts lookups by (media type, filter key),
+    and `downloading` is the number of interactive downloads in progress.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.downloading = 0
+        self.filters = collections.Counter()
+        self.evicted = 0
+        self.bytes_freed = 0
+        self.last_eviction = 0.0
+        self.downloads = 0
+        self.download_bytes = 0
+        self.download_time = 0.0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return round(self.hits / lookups, 4) if lookups else 0.0
+
+    @property
+    def throughput(self) -> int:
+        """Average download speed in bytes per second."""
+        return round(self.download_bytes / self.download_time) if self.download_time else 0
+
+    def record_download(self, size: int, elapsed: float):
+        self.downloads += 1
+        self.download_bytes += size
+        self.download_time += elapsed
+
+    def info(self) -> dict:
+        """Returns a dictionary of cache statistics."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio,
+            "evicted": self.evicted,
+            "bytes_freed": self.bytes_freed,
+            "last_eviction": self.last_eviction,
+            "downloading": self.downloading,
+            "downloads": self.downloads,
+            "download_bytes": self.download_bytes,
+            "throughput": self.throughput,
+            "size": media_manifest.total_size,
+            "budget": CACHE_BUDGET,
+        }
+
+
+_eviction_lock = threading.Lock()
+
+
+def _bird_names(key: str) -> Tuple[str, ...]:
+    """Returns the common names of the bird in a cache key.
+
+    Birds from the bundled lists are counted without hyphens,
+    and birds from custom lists are counted with them.
+    """
+    sci_bird = key.split("/", 1)[1].rstrip("0123456789")
+    bird = common_names.get(sci_bird.lower(), sci_bird)
+    return tuple({bird, string.capwords(bird.replace("-", " "))})
+
+
+def eviction_order(now: float = None) -> List[str]:
+    """Returns cache keys sorted from most to least evictable.
+
+    Keys are scored by combining recency and frequency.
+    Frequency is how many times files in the key were served locally,
+    plus the logarithm of the times the bird was shown globally
+    (`frequency.bird:global`). The score decays with the hours since
+    a file in the key was last served, so popular birds that haven't been
+    used in a while will eventually be evicted.
+    """
+    if now is None:
+        now = time.time()
+    keys = media_manifest.keys()
+    birds = list({bird for key in keys for bird in _bird_names(key)})
+    pipe = database.pipeline()
+    for bird in birds:
+        pipe.zscore("frequency.bird:global", bird)
+    global_frequency = dict(zip(birds, pipe.execute()))
+
+    def score(key):
+        entries = media_manifest.get(key) or []
+        last_served = max((entry["last_served"] for entry in entries), default=0)
+        hits = sum(entry.get("hits", 0) for entry in entries)
+        shown = sum(global_frequency[bird] or 0 for bird in _bird_names(key))
+        frequency = hits + math.log2(1 + shown)
+        age = max(now - last_served, 0) / 3600
+        return (1 + frequency) / (1 + age)
+
+    return sorted(keys, key=score)
+
+
+def evict_cache() -> int:
+    """Deletes cached birds until the cache is under the low watermark.
+
+    Nothing is deleted unless the cache is over the high watermark,
+    and only the process that owns the manifest evicts media.
+    Returns the number of bytes freed.
+    """
+    if not media_manifest.owner:
+        logger.info("manifest owned by another process, not evicting")
+        return 0
+    media_manifest.scan_new()
+    high = CACHE_BUDGET * HIGH_WATERMARK
+    low = CACHE_BUDGET * LOW_WATERMARK
+    logger.info(f"cache size: {media_manifest.total_size}; budget: {CACHE_BUDGET}")
+    if media_manifest.total_size <= high:
+        logger.info("cache under high watermark")
+        media_manifest.save()
+        return 0
+    if not _eviction_lock.acquire(blocking=False):
+        logger.info("eviction already running")
+        return 0
+
+    freed = 0
+    try:
+        for key in eviction_order():
+            if media_manifest.total_size <= low:
+                break
+            lock = KeyLock(key)
+            if not lock.acquire():
+                # being populated by another process
+                continue
+            try:
+                freed += media_manifest.remove(key)
+                cache_stats.evicted += 1
+                directory = cache_directory(key)
+                with contextlib.suppress(FileNotFoundError):
+                    shutil.rmtree(directory)
+                logger.info(f"{directory} removed")
+            finally:
+                lock.release(remove=True)
+        media_manifest.save()
+    finally:
+        _eviction_lock.release()
+
+    cache_stats.bytes_freed += freed
+    cache_stats.last_eviction = time.time()
+    logger.info(f"evicted {freed} bytes; cache size: {media_manifest.total_size}")
+    return freed
+
+
+def migrate_fetch_keys() -> int:
+    """Moves cache directories keyed on `Filter.to_int` to `Filter.fetch_key`.
+
+    Directories that now share a fetch key are merged by keeping one of them.
+    This only runs once, and returns the number of directories moved or removed.
+    """
+    if os.path.exists(FETCH_KEY_MARKER):
+        return 0
+    logger.info("migrating cache to fetch keys")
+    changed = 0
+    for key in media_manifest.keys():
+        media_type, name = key.split("/", 1)
+        bird = name.rstrip("0123456789")
+        try:
+            filters = Filter.from_int(int(name[len(bird) :]))
+            new_key = cache_key(media_type, bird, filters.fetch_key(media_type))
+        except ValueError:
+            continue
+        if new_key == key:
+            continue
+
+        changed += 1
+        entries = media_manifest.get(key) or []
+        media_manifest.remove(key)
+        old_directory = cache_directory(key)
+        new_directory = cache_directory(new_key)
+        if new_key in media_manifest or os.path.exists(new_directory):
+            logger.info(f"{old_directory} duplicates {new_directory}, removing")
+            shutil.rmtree(old_directory, ignore_errors=True)
+            media_manifest.scan(new_key)
+            continue
+        try:
+            os.rename(old_directory, new_directory)
+        except OSError:
+            shutil.rmtree(old_directory, ignore_errors=True)
+            continue
+        media_manifest.set(
+            new_key,
+            [
+                dict(entry, path=entry["path"].replace(old_directory, new_directory, 1))
+                for entry in entries
+            ],
+        )
+    media_manifest.save()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(FETCH_KEY_MARKER, "w"):
+        pass
+    logger.info(f"migrated {changed} cache directories")
+    return changed
+
+
+def over_budget() -> bool:
+    """Returns True if the cache is over the high watermark."""
+    return media_manifest.total_size > CACHE_BUDGET * HIGH_WATERMARK
+
+
+media_manifest = MediaManifest()
+cache_stats = CacheStats()
@@ -0,0 +1,289 @@
+# catalog.py | local index of Macaulay Library catalog results
+# Copyright (C) 2019-2020  EraserBird, person_v1.32, hmmm
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from bot.data import logger
+from bot.filters import COUNT, Filter
+
+CATALOG_PATH = "bot_files/cache/catalog.sqlite3"
+PAGE_SIZE = int(os.getenv("SCIOLY_ID_BOT_CATALOG_PAGE_SIZE", 100))
+MAX_PAGES = int(os.getenv("SCIOLY_ID_BOT_CATALOG_PAGES", 3))
+CATALOG_TTL = int(os.getenv("SCIOLY_ID_BOT_CATALOG_TTL", 7 * 86400))  # 1 week
+
+# queries: one row per catalog query that has been fetched
+#   query - catalog url without paging, identifies the query
+#   base - catalog url with the quality filter removed
+#   quality - comma separated quality values of the query
+#   complete - 1 if every page of results was fetched
+# assets: one row per media item
+#   quality - star rating rounded down, 0 if unrated
+#   last_used - when the asset was last chosen for downloading
+# query_assets: which assets each query returned, in order
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    query TEXT PRIMARY KEY,
+    taxon_code TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    base TEXT NOT NULL,
+    quality TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    total INTEGER NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS queries_base ON queries (base);
+CREATE TABLE IF NOT EXISTS assets (
+    asset_id TEXT PRIMARY KEY,
+    taxon_code TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    media_url TEXT,
+    preview_url TEXT,
+    rating REAL,
+    quality INTEGER NOT NULL,
+    age TEXT,
+    sex TEXT,
+    behaviors TEXT,
+    tags TEXT,
+    width INTEGER,
+    height INTEGER,
+    last_used REAL
+);
+CREATE TABLE IF NOT EXISTS query_assets (
+    query TEXT NOT NULL,
+    asset_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (query, asset_id)
+);
+"""
+
+
+def query_urls(taxon_code: str, media_type: str, filters: Filter):
+    """Returns the query url and the query url without quality filters.
+
+    `media_type` is p (pictures) or a (audio)
+    """
+    query = filters.url(taxon_code, media_type, count=PAGE_SIZE)
+    broad = Filter.from_int(filters.to_int())
+    broad.quality = set()
+    return query, broad.url(taxon_code, media_type, count=PAGE_SIZE)
+
+
+def _text(value) -> Optional[str]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, (list, tuple)):
+        return ",".join(str(item) for item in value)
+    return str(value)
+
+
+def _asset(item: dict, taxon_code: str, media_type: str) -> Optional[tuple]:
+    asset_id = item.get("assetId") or item.get("catalogId") or item.get("mediaUrl")
+    if asset_id is None:
+        return None
+    try:
+        rating = float(item.get("rating") or 0)
+    except (TypeError, ValueError):
+        rating = 0.0
+    return (
+        str(asset_id),
+        taxon_code,
+        media_type,
+        item.get("mediaUrl"),
+        item.get("previewUrl"),
+        rating or None,
+        min(int(rating), 5),
+        _text(item.get("age")),
+        _text(item.get("sex")),
+        _text(item.get("behaviors")),
+        _text(item.get("tags")),
+        item.get("width"),
+        item.get("height"),
+    )
+
+
+class CatalogIndex:
+    """On disk index of Macaulay Library catalog results.
+
+    Catalog queries are fetched with large pages, and the results
+    are stored so later downloads of the same bird and filters pick
+    different media without querying the catalog again.
+    Queries that only differ by having fewer quality ratings are
+    answered from a broader query that was already fetched, if
+    all of its results were stored.
+    The database is shared by the bot and web workers.
+    """
+
+    def __init__(self, path: str = CATALOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(queries)")}
+            if "complete" not in columns:
+                # indexes from before queries were marked complete
+                with self._db:
+                    self._db.execute(
+                        "ALTER TABLE queries "
+                        + "ADD COLUMN complete INTEGER NOT NULL DEFAULT 0"
+                    )
+        return self._db
+
+    def _source_query(self, db, query: str, base: str, quality: set) -> Optional[str]:
+        """Returns a fresh indexed query that includes the results of `query`.
+
+        Broader queries are only used if they were complete, since results
+        past the last page fetched could be the only ones matching `quality`.
+        """
+        oldest = time.time() - CATALOG_TTL
+        row = db.execute(
+            "SELECT query FROM queries WHERE query = ? AND fetched > ?", (query, oldest)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        for (other, other_quality) in db.execute(
+            "SELECT query, quality FROM queries "
+            + "WHERE base = ? AND fetched > ? AND complete",
+            (base, oldest),
+        ):
+            if quality and quality.issubset(set(other_quality.split(","))):
+                return other
+        return None
+
+    def urls(
+        self, taxon_code: str, media_type: str, filters: Filter, count: int = COUNT
+    ) -> Optional[List[str]]:
+        """Returns urls of media from the index, or None if the query isn't indexed.
+
+        The least recently used media are chosen first. If a broader query
+        has no media matching the quality filter, the query is treated as
+        not indexed.
+
+        `taxon_code` (str) - taxon code of the bird\n
+        `media_type` (str) - p (pictures) or a (audio)\n
+        `filters` (bot.filters Filter)\n
+        `count` (int) - number of urls to return
+        """
+        query, base = query_urls(taxon_code, media_type, filters)
+        column = "media_url" if filters.large or media_type == "a" else "preview_url"
+        quality = {int(value) for value in filters.quality}
+        with self._lock:
+            db = self._connect()
+            source = self._source_query(db, query, base, set(filters.quality))
+            if source is None:
+                self.misses += 1
+                return None
+            sql = (
+                f"SELECT a.asset_id, a.{column} FROM query_assets qa "
+                + "JOIN assets a ON a.asset_id = qa.asset_id "
+                + f"WHERE qa.query = ? AND a.{column} IS NOT NULL"
+            )
+            params = [source]
+            if source != query:
+                sql += f" AND a.quality IN ({','.join('?' * len(quality))})"
+                params += sorted(quality)
+            sql += " ORDER BY a.last_used IS NOT NULL, a.last_used, qa.position LIMIT ?"
+            params.append(count)
+            rows = db.execute(sql, params).fetchall()
+            if not rows and source != query:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with db:
+                db.executemany(
+                    "UPDATE assets SET last_used = ? WHERE asset_id = ?",
+                    [(time.time(), asset_id) for asset_id, _ in rows],
+                )
+        return [url for _, url in rows]
+
+    def add(
+        self,
+        taxon_code: str,
+        media_type: str,
+        filters: Filter,
+        items: List[dict],
+        complete: bool = False,
+    ):
+        """Stores the results of a catalog query, replacing older results.
+
+        `items` (list) - the "content" of each page of catalog results\n
+        `complete` (bool) - whether `items` has every result of the query
+        """
+        query, base = query_urls(taxon_code, media_type, filters)
+        assets = [
+            asset
+            for asset in (_asset(item, taxon_code, media_type) for item in items)
+            if asset is not None
+        ]
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute("DELETE FROM query_assets WHERE query = ?", (query,))
+                db.execute(
+                    "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        query,
+                        taxon_code,
+                        media_type,
+                        base,
+                        ",".join(sorted(filters.quality)),
+                        time.time(),
+                        len(assets),
+                        int(complete),
+                    ),
+                )
+                # keep when assets were last used
+                db.executemany(
+                    "INSERT OR IGNORE INTO assets "
+                    + "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                    assets,
+                )
+                db.executemany(
+                    "UPDATE assets SET media_url = ?, preview_url = ?, rating = ?, "
+                    + "quality = ? WHERE asset_id = ?",
+                    [(*asset[3:7], asset[0]) for asset in assets],
+                )
+                db.executemany(
+                    "INSERT OR IGNORE INTO query_assets VALUES (?, ?, ?)",
+                    [(query, asset[0], i) for i, asset in enumerate(assets)],
+                )
+        logger.info(f"indexed {len(assets)} catalog items for {taxon_code}")
+
+    def info(self) -> dict:
+        with self._lock:
+            db = self._connect()
+            queries = db.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+            assets = db.execute("SELECT COUNT(*) FROM assets").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "queries": queries,
+            "assets": assets,
+        }
+
+
+catalog_index = CatalogIndex()
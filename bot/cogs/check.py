@@ -20,17 +20,11 @@ import discord
 from discord.ext import commands
 
 import bot.voice as voice_functions
+from bot.command_state import CommandState
 from bot.core import get_sciname, spellcheck
-from bot.data import alpha_codes, database, get_wiki_url, logger
+from bot.data import alpha_codes, get_wiki_url, logger
 from bot.filters import Filter
-from bot.functions import (
-    CustomCooldown,
-    bird_setup,
-    incorrect_increment,
-    score_increment,
-    session_increment,
-    streak_increment,
-)
+from bot.functions import CustomCooldown, record_answer
 
 # achievement values
 achievement = [1, 10, 25, 50, 100, 150, 200, 250, 400, 420, 500, 650, 666, 690, 1000]
@@ -48,7 +42,9 @@ class Check(commands.Cog):
     async def check(self, ctx, *, arg):
         logger.info("command: check")
 
-        currentBird = database.hget(f"channel:{ctx.channel.id}", "bird").decode("utf-8")
+        command_state = await CommandState.load(ctx)
+        race = command_state.race
+        currentBird = command_state.channel.bird
         if currentBird == "":  # no bird
             await ctx.send("You must ask for a bird first!")
             return
@@ -60,24 +56,22 @@ class Check(commands.Cog):
         logger.info("currentBird: " + currentBird)
         logger.info("arg: " + arg)
 
-        bird_setup(ctx, currentBird)
-
-        race_in_session = bool(database.exists(f"race.data:{ctx.channel.id}"))
+        race_in_session = race is not None
         if race_in_session:
             logger.info("race in session")
-            if database.hget(f"race.data:{ctx.channel.id}", "strict"):
+            if race.strict:
                 logger.info("strict spelling")
                 correct = arg in (currentBird, sciBird)
             else:
                 logger.info("spelling leniency")
                 correct = spellcheck(arg, currentBird) or spellcheck(arg, sciBird)
 
-            if not correct and database.hget(f"race.data:{ctx.channel.id}", "alpha"):
+            if not correct and race.alpha:
                 logger.info("checking alpha codes")
                 correct = arg.upper() == alpha_code
         else:
             logger.info("no race")
-            if database.hget(f"session.data:{ctx.author.id}", "strict"):
+            if command_state.session is not None and command_state.session.strict:
                 logger.info("strict spelling")
                 correct = arg in (currentBird, sciBird)
             else:
@@ -91,21 +85,10 @@ class Check(commands.Cog):
         if correct:
             logger.info("correct")
 
-            database.hset(f"channel:{ctx.channel.id}", "bird", "")
-            database.hset(f"channel:{ctx.channel.id}", "answered", "1")
-
-            session_increment(ctx, "correct", 1)
-            streak_increment(ctx, 1)
-            database.zincrby(
-                f"correct.user:{ctx.author.id}", 1, string.capwords(str(currentBird))
-            )
+            score, race_score = await record_answer(ctx, currentBird, "correct")
+            command_state.channel.apply(bird="", answered=1)
 
-            if (
-                race_in_session
-                and Filter.from_int(
-                    int(database.hget(f"race.data:{ctx.channel.id}", "filter"))
-                ).vc
-            ):
+            if race_in_session and Filter.from_int(race.filter).vc:
                 await voice_functions.stop(ctx, silent=True)
 
             await ctx.send(
@@ -113,57 +96,45 @@ class Check(commands.Cog):
                 if not race_in_session
                 else f"**{ctx.author.mention}**, you are correct!"
             )
-            url = get_wiki_url(ctx, currentBird)
+            url = await get_wiki_url(ctx, currentBird)
             await ctx.send(url)
-            score_increment(ctx, 1)
-            if int(database.zscore("users:global", str(ctx.author.id))) in achievement:
-                number = str(int(database.zscore("users:global", str(ctx.author.id))))
+            if score in achievement:
+                number = str(score)
                 await ctx.send(f"Wow! You have answered {number} birds correctly!")
                 filename = f"bot/media/achievements/{number}.PNG"
                 with open(filename, "rb") as img:
                     await ctx.send(file=discord.File(img, filename="award.png"))
 
             if race_in_session:
-                media = database.hget(f"race.data:{ctx.channel.id}", "media").decode(
-                    "utf-8"
-                )
-
-                limit = int(database.hget(f"race.data:{ctx.channel.id}", "limit"))
-                first = database.zrevrange(f"race.scores:{ctx.channel.id}", 0, 0, True)[
-                    0
-                ]
-                if int(first[1]) >= limit:
+                if race_score is not None and race_score >= race.limit:
                     logger.info("race ending")
-                    race = self.bot.get_cog("Race")
-                    await race.stop_race_(ctx)
+                    race_cog = self.bot.get_cog("Race")
+                    await race_cog.stop_race_(ctx)
                 else:
-                    logger.info(f"auto sending next bird {media}")
-                    filter_int, taxon, state = database.hmget(
-                        f"race.data:{ctx.channel.id}", ["filter", "taxon", "state"]
-                    )
+                    logger.info(f"auto sending next bird {race.media}")
                     birds = self.bot.get_cog("Birds")
                     await birds.send_bird_(
                         ctx,
-                        media,
-                        Filter.from_int(int(filter_int)),
-                        taxon.decode("utf-8"),
-                        state.decode("utf-8"),
+                        race.media,
+                        Filter.from_int(race.filter),
+                        race.taxon,
+                        race.state,
+                        command_state=command_state,
                     )
 
         else:
             logger.info("incorrect")
 
-            streak_increment(ctx, None)  # reset streak
-            session_increment(ctx, "incorrect", 1)
-            incorrect_increment(ctx, str(currentBird), 1)
+            # the bird stays the same in races
+            await record_answer(
+                ctx, currentBird, "incorrect", reset=not race_in_session
+            )
 
             if race_in_session:
                 await ctx.send("Sorry, that wasn't the right answer.")
             else:
-                database.hset(f"channel:{ctx.channel.id}", "bird", "")
-                database.hset(f"channel:{ctx.channel.id}", "answered", "1")
                 await ctx.send("Sorry, the bird was actually " + currentBird + ".")
-                url = get_wiki_url(ctx, currentBird)
+                url = await get_wiki_url(ctx, currentBird)
                 await ctx.send(url)
 
 
@@ -15,16 +15,17 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import random
-import string
 from typing import Optional
 
 from discord.ext import commands
 
+from bot.command_state import CommandState
 from bot.core import send_bird
-from bot.data import GenericError, database, goatsuckers, logger, states, taxons
+from bot.data import (GenericError, async_database, goatsuckers, logger, states,
+                      taxons)
 from bot.filters import Filter
 from bot.functions import (CustomCooldown, bird_setup, build_id_list,
-                           check_state_role, session_increment)
+                           check_state_role)
 
 BASE_MESSAGE = (
     "*Here you go!* \n**Use `b!{new_cmd}` again to get a new {media} of the same bird, "
@@ -63,6 +64,7 @@ class Birds(commands.Cog):
         taxon_str,
         role_str,
         retries,
+        command_state: CommandState,
     ):
         """Return a function to pass to send_bird() as on_error."""
         # pylint: disable=unused-argument
@@ -71,8 +73,8 @@ class Birds(commands.Cog):
             nonlocal retries
 
             # skip current bird
-            database.hset(f"channel:{ctx.channel.id}", "bird", "")
-            database.hset(f"channel:{ctx.channel.id}", "answered", "1")
+            command_state.channel.update(bird="", answered=1)
+            await command_state.channel.save()
 
             if retries >= 2:  # only retry twice
                 await ctx.send("**Too many retries.**\n*Please try again.*")
@@ -82,7 +84,7 @@ class Birds(commands.Cog):
                 retries += 1
                 await ctx.send("**Retrying...**")
                 await self.send_bird_(
-                    ctx, media_type, filters, taxon_str, role_str, retries
+                    ctx, media_type, filters, taxon_str, role_str, retries, command_state
                 )
             else:
                 await ctx.send("*Please try again.*")
@@ -90,21 +92,20 @@ class Birds(commands.Cog):
         return inner
 
     @staticmethod
-    def error_skip(ctx):
+    def error_skip(ctx, command_state: CommandState):
         async def inner(error):
             # pylint: disable=unused-argument
 
             # skip current bird
-            database.hset(f"channel:{ctx.channel.id}", "bird", "")
-            database.hset(f"channel:{ctx.channel.id}", "answered", "1")
+            command_state.channel.update(bird="", answered=1)
+            await command_state.channel.save()
             await ctx.send("*Please try again.*")
 
         return inner
 
     @staticmethod
-    def increment_bird_frequency(ctx, bird):
-        bird_setup(ctx, bird)
-        database.zincrby("frequency.bird:global", 1, string.capwords(bird))
+    async def increment_bird_frequency(ctx, bird):
+        await bird_setup(ctx, bird, frequency=1)
 
     async def send_bird_(
         self,
@@ -114,7 +115,12 @@ class Birds(commands.Cog):
         taxon_str: str = "",
         role_str: str = "",
         retries=0,
+        command_state: CommandState = None,
     ):
+        if command_state is None:
+            command_state = await CommandState.load(ctx)
+        channel = command_state.channel
+
         media_type = (
             "images"
             if media_type in ("images", "image", "i", "p")
@@ -124,7 +130,7 @@ class Birds(commands.Cog):
             raise GenericError("Invalid media type", code=990)
 
         if media_type == "songs" and filters.vc:
-            current_voice = database.get(f"voice.server:{ctx.guild.id}")
+            current_voice = await async_database.get(f"voice.server:{ctx.guild.id}")
             if current_voice is not None and current_voice.decode("utf-8") != str(
                 ctx.channel.id
             ):
@@ -142,16 +148,12 @@ class Birds(commands.Cog):
         else:
             roles = []
 
-        logger.info(
-            "bird: "
-            + database.hget(f"channel:{ctx.channel.id}", "bird").decode("utf-8")
-        )
-
-        answered = int(database.hget(f"channel:{ctx.channel.id}", "answered"))
-        logger.info(f"answered: {answered}")
+        logger.info("bird: " + channel.bird)
+        logger.info(f"answered: {channel.answered}")
         # check to see if previous bird was answered
-        if answered:  # if yes, give a new bird
-            session_increment(ctx, "total", 1)
+        if channel.answered:  # if yes, give a new bird
+            if command_state.session is not None:
+                command_state.session.increment("total")
 
             logger.info(f"filters: {filters}; taxon: {taxon}; roles: {roles}")
 
@@ -165,70 +167,70 @@ class Birds(commands.Cog):
 
             find_custom_role = {i if i.startswith("CUSTOM:") else "" for i in roles}
             find_custom_role.discard("")
-            if (
-                database.exists(f"race.data:{ctx.channel.id}")
-                and len(find_custom_role) == 1
-            ):
+            if command_state.race is not None and len(find_custom_role) == 1:
                 custom_role = find_custom_role.pop()
                 roles.remove(custom_role)
                 roles.append("CUSTOM")
                 user_id = custom_role.split(":")[1]
-                birds = build_id_list(
+                birds = await build_id_list(
                     user_id=user_id, taxon=taxon, roles=roles, media=media_type
                 )
             else:
-                birds = build_id_list(
+                birds = await build_id_list(
                     user_id=ctx.author.id, taxon=taxon, roles=roles, media=media_type
                 )
 
             if not birds:
                 logger.info("no birds for taxon/state")
+                await command_state.save()
                 await ctx.send(
                     "**Sorry, no birds could be found for the taxon/state combo.**\n*Please try again*"
                 )
                 return
 
             currentBird = random.choice(birds)
-            self.increment_bird_frequency(ctx, currentBird)
+            await self.increment_bird_frequency(ctx, currentBird)
 
-            prevB = database.hget(f"channel:{ctx.channel.id}", "prevB").decode("utf-8")
-            while currentBird == prevB and len(birds) > 1:
+            while currentBird == channel.prevB and len(birds) > 1:
                 currentBird = random.choice(birds)
-            database.hset(f"channel:{ctx.channel.id}", "prevB", str(currentBird))
-            database.hset(f"channel:{ctx.channel.id}", "bird", str(currentBird))
+            channel.update(prevB=str(currentBird), bird=str(currentBird), answered=0)
             logger.info("currentBird: " + str(currentBird))
-            database.hset(f"channel:{ctx.channel.id}", "answered", "0")
+            await command_state.save()
             await send_bird(
                 ctx,
                 currentBird,
                 media_type,
                 filters,
                 on_error=self.error_handle(
-                    ctx, media_type, filters, taxon_str, role_str, retries
+                    ctx, media_type, filters, taxon_str, role_str, retries, command_state
                 ),
                 message=(SONG_MESSAGE if media_type == "songs" else BIRD_MESSAGE),
+                command_state=command_state,
             )
         else:  # if no, give the same bird
             await ctx.send(f"**Active Filters**: `{'`, `'.join(filters.display())}`")
             await send_bird(
                 ctx,
-                database.hget(f"channel:{ctx.channel.id}", "bird").decode("utf-8"),
+                channel.bird,
                 media_type,
                 filters,
                 on_error=self.error_handle(
-                    ctx, media_type, filters, taxon_str, role_str, retries
+                    ctx, media_type, filters, taxon_str, role_str, retries, command_state
                 ),
                 message=(SONG_MESSAGE if media_type == "songs" else BIRD_MESSAGE),
+                command_state=command_state,
             )
 
     @staticmethod
-    async def parse(ctx, args_str: str):
+    async def parse(ctx, args_str: str, command_state: CommandState):
         """Parse arguments for options."""
 
         args = args_str.split(" ")
         logger.info(f"args: {args}")
+        race = command_state.race
+        session = command_state.session
 
-        if not database.exists(f"race.data:{ctx.channel.id}"):
+        if race is None:
             roles = check_state_role(ctx)
 
             taxon_args = set(taxons.keys()).intersection({arg.lower() for arg in args})
@@ -243,15 +245,11 @@ class Birds(commands.Cog):
             else:
                 state = ""
 
-            if database.exists(f"session.data:{ctx.author.id}"):
+            if session is not None:
                 logger.info("session parameters")
 
                 if taxon_args:
-                    current_taxons = set(
-                        database.hget(f"session.data:{ctx.author.id}", "taxon")
-                        .decode("utf-8")
-                        .split(" ")
-                    )
+                    current_taxons = set(session.taxon.split(" "))
                     logger.info(f"toggle taxons: {taxon_args}")
                     logger.info(f"current taxons: {current_taxons}")
                     taxon_args.symmetric_difference_update(current_taxons)
@@ -259,24 +257,16 @@ class Birds(commands.Cog):
                     logger.info(f"new taxons: {taxon_args}")
                     taxon = " ".join(taxon_args).strip()
                 else:
-                    taxon = database.hget(
-                        f"session.data:{ctx.author.id}", "taxon"
-                    ).decode("utf-8")
-
-                roles = (
-                    database.hget(f"session.data:{ctx.author.id}", "state")
-                    .decode("utf-8")
-                    .split(" ")
-                )
+                    taxon = session.taxon
+
+                roles = session.state.split(" ")
                 if roles[0] == "":
                     roles = []
                 if not roles:
                     logger.info("no session lists")
                     roles = check_state_role(ctx)
 
-                session_filter = int(
-                    database.hget(f"session.data:{ctx.author.id}", "filter")
-                )
+                session_filter = session.filter
                 filters = Filter.parse(args_str, defaults=False)
                 if filters.vc:
                     filters.vc = False
@@ -309,7 +299,7 @@ class Birds(commands.Cog):
         else:
             logger.info("race parameters")
 
-            race_filter = int(database.hget(f"race.data:{ctx.channel.id}", "filter"))
+            race_filter = race.filter
             filters = Filter.parse(args_str, defaults=False)
             if filters.vc:
                 filters.vc = False
@@ -324,12 +314,8 @@ class Birds(commands.Cog):
                 filters ^= Filter()  # clear defaults
             filters ^= race_filter
 
-            taxon = database.hget(f"race.data:{ctx.channel.id}", "taxon").decode(
-                "utf-8"
-            )
-            state = database.hget(f"race.data:{ctx.channel.id}", "state").decode(
-                "utf-8"
-            )
+            taxon = race.taxon
+            state = race.state
 
         logger.info(f"args: filters: {filters}; taxon: {taxon}; state: {state}")
 
@@ -347,13 +333,14 @@ class Birds(commands.Cog):
     async def bird(self, ctx, *, args_str: str = ""):
         logger.info("command: bird")
 
-        filters, taxon, state = await self.parse(ctx, args_str)
+        command_state = await CommandState.load(ctx)
+        filters, taxon, state = await self.parse(ctx, args_str, command_state)
         media = "images"
-        if database.exists(f"race.data:{ctx.channel.id}"):
-            media = database.hget(f"race.data:{ctx.channel.id}", "media").decode(
-                "utf-8"
-            )
-        await self.send_bird_(ctx, media, filters, taxon, state)
+        if command_state.race is not None:
+            media = command_state.race.media
+        await self.send_bird_(
+            ctx, media, filters, taxon, state, command_state=command_state
+        )
 
     # picks a random bird call to send
     @commands.command(
@@ -365,13 +352,14 @@ class Birds(commands.Cog):
     async def song(self, ctx, *, args_str: str = ""):
         logger.info("command: song")
 
-        filters, taxon, state = await self.parse(ctx, args_str)
+        command_state = await CommandState.load(ctx)
+        filters, taxon, state = await self.parse(ctx, args_str, command_state)
         media = "songs"
-        if database.exists(f"race.data:{ctx.channel.id}"):
-            media = database.hget(f"race.data:{ctx.channel.id}", "media").decode(
-                "utf-8"
-            )
-        await self.send_bird_(ctx, media, filters, taxon, state)
+        if command_state.race is not None:
+            media = command_state.race.media
+        await self.send_bird_(
+            ctx, media, filters, taxon, state, command_state=command_state
+        )
 
     # goatsucker command - no args
     # just for fun, no real purpose
@@ -380,37 +368,41 @@ class Birds(commands.Cog):
     async def goatsucker(self, ctx):
         logger.info("command: goatsucker")
 
-        if database.exists(f"race.data:{ctx.channel.id}"):
+        command_state = await CommandState.load(ctx)
+        if command_state.race is not None:
             await ctx.send("This command is disabled during races.")
             return
 
-        answered = int(database.hget(f"channel:{ctx.channel.id}", "answered"))
+        channel = command_state.channel
         # check to see if previous bird was answered
-        if answered:  # if yes, give a new bird
-            session_increment(ctx, "total", 1)
+        if channel.answered:  # if yes, give a new bird
+            if command_state.session is not None:
+                command_state.session.increment("total")
 
-            database.hset(f"channel:{ctx.channel.id}", "answered", "0")
             currentBird = random.choice(goatsuckers)
-            self.increment_bird_frequency(ctx, currentBird)
+            await self.increment_bird_frequency(ctx, currentBird)
 
-            database.hset(f"channel:{ctx.channel.id}", "bird", str(currentBird))
+            channel.update(bird=str(currentBird), answered=0)
             logger.info("currentBird: " + str(currentBird))
+            await command_state.save()
             await send_bird(
                 ctx,
                 currentBird,
                 "images",
                 Filter(),
-                on_error=self.error_skip(ctx),
+                on_error=self.error_skip(ctx, command_state),
                 message=GS_MESSAGE,
+                command_state=command_state,
             )
         else:  # if no, give the same bird
             await send_bird(
                 ctx,
-                database.hget(f"channel:{ctx.channel.id}", "bird").decode("utf-8"),
+                channel.bird,
                 "images",
                 Filter(),
-                on_error=self.error_skip(ctx),
+                on_error=self.error_skip(ctx, command_state),
                 message=GS_MESSAGE,
+                command_state=command_state,
             )
 
 
@@ -16,7 +16,8 @@
 
 from discord.ext import commands
 
-from bot.data import database, logger
+from bot.command_state import CommandState
+from bot.data import logger
 from bot.functions import CustomCooldown
 
 
@@ -30,7 +31,7 @@ class Hint(commands.Cog):
     async def hint(self, ctx):
         logger.info("command: hint")
 
-        currentBird = database.hget(f"channel:{ctx.channel.id}", "bird").decode("utf-8")
+        currentBird = (await CommandState.load(ctx)).channel.bird
         if currentBird != "":  # check if there is bird
             await ctx.send(f"The first letter is {currentBird[0]}")
         else:
@@ -14,8 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import contextlib
-import os
+import asyncio
 import random
 from difflib import get_close_matches
 
@@ -23,11 +22,17 @@ import discord
 import wikipedia
 from discord.ext import commands
 
+from bot.cache import cache_stats, media_manifest
+from bot.catalog import catalog_index
 from bot.core import get_sciname, get_taxon, send_bird
 from bot.data import (alpha_codes, birdListMaster, logger, memeList,
-                      sciListMaster, states, taxons)
+                      sciListMaster, states, taxonomy, taxonomy_version, taxons)
 from bot.filters import Filter
-from bot.functions import CustomCooldown, build_id_list
+from bot.functions import CustomCooldown, build_id_list, known_entities
+from bot.http_cache import response_cache
+from bot.network import flights, upstream_health
+from bot.prefetch import prefetcher
+from bot.scheduler import download_scheduler
 
 
 class Other(commands.Cog):
@@ -128,10 +133,10 @@ class Other(commands.Cog):
             )
             return
 
-        state_birdlist = build_id_list(
+        state_birdlist = await build_id_list(
             user_id=ctx.author.id, state=state, media="images"
         )
-        state_songlist = build_id_list(
+        state_songlist = await build_id_list(
             user_id=ctx.author.id, state=state, media="songs"
         )
 
@@ -197,10 +202,10 @@ class Other(commands.Cog):
             )
             return
 
-        bird_list = build_id_list(
+        bird_list = await build_id_list(
             user_id=ctx.author.id, taxon=taxon, state=state, media="images"
         )
-        song_bird_list = build_id_list(
+        song_bird_list = await build_id_list(
             user_id=ctx.author.id, taxon=taxon, state=state, media="songs"
         )
         if not bird_list and not song_bird_list:
@@ -289,15 +294,23 @@ class Other(commands.Cog):
     @commands.is_owner()
     async def cache(self, ctx):
         logger.info("command: cache stats")
-        items = []
-        with contextlib.suppress(FileNotFoundError):
-            items += os.listdir("bot_files/cache/images/")
-        with contextlib.suppress(FileNotFoundError):
-            items += os.listdir("bot_files/cache/songs/")
+        # counting the cached responses reads the whole cache directory
+        http_cache = await asyncio.get_running_loop().run_in_executor(
+            None, response_cache.info
+        )
         stats = {
-            "sciname_cache": get_sciname.cache_info(),
-            "taxon_cache": get_taxon.cache_info(),
-            "num_downloaded_birds": len(items),
+            "sciname_cache": await get_sciname.cache_info(),
+            "taxon_cache": await get_taxon.cache_info(),
+            "taxonomy_table": {"version": taxonomy_version, "size": len(taxonomy)},
+            "num_downloaded_birds": len(media_manifest),
+            "media_cache": cache_stats.info(),
+            "prefetch": prefetcher.info(),
+            "single_flight": flights.info(),
+            "catalog": catalog_index.info(),
+            "upstream": upstream_health.info(),
+            "http_cache": http_cache,
+            "downloads": download_scheduler.info(),
+            "known_entities": known_entities.info(),
         }
         await ctx.send(f"```python\n{stats}```")
 
@@ -21,8 +21,8 @@ import discord
 import pandas as pd
 from discord.ext import commands
 
-from bot.data import GenericError, database, logger
-from bot.functions import CustomCooldown, send_leaderboard
+from bot.data import GenericError, async_database, logger
+from bot.functions import CustomCooldown, send_leaderboard, server_score_setup
 
 
 class Score(commands.Cog):
@@ -30,22 +30,20 @@ class Score(commands.Cog):
         self.bot = bot
 
     @staticmethod
-    def _server_total(ctx):
+    async def _server_total(ctx):
         logger.info("fetching server totals")
-        channels = map(
-            lambda x: x.decode("utf-8").split(":")[1],
-            database.zrangebylex(
-                "channels:global", f"[{ctx.guild.id}", f"({ctx.guild.id}\xff"
-            ),
+        members = await async_database.zrangebylex(
+            "channels:global", f"[{ctx.guild.id}", f"({ctx.guild.id}\xff"
         )
-        pipe = database.pipeline()  # use a pipeline to get all the scores
+        channels = map(lambda x: x.decode("utf-8").split(":")[1], members)
+        pipe = async_database.pipeline()  # use a pipeline to get all the scores
         for channel in channels:
             pipe.zscore("score:global", channel)
-        scores = pipe.execute()
+        scores = await pipe.execute()
         return int(sum(scores))
 
     @staticmethod
-    def _monthly_lb(category):
+    async def _monthly_lb(category):
         logger.info("generating monthly leaderboard")
         if category == "scores":
             key = "daily.score"
@@ -58,10 +56,10 @@ class Score(commands.Cog):
         past_month = pd.date_range(  # pylint: disable=no-member
             today - datetime.timedelta(29), today
         ).date
-        pipe = database.pipeline()
+        pipe = async_database.pipeline()
         for day in past_month:
             pipe.zrevrangebyscore(f"{key}:{day}", "+inf", "-inf", withscores=True)
-        result = pipe.execute()
+        result = await pipe.execute()
         totals = pd.Series(dtype="int64")
         for daily_score in result:
             daily_score = pd.Series(
@@ -86,7 +84,7 @@ class Score(commands.Cog):
             page = 1
 
         user_amount = (
-            int(database.zcard(database_key))
+            int(await async_database.zcard(database_key))
             if database_key is not None
             else data.count()
         )
@@ -102,7 +100,7 @@ class Score(commands.Cog):
 
         users_per_page = 10
         leaderboard_list = (
-            database.zrevrangebyscore(
+            await async_database.zrevrangebyscore(
                 database_key, "+inf", "-inf", page, users_per_page, True
             )
             if database_key is not None
@@ -145,17 +143,22 @@ class Score(commands.Cog):
         embed.add_field(name=title, value=leaderboard, inline=False)
 
         user_score = (
-            database.zscore(database_key, str(ctx.author.id))
+            await async_database.zscore(database_key, str(ctx.author.id))
             if database_key is not None
             else data.get(str(ctx.author.id))
         )
 
         if user_score is not None:
             if database_key is not None:
-                placement = int(database.zrevrank(database_key, str(ctx.author.id))) + 1
+                placement = (
+                    int(await async_database.zrevrank(database_key, str(ctx.author.id)))
+                    + 1
+                )
                 distance = int(
-                    database.zrevrange(
-                        database_key, placement - 2, placement - 2, True
+                    (
+                        await async_database.zrevrange(
+                            database_key, placement - 2, placement - 2, True
+                        )
                     )[0][1]
                 ) - int(user_score)
             else:
@@ -196,13 +199,15 @@ class Score(commands.Cog):
         logger.info("command: score")
 
         if scope in ("server", "s"):
-            total_correct = self._server_total(ctx)
+            total_correct = await self._server_total(ctx)
             await ctx.send(
                 f"Wow, looks like a total of `{total_correct}` birds have been answered correctly in this **server**!\n"
                 + "Good job everyone!"
             )
         else:
-            total_correct = int(database.zscore("score:global", str(ctx.channel.id)))
+            total_correct = int(
+                await async_database.zscore("score:global", str(ctx.channel.id))
+            )
             await ctx.send(
                 f"Wow, looks like a total of `{total_correct}` birds have been answered correctly in this **channel**!\n"
                 + "Good job everyone!"
@@ -230,7 +235,7 @@ class Score(commands.Cog):
                 return
             usera = user.id
             logger.info(usera)
-            score = database.zscore("users:global", str(usera))
+            score = await async_database.zscore("users:global", str(usera))
             if score is not None:
                 score = int(score)
                 user = f"<@{usera}>"
@@ -239,7 +244,7 @@ class Score(commands.Cog):
                 return
         else:
             user = f"<@{ctx.author.id}>"
-            score = int(database.zscore("users:global", str(ctx.author.id)))
+            score = int(await async_database.zscore("users:global", str(ctx.author.id)))
 
         embed = discord.Embed(type="rich", colour=discord.Color.blurple())
         embed.set_author(name="Bird ID - An Ornithology Bot")
@@ -271,8 +276,8 @@ class Score(commands.Cog):
                 return
             usera = user.id
             logger.info(usera)
-            streak = database.zscore("streak:global", str(usera))
-            max_streak = database.zscore("streak.max:global", str(usera))
+            streak = await async_database.zscore("streak:global", str(usera))
+            max_streak = await async_database.zscore("streak.max:global", str(usera))
             if streak is not None and max_streak is not None:
                 streak = int(streak)
                 max_streak = int(max_streak)
@@ -282,8 +287,12 @@ class Score(commands.Cog):
                 return
         else:
             user = f"<@{ctx.author.id}>"
-            streak = int(database.zscore("streak:global", str(ctx.author.id)))
-            max_streak = int(database.zscore("streak.max:global", str(ctx.author.id)))
+            streak = int(
+                await async_database.zscore("streak:global", str(ctx.author.id))
+            )
+            max_streak = int(
+                await async_database.zscore("streak.max:global", str(ctx.author.id))
+            )
 
         embed = discord.Embed(
             type="rich", colour=discord.Color.blurple(), title="**User Streaks**"
@@ -370,6 +379,7 @@ class Score(commands.Cog):
             if ctx.guild is not None:
                 database_key = f"users.server:{ctx.guild.id}"
                 scope = "server"
+                await server_score_setup(ctx)
             else:
                 logger.info("dm context")
                 await ctx.send(
@@ -381,7 +391,7 @@ class Score(commands.Cog):
         elif scope in ("month", "monthly", "m"):
             database_key = None
             scope = "Last 30 Days"
-            data = self._monthly_lb("scores")
+            data = await self._monthly_lb("scores")
         else:
             database_key = "users:global"
             scope = "global"
@@ -446,7 +456,7 @@ class Score(commands.Cog):
             database_key = f"incorrect.user:{ctx.author.id}"
             scope = "me"
         elif scope in ("month", "monthly", "mo"):
-            data = self._monthly_lb("missed")
+            data = await self._monthly_lb("missed")
             database_key = None
             scope = "Last 30 days"
         else:
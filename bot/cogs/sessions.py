@@ -21,7 +21,7 @@ import time
 import discord
 from discord.ext import commands
 
-from bot.data import database, logger, states, taxons
+from bot.data import async_database, logger, states, taxons
 from bot.filters import Filter
 from bot.functions import CustomCooldown, check_state_role
 
@@ -31,7 +31,7 @@ class Sessions(commands.Cog):
         self.bot = bot
 
     async def _get_options(self, ctx):
-        filter_int, state, taxon, wiki, strict = database.hmget(
+        filter_int, state, taxon, wiki, strict = await async_database.hmget(
             f"session.data:{ctx.author.id}",
             ["filter", "state", "taxon", "wiki", "strict"],
         )
@@ -50,7 +50,7 @@ class Sessions(commands.Cog):
     async def _get_stats(self, ctx):
         start, correct, incorrect, total = map(
             int,
-            database.hmget(
+            await async_database.hmget(
                 f"session.data:{ctx.author.id}",
                 ["start", "correct", "incorrect", "total"],
             ),
@@ -80,8 +80,8 @@ class Sessions(commands.Cog):
         )
         embed.set_author(name="Bird ID - An Ornithology Bot")
 
-        if database.zcard(database_key) != 0:
-            leaderboard_list = database.zrevrangebyscore(
+        if await async_database.zcard(database_key) != 0:
+            leaderboard_list = await async_database.zrevrangebyscore(
                 database_key, "+inf", "-inf", 0, 5, True
             )
             leaderboard = ""
@@ -131,7 +131,7 @@ class Sessions(commands.Cog):
     async def start(self, ctx, *, args_str: str = ""):
         logger.info("command: start session")
 
-        if database.exists(f"session.data:{ctx.author.id}"):
+        if await async_database.exists(f"session.data:{ctx.author.id}"):
             logger.info("already session")
             await ctx.send(
                 "**There is already a session running.** *Change settings/view stats with `b!session edit`*"
@@ -172,7 +172,7 @@ class Sessions(commands.Cog):
             f"adding filters: {filters}; state: {state}; wiki: {wiki}; strict: {strict}"
         )
 
-        database.hset(
+        await async_database.hset(
             f"session.data:{ctx.author.id}",
             mapping={
                 "start": round(time.time()),
@@ -204,7 +204,7 @@ class Sessions(commands.Cog):
     async def edit(self, ctx, *, args_str: str = ""):
         logger.info("command: view session")
 
-        if database.exists(f"session.data:{ctx.author.id}"):
+        if await async_database.exists(f"session.data:{ctx.author.id}"):
             new_filter = Filter.parse(args_str, defaults=False)
             if new_filter.vc:
                 new_filter.vc = False
@@ -213,31 +213,41 @@ class Sessions(commands.Cog):
             args = args_str.lower().split(" ")
             logger.info(f"args: {args}")
 
-            new_filter ^= int(database.hget(f"session.data:{ctx.author.id}", "filter"))
-            database.hset(
+            new_filter ^= int(
+                await async_database.hget(f"session.data:{ctx.author.id}", "filter")
+            )
+            await async_database.hset(
                 f"session.data:{ctx.author.id}", "filter", str(new_filter.to_int())
             )
 
             if "wiki" in args:
-                if database.hget(f"session.data:{ctx.author.id}", "wiki"):
+                if await async_database.hget(f"session.data:{ctx.author.id}", "wiki"):
                     logger.info("enabling wiki embeds")
-                    database.hset(f"session.data:{ctx.author.id}", "wiki", "")
+                    await async_database.hset(
+                        f"session.data:{ctx.author.id}", "wiki", ""
+                    )
                 else:
                     logger.info("disabling wiki embeds")
-                    database.hset(f"session.data:{ctx.author.id}", "wiki", "wiki")
+                    await async_database.hset(
+                        f"session.data:{ctx.author.id}", "wiki", "wiki"
+                    )
 
             if "strict" in args:
-                if database.hget(f"session.data:{ctx.author.id}", "strict"):
+                if await async_database.hget(f"session.data:{ctx.author.id}", "strict"):
                     logger.info("disabling strict spelling")
-                    database.hset(f"session.data:{ctx.author.id}", "strict", "")
+                    await async_database.hset(
+                        f"session.data:{ctx.author.id}", "strict", ""
+                    )
                 else:
                     logger.info("enabling strict spelling")
-                    database.hset(f"session.data:{ctx.author.id}", "strict", "strict")
+                    await async_database.hset(
+                        f"session.data:{ctx.author.id}", "strict", "strict"
+                    )
 
             states_args = set(states.keys()).intersection({arg.upper() for arg in args})
             if states_args:
                 current_states = set(
-                    database.hget(f"session.data:{ctx.author.id}", "state")
+                    await async_database.hget(f"session.data:{ctx.author.id}", "state")
                     .decode("utf-8")
                     .split(" ")
                 )
@@ -246,7 +256,7 @@ class Sessions(commands.Cog):
                 states_args.symmetric_difference_update(current_states)
                 states_args.discard("")
                 logger.info(f"new states: {states_args}")
-                database.hset(
+                await async_database.hset(
                     f"session.data:{ctx.author.id}",
                     "state",
                     " ".join(states_args).strip(),
@@ -255,7 +265,7 @@ class Sessions(commands.Cog):
             taxon_args = set(taxons.keys()).intersection({arg.lower() for arg in args})
             if taxon_args:
                 current_taxons = set(
-                    database.hget(f"session.data:{ctx.author.id}", "taxon")
+                    await async_database.hget(f"session.data:{ctx.author.id}", "taxon")
                     .decode("utf-8")
                     .split(" ")
                 )
@@ -264,7 +274,7 @@ class Sessions(commands.Cog):
                 taxon_args.symmetric_difference_update(current_taxons)
                 taxon_args.discard("")
                 logger.info(f"new taxons: {taxon_args}")
-                database.hset(
+                await async_database.hset(
                     f"session.data:{ctx.author.id}",
                     "taxon",
                     " ".join(taxon_args).strip(),
@@ -282,12 +292,14 @@ class Sessions(commands.Cog):
     async def stop(self, ctx):
         logger.info("command: stop session")
 
-        if database.exists(f"session.data:{ctx.author.id}"):
-            database.hset(f"session.data:{ctx.author.id}", "stop", round(time.time()))
+        if await async_database.exists(f"session.data:{ctx.author.id}"):
+            await async_database.hset(
+                f"session.data:{ctx.author.id}", "stop", round(time.time())
+            )
 
             await self._send_stats(ctx, "**Session stopped.**\n")
-            database.delete(f"session.data:{ctx.author.id}")
-            database.delete(f"session.incorrect:{ctx.author.id}")
+            await async_database.delete(f"session.data:{ctx.author.id}")
+            await async_database.delete(f"session.incorrect:{ctx.author.id}")
         else:
             await ctx.send(
                 "**There is no session running.** *You can start one with `b!session start`*"
@@ -17,9 +17,10 @@
 from discord.ext import commands
 
 import bot.voice as voice_functions
-from bot.data import database, get_wiki_url, logger
+from bot.command_state import CommandState
+from bot.data import async_database, get_wiki_url, logger
 from bot.filters import Filter
-from bot.functions import CustomCooldown, streak_increment
+from bot.functions import CustomCooldown, record_answer
 
 
 class Skip(commands.Cog):
@@ -32,48 +33,44 @@ class Skip(commands.Cog):
     async def skip(self, ctx):
         logger.info("command: skip")
 
-        currentBird = database.hget(f"channel:{ctx.channel.id}", "bird").decode("utf-8")
-        database.hset(f"channel:{ctx.channel.id}", "bird", "")
-        database.hset(f"channel:{ctx.channel.id}", "answered", "1")
+        command_state = await CommandState.load(ctx)
+        race = command_state.race
+        currentBird = command_state.channel.bird
         if currentBird != "":  # check if there is bird
-            url = get_wiki_url(ctx, currentBird)
+            # resets the bird and streak
+            await record_answer(ctx, currentBird, "skip")
+            command_state.channel.apply(bird="", answered=1)
+            url = await get_wiki_url(ctx, currentBird)
             await ctx.send(f"Ok, skipping {currentBird.lower()}")
             await ctx.send(url)  # sends wiki page
 
-            streak_increment(ctx, None)  # reset streak
-
-            if database.exists(f"race.data:{ctx.channel.id}"):
-                if Filter.from_int(
-                    int(database.hget(f"race.data:{ctx.channel.id}", "filter"))
-                ).vc:
+            if race is not None:
+                if Filter.from_int(race.filter).vc:
                     await voice_functions.stop(ctx, silent=True)
 
-                media = database.hget(f"race.data:{ctx.channel.id}", "media").decode(
-                    "utf-8"
-                )
-
-                limit = int(database.hget(f"race.data:{ctx.channel.id}", "limit"))
-                first = database.zrevrange(f"race.scores:{ctx.channel.id}", 0, 0, True)[
-                    0
-                ]
-                if int(first[1]) >= limit:
+                first = (
+                    await async_database.zrevrange(
+                        f"race.scores:{ctx.channel.id}", 0, 0, True
+                    )
+                )[0]
+                if int(first[1]) >= race.limit:
                     logger.info("race ending")
-                    race = self.bot.get_cog("Race")
-                    await race.stop_race_(ctx)
+                    race_cog = self.bot.get_cog("Race")
+                    await race_cog.stop_race_(ctx)
                 else:
-                    logger.info(f"auto sending next bird {media}")
-                    filter_int, taxon, state = database.hmget(
-                        f"race.data:{ctx.channel.id}", ["filter", "taxon", "state"]
-                    )
+                    logger.info(f"auto sending next bird {race.media}")
                     birds = self.bot.get_cog("Birds")
                     await birds.send_bird_(
                         ctx,
-                        media,
-                        Filter.from_int(int(filter_int)),
-                        taxon.decode("utf-8"),
-                        state.decode("utf-8"),
+                        race.media,
+                        Filter.from_int(race.filter),
+                        race.taxon,
+                        race.state,
+                        command_state=command_state,
                     )
         else:
+            command_state.channel.update(bird="", answered=1)
+            await command_state.save()
             await ctx.send("You need to ask for a bird first!")
 
 
@@ -22,7 +22,7 @@ import numpy as np
 import pandas as pd
 from discord.ext import commands
 
-from bot.data import database, logger
+from bot.data import async_database, logger
 from bot.functions import CustomCooldown, send_leaderboard
 
 
@@ -31,21 +31,23 @@ class Stats(commands.Cog):
         self.bot = bot
 
     @staticmethod
-    def generate_series(database_key):
+    async def generate_series(database_key):
         """Generates a pandas.Series from a Redis sorted set."""
         logger.info("generating series")
-        data = database.zrevrangebyscore(database_key, "+inf", "-inf", withscores=True)
+        data = await async_database.zrevrangebyscore(
+            database_key, "+inf", "-inf", withscores=True
+        )
         return pd.Series(
             {e[0]: e[1] for e in map(lambda x: (x[0].decode("utf-8"), int(x[1])), data)}
         )
 
     @staticmethod
-    def generate_dataframe(database_keys, titles):
+    async def generate_dataframe(database_keys, titles):
         """Generates a pandas.DataFrame from multiple Redis sorted sets."""
-        pipe = database.pipeline()
+        pipe = async_database.pipeline()
         for key in database_keys:
             pipe.zrevrangebyscore(key, "+inf", "-inf", withscores=True)
-        result = pipe.execute()
+        result = await pipe.execute()
         df = pd.DataFrame()
         for i, item in enumerate(result):
             df.insert(
@@ -149,7 +151,7 @@ class Stats(commands.Cog):
 
         elif topic == "scores":
             embed.description = "**Score Statistics**"
-            scores = self.generate_series("users:global")
+            scores = await self.generate_series("users:global")
             scores = scores[scores > 0]
             c, d = np.histogram(scores, bins=range(0, 1100, 100), range=(0, 1000))
             c = (c / len(scores) * 100).round(1)
@@ -195,7 +197,7 @@ class Stats(commands.Cog):
             titles = list(
                 reversed(range(1, 32))
             )  # label columns by # days ago, today is 1 day ago
-            month = self.generate_dataframe(keys, titles)
+            month = await self.generate_dataframe(keys, titles)
             total = month.loc[:, 31]
             month = month.loc[:, 30:1]  # remove totals column
             month = month.loc[(month != 0).any(1)]  # remove users with all 0s
@@ -205,7 +207,7 @@ class Stats(commands.Cog):
             today = today.loc[today != 0]
 
             channels_see = len(list(self.bot.get_all_channels()))
-            channels_used = int(database.zcard("score:global"))
+            channels_used = int(await async_database.zcard("score:global"))
 
             embed.add_field(
                 name="Today (Since midnight UTC)",
@@ -266,7 +268,7 @@ class Stats(commands.Cog):
 
         async def _export_helper(database_keys, header, filename, users=False):
             if not isinstance(database_keys, str) and len(database_keys) > 1:
-                data = self.generate_dataframe(
+                data = await self.generate_dataframe(
                     database_keys, header.strip().split(",")[1:]
                 )
             else:
@@ -275,7 +277,7 @@ class Stats(commands.Cog):
                     if isinstance(database_keys, str)
                     else database_keys[0]
                 )
-                data = self.generate_series(key)
+                data = await self.generate_series(key)
             if users:
                 data = await self.convert_users(data)
             with StringIO() as f:
@@ -312,7 +314,9 @@ class Stats(commands.Cog):
         keys = list(
             map(
                 lambda x: x.decode("utf-8"),
-                database.scan_iter(match="daily.incorrect:????-??-??", count=5000),
+                await async_database.scan_keys(
+                    "daily.incorrect:????-??-??", count=5000
+                ),
             )
         )
         keys.sort()
@@ -326,7 +330,7 @@ class Stats(commands.Cog):
         keys = list(
             map(
                 lambda x: x.decode("utf-8"),
-                database.scan_iter(match="daily.score:????-??-??", count=5000),
+                await async_database.scan_keys("daily.score:????-??-??", count=5000),
             )
         )
         keys.sort()
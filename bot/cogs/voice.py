@@ -17,7 +17,7 @@
 from discord.ext import commands, tasks
 
 import bot.voice as voice_functions
-from bot.data import logger, database
+from bot.data import logger, async_database
 from bot.functions import CustomCooldown
 
 
@@ -82,7 +82,7 @@ class Voice(commands.Cog):
     @commands.guild_only()
     async def disconnect(self, ctx):
         logger.info("command: disconnect")
-        current_voice = database.get(f"voice.server:{ctx.guild.id}")
+        current_voice = await async_database.get(f"voice.server:{ctx.guild.id}")
         if current_voice is not None:
             race = ctx.bot.get_cog("Race")
             await race.stop_race_(ctx)
@@ -0,0 +1,207 @@
+# command_state.py | snapshots of channel, race, and session data
+# Copyright (C) 2019-2020  EraserBird, person_v1.32, hmmm
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from typing import Optional
+
+from bot.data import async_database, logger
+
+# see bot/data/__init__.py for the format of each hash
+
+
+class _HashState:
+    """Typed snapshot of a Redis hash.
+
+    Fields are decoded when the snapshot is loaded. Changed fields
+    are written back together with `save()`.
+    """
+
+    __slots__ = ("key", "_changed", "_increments")
+    # field name: (type, default)
+    FIELDS: dict = {}
+
+    def __init__(self, key: str, data: dict):
+        self.key = key
+        self._changed = {}
+        self._increments = {}
+        for field, (kind, default) in self.FIELDS.items():
+            value = data.get(field.encode("utf-8"))
+            if value is None:
+                value = default
+            else:
+                value = value.decode("utf-8")
+                if kind is int:
+                    value = int(value) if value else default
+            setattr(self, field, value)
+
+    def update(self, **fields):
+        """Changes fields of the snapshot, to be written with `save()`."""
+        for field, value in fields.items():
+            setattr(self, field, value)
+            self._changed[field] = value
+
+    def increment(self, field: str, amount: int = 1):
+        """Increments an integer field, to be written with `save()`."""
+        setattr(self, field, getattr(self, field) + amount)
+        self._increments[field] = self._increments.get(field, 0) + amount
+
+    def apply(self, **fields):
+        """Changes fields of the snapshot that were already written elsewhere."""
+        for field, value in fields.items():
+            setattr(self, field, value)
+            self._changed.pop(field, None)
+
+    def queue(self, pipe):
+        """Adds writes of the changed fields to a pipeline."""
+        if not self._changed and not self._increments:
+            return
+        logger.info(
+            f"saving {', '.join({**self._changed, **self._increments})} to {self.key}"
+        )
+        if self._changed:
+            pipe.hset(
+                self.key,
+                mapping={field: str(value) for field, value in self._changed.items()},
+            )
+        for field, amount in self._increments.items():
+            pipe.hincrby(self.key, field, amount)
+        self._changed = {}
+        self._increments = {}
+
+    async def save(self):
+        """Writes changed fields in one round trip."""
+        pipe = async_database.pipeline(transaction=False)
+        self.queue(pipe)
+        if len(pipe):
+            await pipe.execute()
+
+
+class ChannelState(_HashState):
+    """The current bird in a channel."""
+
+    __slots__ = ("bird", "answered", "prevB", "prevJ")
+    FIELDS = {
+        "bird": (str, ""),
+        "answered": (int, 1),
+        "prevB": (str, ""),
+        "prevJ": (int, 20),
+    }
+
+
+class RaceState(_HashState):
+    """Options of the race in a channel."""
+
+    __slots__ = (
+        "start",
+        "stop",
+        "limit",
+        "state",
+        "filter",
+        "media",
+        "taxon",
+        "strict",
+        "alpha",
+    )
+    FIELDS = {
+        "start": (int, 0),
+        "stop": (int, 0),
+        "limit": (int, 10),
+        "state": (str, ""),
+        "filter": (int, 0),
+        "media": (str, "images"),
+        "taxon": (str, ""),
+        "strict": (str, ""),
+        "alpha": (str, ""),
+    }
+
+
+class SessionState(_HashState):
+    """Options and stats of a user's session."""
+
+    __slots__ = (
+        "start",
+        "stop",
+        "correct",
+        "incorrect",
+        "total",
+        "state",
+        "filter",
+        "taxon",
+        "wiki",
+        "strict",
+    )
+    FIELDS = {
+        "start": (int, 0),
+        "stop": (int, 0),
+        "correct": (int, 0),
+        "incorrect": (int, 0),
+        "total": (int, 0),
+        "state": (str, ""),
+        "filter": (int, 0),
+        "taxon": (str, ""),
+        "wiki": (str, "wiki"),
+        "strict": (str, ""),
+    }
+
+
+class CommandState:
+    """Channel, race, and session data for a command, loaded in one round trip.
+
+    `race` and `session` are None if there isn't a race in the channel
+    or the user doesn't have a session.
+    """
+
+    __slots__ = ("channel", "race", "session")
+
+    def __init__(
+        self,
+        channel: ChannelState,
+        race: Optional[RaceState],
+        session: Optional[SessionState],
+    ):
+        self.channel = channel
+        self.race = race
+        self.session = session
+
+    @classmethod
+    async def load(cls, ctx) -> "CommandState":
+        """Loads the state for a command with one pipelined HGETALL.
+
+        `ctx` - Discord context object
+        """
+        logger.info("loading command state")
+        keys = (
+            f"channel:{ctx.channel.id}",
+            f"race.data:{ctx.channel.id}",
+            f"session.data:{ctx.author.id}",
+        )
+        pipe = async_database.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        channel, race, session = await pipe.execute()
+        return cls(
+            ChannelState(keys[0], channel),
+            RaceState(keys[1], race) if race else None,
+            SessionState(keys[2], session) if session else None,
+        )
+
+    async def save(self):
+        """Writes changed fields of each hash in one round trip."""
+        pipe = async_database.pipeline(transaction=False)
+        for item in (self.channel, self.race, self.session):
+            if item is not None:
+                item.queue(pipe)
+        if len(pipe):
+            await pipe.execute()
@@ -15,14 +15,14 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
-import contextlib
 import difflib
 import functools
-import math
+import json
 import os
 import random
 import shutil
 import string
+import time
 import urllib
 from io import BytesIO
 from typing import Tuple
@@ -34,14 +34,34 @@ from PIL import Image
 from sentry_sdk import capture_exception
 
 import bot.voice as voice_functions
-from bot.data import GenericError, database, logger, screech_owls
+from bot.cache import (KeyLock, cache_directory, cache_key, cache_stats,
+                       evict_cache, media_entry, media_manifest, over_budget,
+                       staging_directory, variant_path)
+from bot.catalog import MAX_PAGES, PAGE_SIZE, catalog_index
+from bot.command_state import CommandState
+from bot.data import (GenericError, async_database, logger, screech_owls,
+                      taxonomy, taxonomy_key)
 from bot.filters import Filter
+from bot.ingest import MAX_FILESIZE, ingest_media
+from bot.network import (RetryBudget, http_client, retry_budget, single_flight,
+                         stream_to_file, upstream_health)
+from bot.scheduler import (INTERACTIVE, PRIORITY_NAMES, download_group,
+                           download_priority, download_scheduler)
 
 # Macaulay URL definitions
 SCINAME_URL = "https://api.ebird.org/v2/ref/taxonomy/ebird?fmt=json&species={}"
 TAXON_CODE_URL = "https://search.macaulaylibrary.org/api/v1/find/taxon?q={}"
 
-MAX_FILESIZE = 6000000  # limit media to 6mb
+# images are optimized after downloading, so larger ones are accepted
+MAX_IMAGE_DOWNLOAD = int(os.getenv("SCIOLY_ID_BOT_MAX_IMAGE_DOWNLOAD", 20000000))
+# how long to wait for another process that is downloading the same media
+POPULATE_TIMEOUT = 120  # seconds
+POPULATE_POLL = 0.25  # seconds
+
+# taxonomy cache settings
+TAXONOMY_TTL = int(os.getenv("SCIOLY_ID_BOT_TAXONOMY_TTL", 30 * 86400))  # 30 days
+NEGATIVE_TTL = int(os.getenv("SCIOLY_ID_BOT_TAXONOMY_NEGATIVE_TTL", 86400))  # 1 day
+TAXONOMY_CACHE_SIZE = int(os.getenv("SCIOLY_ID_BOT_TAXONOMY_CACHE_SIZE", 10000))
 
 # Valid file types
 valid_types = {
@@ -50,51 +70,144 @@ valid_types = {
 }
 
 
-def cache(func=None):
-    """Cache decorator based on functools.lru_cache.
-
-    This does not have a max_size and does not evict items.
-    In addition, results are only cached by the first provided argument.
+def cache(
+    ttl: int = TAXONOMY_TTL,
+    negative_ttl: int = NEGATIVE_TTL,
+    max_size: int = TAXONOMY_CACHE_SIZE,
+):
+    """Cache decorator for taxonomy lookups, backed by redis.
+
+    Results are cached by the first provided argument (case insensitive),
+    so the cache is shared by the bot and web workers and survives restarts.
+    Entries expire after `ttl` seconds. "Not found" errors (code 111) are
+    also cached for `negative_ttl` seconds and raised again on a hit.
+    The oldest entries are removed once there are more than `max_size`.
+
+    Hit and miss counts are stored in redis and reported by `cache_info()`.
+
+    Keys used:
+        taxonomy.{function}:{argument} : json result or error, with expiry
+        taxonomy.index:{function} : [
+            argument, insertion time
+        ]
+        taxonomy.stats:{function} : {
+            hits, misses, negative_hits
+        }
     """
 
     def wrapper(func):
-        sentinel = object()
-
-        cache_ = {}
-        hits = misses = 0
-        cache_get = cache_.get
-        cache_len = cache_.__len__
+        name = func.__name__
+        index_key = f"taxonomy.index:{name}"
+        stats_key = f"taxonomy.stats:{name}"
+
+        async def store(arg: str, value: dict, expiry: int):
+            pipe = async_database.pipeline()
+            pipe.set(f"taxonomy.{name}:{arg}", json.dumps(value), ex=expiry)
+            pipe.zadd(index_key, {arg: time.time()})
+            # expired entries don't need to be in the index
+            pipe.zremrangebyscore(index_key, "-inf", time.time() - ttl)
+            pipe.zcard(index_key)
+            size = (await pipe.execute())[-1]
+            if size > max_size:
+                # remove the oldest entries
+                old = await async_database.zrange(index_key, 0, size - max_size - 1)
+                pipe = async_database.pipeline()
+                pipe.delete(*(f"taxonomy.{name}:{item.decode('utf-8')}" for item in old))
+                pipe.zrem(index_key, *old)
+                await pipe.execute()
 
         async def wrapped(*args, **kwds):
-            # Simple caching without ordering or size limit
             logger.info("checking cache")
-            nonlocal hits, misses
-            key = hash(args[0])
-            result = cache_get(key, sentinel)
-            if result is not sentinel:
+            arg = str(args[0]).strip().lower()
+            cached = await async_database.get(f"taxonomy.{name}:{arg}")
+            if cached is not None:
+                value = json.loads(cached)
+                if "error" in value:
+                    logger.info(f"{args[0]} found in cache as not found!")
+                    await async_database.hincrby(stats_key, "negative_hits", 1)
+                    raise GenericError(value["error"], code=111)
                 logger.info(f"{args[0]} found in cache!")
-                hits += 1
-                return result
+                await async_database.hincrby(stats_key, "hits", 1)
+                result = value["result"]
+                return tuple(result) if isinstance(result, list) else result
+
             logger.info(f"did not find {args[0]} in cache")
-            misses += 1
-            result = await func(*args, **kwds)
-            cache_[key] = result
+            await async_database.hincrby(stats_key, "misses", 1)
+            try:
+                result = await func(*args, **kwds)
+            except GenericError as e:
+                if e.code == 111:
+                    await store(arg, {"error": str(e)}, negative_ttl)
+                raise
+            await store(arg, {"result": result}, ttl)
             return result
 
-        def cache_info():
+        async def cache_info() -> dict:
             """Report cache statistics"""
-            return functools._CacheInfo(hits, misses, None, cache_len())
+            pipe = async_database.pipeline(transaction=False)
+            pipe.hgetall(stats_key)
+            pipe.zcard(index_key)
+            raw_stats, size = await pipe.execute()
+            stats = {
+                key.decode("utf-8"): int(value) for key, value in raw_stats.items()
+            }
+            hits = stats.get("hits", 0) + stats.get("negative_hits", 0)
+            lookups = hits + stats.get("misses", 0)
+            return {
+                "hits": stats.get("hits", 0),
+                "negative_hits": stats.get("negative_hits", 0),
+                "misses": stats.get("misses", 0),
+                "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+                "size": size,
+                "max_size": max_size,
+            }
 
         wrapped.cache_info = cache_info
         return functools.update_wrapper(wrapped, func)
 
-    if func:
-        return wrapper(func)
     return wrapper
 
 
+def offline(lookup):
+    """Decorator that checks the bundled taxonomy table before calling the function.
+
+    `lookup` is called with the first argument and returns
+    the result, or None if the bird isn't in the table.
+    """
+
+    def wrapper(func):
+        async def wrapped(*args, **kwds):
+            result = lookup(args[0])
+            if result is not None:
+                logger.info(f"{args[0]} found in taxonomy table")
+                return result
+            return await func(*args, **kwds)
+
+        return functools.update_wrapper(wrapped, func)
+
+    return wrapper
+
+
+def _lookup_key(bird: str, session=None):
+    return taxonomy_key(bird)
+
+
+def _offline_sciname(bird: str):
+    row = taxonomy.get(taxonomy_key(bird))
+    return row["scientific"] if row else None
+
+
+def _offline_taxon(bird: str):
+    row = taxonomy.get(taxonomy_key(bird))
+    if row is None or not row["taxon_code"]:
+        return None
+    return (row["taxon_code"], f"{row['common']} - {row['scientific']}")
+
+
+@offline(_offline_sciname)
+@single_flight(_lookup_key)
 @cache()
-async def get_sciname(bird: str, session=None, retries=0) -> str:
+async def get_sciname(bird: str, session=None) -> str:
     """Returns the scientific name of a bird.
 
     Scientific names are found using the eBird API from the Cornell Lab of Ornithology,
@@ -105,44 +218,30 @@ async def get_sciname(bird: str, session=None, retries=0) -> str:
     `session` (optional) - an aiohttp client session
     """
     logger.info(f"getting sciname for {bird}")
-    async with contextlib.AsyncExitStack() as stack:
-        if session is None:
-            session = await stack.enter_async_context(aiohttp.ClientSession())
-        try:
-            code = (await get_taxon(bird, session))[0]
-        except GenericError as e:
-            if e.code == 111:
-                code = bird
-            else:
-                raise
-
-        sciname_url = SCINAME_URL.format(urllib.parse.quote(code))
-        async with session.get(sciname_url) as sciname_response:
-            if sciname_response.status != 200:
-                if retries >= 3:
-                    logger.info("Retried more than 3 times. Aborting...")
-                    raise GenericError(
-                        f"An http error code of {sciname_response.status} occurred"
-                        + f" while fetching {sciname_url} for {bird}",
-                        code=201,
-                    )
-                retries += 1
-                logger.info(f"An HTTP error occurred; Retries: {retries}; Sleeping: {1.5**retries}")
-                await asyncio.sleep(1.5**retries)
-                sciname = await get_sciname(bird, session, retries)
-                return sciname
+    if session is None:
+        session = http_client.session()
+    try:
+        code = (await get_taxon(bird, session))[0]
+    except GenericError as e:
+        if e.code == 111:
+            code = bird
+        else:
+            raise
 
-            sciname_data = await sciname_response.json()
-            try:
-                sciname = sciname_data[0]["sciName"]
-            except IndexError:
-                raise GenericError(f"No sciname found for {code}", code=111)
+    sciname_url = SCINAME_URL.format(urllib.parse.quote(code))
+    sciname_data = await http_client.get_json(sciname_url, session)
+    try:
+        sciname = sciname_data[0]["sciName"]
+    except IndexError:
+        raise GenericError(f"No sciname found for {code}", code=111)
     logger.info(f"sciname: {sciname}")
     return sciname
 
 
+@offline(_offline_taxon)
+@single_flight(_lookup_key)
 @cache()
-async def get_taxon(bird: str, session=None, retries=0) -> Tuple[str, str]:
+async def get_taxon(bird: str, session=None) -> Tuple[str, str]:
     """Returns the taxonomic code of a bird.
 
     Taxonomic codes are used by the Cornell Lab of Ornithology to identify species of birds.
@@ -154,47 +253,31 @@ async def get_taxon(bird: str, session=None, retries=0) -> Tuple[str, str]:
     `session` (optional) - an aiohttp client session
     """
     logger.info(f"getting taxon code for {bird}")
-    async with contextlib.AsyncExitStack() as stack:
-        if session is None:
-            session = await stack.enter_async_context(aiohttp.ClientSession())
-        taxon_code_url = TAXON_CODE_URL.format(
-            urllib.parse.quote(bird.replace("-", " ").replace("'s", ""))
-        )
-        async with session.get(taxon_code_url) as taxon_code_response:
-            if taxon_code_response.status != 200:
-                if retries >= 3:
-                    logger.info("Retried more than 3 times. Aborting...")
-                    raise GenericError(
-                        f"An http error code of {taxon_code_response.status} occurred"
-                        + f" while fetching {taxon_code_url} for {bird}",
-                        code=201,
-                    )
-                retries += 1
-                logger.info(f"An HTTP error occurred; Retries: {retries}; Sleeping: {1.5**retries}")
-                await asyncio.sleep(1.5**retries)
-                taxon_code = (await get_taxon(bird, session, retries))[0]
-                return taxon_code
-
-            taxon_code_data = await taxon_code_response.json()
-            try:
-                logger.info(f"raw data: {taxon_code_data}")
-                taxon_code = taxon_code_data[0]["code"]
-                item_name = taxon_code_data[0]["name"]
-                logger.info(f"first item: {taxon_code_data[0]}")
-                if len(taxon_code_data) > 1:
-                    logger.info("entering check")
-                    for item in taxon_code_data:
-                        logger.info(f"checking: {item}")
-                        if spellcheck(
-                            item["name"].split(" - ")[0], bird, 4
-                        ) or spellcheck(item["name"].split(" - ")[1], bird, 4):
-                            logger.info("ok")
-                            taxon_code = item["code"]
-                            item_name = item["name"]
-                            break
-                        logger.info("fail")
-            except IndexError:
-                raise GenericError(f"No taxon code found for {bird}", code=111)
+    if session is None:
+        session = http_client.session()
+    taxon_code_url = TAXON_CODE_URL.format(
+        urllib.parse.quote(bird.replace("-", " ").replace("'s", ""))
+    )
+    taxon_code_data = await http_client.get_json(taxon_code_url, session)
+    try:
+        logger.info(f"raw data: {taxon_code_data}")
+        taxon_code = taxon_code_data[0]["code"]
+        item_name = taxon_code_data[0]["name"]
+        logger.info(f"first item: {taxon_code_data[0]}")
+        if len(taxon_code_data) > 1:
+            logger.info("entering check")
+            for item in taxon_code_data:
+                logger.info(f"checking: {item}")
+                if spellcheck(
+                    item["name"].split(" - ")[0], bird, 4
+                ) or spellcheck(item["name"].split(" - ")[1], bird, 4):
+                    logger.info("ok")
+                    taxon_code = item["code"]
+                    item_name = item["name"]
+                    break
+                logger.info("fail")
+    except IndexError:
+        raise GenericError(f"No taxon code found for {bird}", code=111)
     logger.info(f"taxon code: {taxon_code}")
     logger.info(f"name: {item_name}")
     return (taxon_code, item_name)
@@ -211,16 +294,15 @@ async def valid_bird(bird: str, session=None) -> Tuple[str, bool, str, str]:
     """
     bird = string.capwords(bird)
     logger.info(f"checking if {bird} is valid")
-    async with contextlib.AsyncExitStack() as stack:
-        if session is None:
-            session = await stack.enter_async_context(aiohttp.ClientSession())
-        try:
-            name = (await get_taxon(bird, session))[1]
-        except GenericError as e:
-            if e.code in (111, 201):
-                return (bird, False, "No taxon code found", "")
-            raise e
-        urls = await _get_urls(session, bird, "p", Filter())
+    if session is None:
+        session = http_client.session()
+    try:
+        name = (await get_taxon(bird, session))[1]
+    except GenericError as e:
+        if e.code in (111, 201):
+            return (bird, False, "No taxon code found", "")
+        raise e
+    urls = await _get_urls(session, bird, "p", Filter())
     if len(urls) < 2:
         return (bird, False, "One or less images found", name)
     return (bird, True, "All checks passed", name)
@@ -242,8 +324,44 @@ def _black_and_white(input_image_path) -> BytesIO:
     return final_buffer
 
 
+def _save_black_and_white(input_image_path: str, output_path: str) -> int:
+    """Saves a black and white version of an image and returns its size."""
+    logger.info("black and white")
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    with Image.open(input_image_path) as color_image:
+        color_image.convert("L").save(temp_path, "png")
+    os.replace(temp_path, output_path)
+    return os.stat(output_path).st_size
+
+
+@single_flight(lambda filename: filename)
+async def black_and_white(filename: str) -> str:
+    """Returns the path to a black and white version of a cached image.
+
+    The image is converted once and stored in the variant store,
+    and later calls return the stored version.
+
+    `filename` (str) - path to the cached image
+    """
+    path = variant_path(filename, "bw")
+    if media_manifest.has_variant(filename, "bw") and os.path.exists(path):
+        return path
+    # prevent the black and white conversion from blocking
+    loop = asyncio.get_running_loop()
+    size = await loop.run_in_executor(None, _save_black_and_white, filename, path)
+    media_manifest.add_variant(filename, "bw", size)
+    return path
+
+
 async def send_bird(
-    ctx, bird: str, media_type: str, filters: Filter, on_error=None, message=None
+    ctx,
+    bird: str,
+    media_type: str,
+    filters: Filter,
+    on_error=None,
+    message=None,
+    command_state: CommandState = None,
 ):
     """Gets bird media and sends it to the user.
 
@@ -253,6 +371,7 @@ async def send_bird(
     `filters` (bot.filters Filter)\n
     `on_error` (function) - async function to run when an error occurs, passes error as argument\n
     `message` (str) - text message to send before bird\n
+    `command_state` (bot.command_state CommandState) - state of the command, loaded if not given\n
     """
     if bird == "":
         logger.error("error - bird is blank")
@@ -275,7 +394,7 @@ async def send_bird(
     await ctx.trigger_typing()
 
     try:
-        filename, extension = await get_media(ctx, bird, media_type, filters)
+        filename, extension = await get_media(ctx, bird, media_type, filters, command_state)
     except GenericError as e:
         await delete.delete()
         if e.code == 100:
@@ -286,8 +405,6 @@ async def send_bird(
             capture_exception(e)
             logger.exception(e)
             await ctx.send("**A network error has occurred.**\n*Please try again later.*")
-            database.incrby("cooldown:global", amount=1)
-            database.expire("cooldown:global", 300)
         else:
             capture_exception(e)
             logger.exception(e)
@@ -300,23 +417,23 @@ async def send_bird(
             await ctx.send("*Please try again.*")
         return
 
-    if os.stat(filename).st_size > MAX_FILESIZE:  # another filesize check (4mb)
+    entry = media_manifest.entry(filename)
+    if entry is not None and entry["size"] > MAX_FILESIZE:  # another filesize check
         await delete.delete()
         await ctx.send("**Oops! File too large :(**\n*Please try again.*")
         return
 
     if media_type == "images":
         if filters.bw:
-            # prevent the black and white conversion from blocking
-            loop = asyncio.get_running_loop()
-            fn = functools.partial(_black_and_white, filename)
-            filename = await loop.run_in_executor(None, fn)
+            filename = await black_and_white(filename)
+            extension = "png"
 
     elif media_type == "songs" and not filters.vc:
-        # remove spoilers in tag metadata
-        audioFile = eyed3.load(filename)
-        if audioFile is not None and audioFile.tag is not None:
-            audioFile.tag.remove(filename)
+        if entry is None or not entry.get("tags_removed"):
+            # remove spoilers in tag metadata, if not done when downloading
+            audioFile = eyed3.load(filename)
+            if audioFile is not None and audioFile.tag is not None:
+                audioFile.tag.remove(filename)
 
     if message is not None:
         await ctx.send(message)
@@ -330,7 +447,9 @@ async def send_bird(
     await delete.delete()
 
 
-async def get_media(ctx, bird: str, media_type: str, filters: Filter):
+async def get_media(
+    ctx, bird: str, media_type: str, filters: Filter, command_state: CommandState = None
+):
     """Chooses media from a list of filenames.
 
     This function chooses a valid image to pass to send_bird().
@@ -342,6 +461,7 @@ async def get_media(ctx, bird: str, media_type: str, filters: Filter):
     `bird` (str) - bird to get media of\n
     `media_type` (str) - type of media (images/songs)\n
     `filters` (bot.filters Filter)\n
+    `command_state` (bot.command_state CommandState) - state of the command, loaded if not given\n
     """
 
     # fetch scientific names of birds
@@ -351,7 +471,9 @@ async def get_media(ctx, bird: str, media_type: str, filters: Filter):
         sciBird = bird
     media = await get_files(sciBird, media_type, filters)
     logger.info("media: " + str(media))
-    prevJ = int(database.hget(f"channel:{ctx.channel.id}", "prevJ"))
+    if command_state is None:
+        command_state = await CommandState.load(ctx)
+    prevJ = command_state.channel.prevJ
     # Randomize start (choose beginning 4/5ths in case it fails checks)
     if media:
         j = (prevJ + 1) % len(media)
@@ -361,26 +483,29 @@ async def get_media(ctx, bird: str, media_type: str, filters: Filter):
         for x in range(0, len(media)):  # check file type and size
             y = (x + j) % len(media)
             path = media[y]
+            entry = media_manifest.entry(path)
             extension = path.split(".")[-1]
+            size = entry["size"] if entry is not None else 0
             logger.info("extension: " + str(extension))
-            statInfo = os.stat(path)
-            logger.info("size: " + str(statInfo.st_size))
+            logger.info("size: " + str(size))
             if (
                 extension.lower() in valid_types[media_type].values()
-                and statInfo.st_size < MAX_FILESIZE
+                and size < MAX_FILESIZE
             ):  # keep files less than 4mb
                 logger.info("found one!")
                 break
             raise GenericError(f"No Valid {media_type.title()} Found", code=999)
 
-        database.hset(f"channel:{ctx.channel.id}", "prevJ", str(j))
+        media_manifest.touch(path)
+        command_state.channel.update(prevJ=j)
+        await command_state.channel.save()
     else:
         raise GenericError(f"No {media_type.title()} Found", code=100)
 
     return [path, extension]
 
 
-async def get_files(sciBird: str, media_type: str, filters: Filter, retries: int = 0):
+async def get_files(sciBird: str, media_type: str, filters: Filter):
     """Returns a list of image/song filenames.
 
     This function also does cache management,
@@ -391,86 +516,248 @@ async def get_files(sciBird: str, media_type: str, filters: Filter, retries: int
     `media_type` (str) - type of media (images/songs)\n
     `filters` (bot.filters Filter)\n
     """
-    logger.info(f"get_files retries: {retries}")
-    directory = f"bot_files/cache/{media_type}/{sciBird}{filters.to_int()}/"
-    try:
-        logger.info("trying")
-        files_dir = os.listdir(directory)
+    key = cache_key(media_type, sciBird, filters.fetch_key(media_type))
+    directory = cache_directory(key)
+    cache_stats.filters[(media_type, filters.fetch_key(media_type))] += 1
+    # the files may have been downloaded or evicted by another process
+    loop = asyncio.get_running_loop()
+    entries = await loop.run_in_executor(None, media_manifest.find, key)
+    if entries:
         logger.info(directory)
-        if not files_dir:
-            raise GenericError("No Files", code=100)
-        return [f"{directory}{path}" for path in files_dir]
-    except (FileNotFoundError, GenericError):
-        logger.info("fetching files")
-        # if not found, fetch images
-        logger.info("scibird: " + str(sciBird))
-        filenames = await download_media(sciBird, media_type, filters, directory)
-        if not filenames:
-            if retries < 3:
-                retries += 1
-                return await get_files(sciBird, media_type, filters, retries)
-            logger.info("More than 3 retries")
+        cache_stats.hits += 1
+        return [entry["path"] for entry in entries]
+
+    cache_stats.misses += 1
+    logger.info("fetching files")
+    # if not found, fetch images
+    logger.info("scibird: " + str(sciBird))
+    budget = retry_budget.get(None) or RetryBudget()
+    cache_stats.downloading += 1
+    try:
+        # return the first file, the rest are downloaded in the background
+        filenames = await download_media(
+            sciBird, media_type, filters, directory, progressive=True
+        )
+        # the catalog index gives different media when downloading again
+        while not filenames and budget.spend():
+            logger.info("no files downloaded, retrying")
+            filenames = await download_media(
+                sciBird, media_type, filters, directory, progressive=True
+            )
+    finally:
+        cache_stats.downloading -= 1
+    return filenames
+
+
+class MediaDownload:
+    """Downloads a batch of media for one cache key in the background.
+
+    Each file is added to the manifest as soon as it is downloaded and
+    ingested, so callers can wait for just the first file with `first()`
+    or for the whole batch with `all()`. Concurrent downloads of the same
+    key share one batch, and cancelling a caller doesn't cancel the batch.
+    The batch downloads at the highest priority of its callers.
+    """
+
+    def __init__(self, key: str, priority: int = INTERACTIVE):
+        self.key = key
+        self.priority = priority
+        self.entries = []
+        self._ready = asyncio.Event()
+        self.task = None
+
+    def start(self, *args):
+        self.task = asyncio.ensure_future(self._run(*args))
+        self.task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Future):
+        if _downloads.get(self.key) is self:
+            del _downloads[self.key]
+        self._ready.set()
+        if not task.cancelled():
+            task.exception()  # mark the exception as retrieved
+
+    async def first(self):
+        """Returns the filenames downloaded so far, once there is at least one."""
+        await asyncio.wait(
+            [asyncio.ensure_future(self._ready.wait()), self.task],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if self.entries:
+            return [entry["path"] for entry in self.entries]
+        return await asyncio.shield(self.task)
+
+    async def all(self):
+        """Returns the filenames once the whole batch has downloaded."""
+        return await asyncio.shield(self.task)
+
+    def raise_priority(self, priority: int):
+        """Downloads the rest of the batch at `priority` if it is higher."""
+        if priority >= self.priority:
+            return
+        logger.info(f"raising {self.key} to {PRIORITY_NAMES[priority]} priority")
+        self.priority = priority
+        download_scheduler.promote(self, priority)
+
+    async def _fetch(self, path, url, session, max_size, directory):
+        # downloads that haven't started yet use the current batch priority
+        download_priority.set(self.priority)
+        result = await _download_helper(path, url, session, max_size)
+        if result is None:
+            return None
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, ingest_media, *result)
+        if result is None:
+            return None
+        staged, content_type, size, metadata = result
+        # the file is complete and processed, so move it into the cache
+        filename = f"{directory}{os.path.basename(staged)}"
+        await loop.run_in_executor(None, os.replace, staged, filename)
+        entry = dict(media_entry(filename, content_type, size), **metadata)
+        self.entries.append(entry)
+        media_manifest.set(self.key, self.entries)
+        self._ready.set()
+        return entry
+
+    async def _wait_for_lock(self, lock: KeyLock) -> bool:
+        """Waits while another process populates the cache key.
+
+        Files the other process has finished are made available to callers,
+        but aren't added to the manifest until the directory is complete.
+        Returns True if the lock was taken.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + POPULATE_TIMEOUT
+        while not lock.acquire():
+            if time.monotonic() > deadline:
+                logger.info(f"timed out waiting for {self.key}, downloading anyway")
+                return False
+            entries = await loop.run_in_executor(
+                None, media_manifest.scan, self.key, False
+            )
+            if entries:
+                self.entries = entries
+                self._ready.set()
+            await asyncio.sleep(POPULATE_POLL)
+        return True
+
+    async def _run(self, bird, media_type, filters, directory, session):
+        download_group.set(self)
+        loop = asyncio.get_running_loop()
+        lock = KeyLock(self.key)
+        locked = lock.acquire()
+        try:
+            if not locked:
+                logger.info(f"{self.key} is being populated by another process")
+                locked = await self._wait_for_lock(lock)
+                # only index the directory once the other process is done with it
+                entries = await loop.run_in_executor(
+                    None, media_manifest.scan, self.key, locked
+                )
+                if entries:
+                    return [entry["path"] for entry in entries]
+            return await self._download(bird, media_type, filters, directory, session)
+        finally:
+            if locked:
+                lock.release()
+
+    async def _download(self, bird, media_type, filters, directory, session):
+        if media_type == "images":
+            media = "p"
+            max_size = MAX_IMAGE_DOWNLOAD
+        elif media_type == "songs":
+            media = "a"
+            max_size = MAX_FILESIZE
 
+        if session is None:
+            session = http_client.session()
+        urls = await _get_urls(session, bird, media, filters)
+        staging = staging_directory(self.key)
+        os.makedirs(staging, exist_ok=True)
+        os.makedirs(directory, exist_ok=True)
+        paths = [f"{staging}{i}" for i in range(len(urls))]
+        try:
+            results = await asyncio.gather(
+                *(
+                    self._fetch(path, url, session, max_size, directory)
+                    for path, url in zip(paths, urls)
+                )
+            )
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        # keep the catalog order instead of the order downloads finished
+        entries = list(filter(None, results))
+        filenames = [entry["path"] for entry in entries]
+        logger.info(f"downloaded {media_type} for {bird}")
+        logger.info(f"download check fails: {len(urls) - len(entries)}")
+        logger.info(f"returned filename count: {len(filenames)}")
+
+        if entries:
+            media_manifest.set(self.key, entries)
+            loop = asyncio.get_running_loop()
+            if over_budget():
+                await loop.run_in_executor(None, evict_cache)
+            else:
+                await loop.run_in_executor(None, media_manifest.save)
         return filenames
 
 
-async def download_media(bird, media_type, filters, directory=None, session=None):
+_downloads = {}
+
+
+async def download_media(
+    bird, media_type, filters, directory=None, session=None, progressive=False
+):
     """Returns a list of filenames downloaded from Macaulay Library.
 
     This function manages the download helpers to fetch images from Macaulay.
+    If `progressive` is True, this returns as soon as one file is ready,
+    and the rest of the files are downloaded in the background.
 
     `bird` (str) - scientific name of bird\n
     `media_type` (str) - type of media (images/songs)\n
     `filters` (bot.filters Filter)\n
     `directory` (str) - relative path to bird directory\n
-    `session` (aiohttp ClientSession)
+    `session` (aiohttp ClientSession)\n
+    `progressive` (bool) - whether to return after the first file
     """
+    key = cache_key(media_type, bird, filters.fetch_key(media_type))
     if directory is None:
-        directory = f"bot_files/cache/{media_type}/{bird}{filters.to_int()}/"
-
-    if media_type == "images":
-        media = "p"
-    elif media_type == "songs":
-        media = "a"
-
-    async with contextlib.AsyncExitStack() as stack:
-        if session is None:
-            session = await stack.enter_async_context(aiohttp.ClientSession())
-        urls = await _get_urls(session, bird, media, filters)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        paths = [f"{directory}{i}" for i in range(len(urls))]
-        sem = asyncio.Semaphore(5)
-        filenames = await asyncio.gather(
-            *(
-                _download_helper(path, url, session, sem)
-                for path, url in zip(paths, urls)
-            )
-        )
-        fails = filenames.count(None)
-        if None in filenames:
-            filenames = set(filenames)
-            filenames.discard(None)
-            filenames = list(filenames)
-        logger.info(f"downloaded {media_type} for {bird}")
-        logger.info(f"download check fails: {fails}")
-        logger.info(f"returned filename count: {len(filenames)}")
-        logger.info(f"actual filenames count: {len(os.listdir(directory))}")
-        return filenames
-
+        directory = cache_directory(key)
 
+    download = _downloads.get(key)
+    if download is None:
+        download = MediaDownload(key, download_priority.get())
+        _downloads[key] = download
+        download.start(bird, media_type, filters, directory, session)
+    else:
+        logger.info(f"waiting for in progress download: {key}")
+        download.raise_priority(download_priority.get())
+    if progressive:
+        return await download.first()
+    return await download.all()
+
+
+@single_flight(
+    lambda session, bird, media_type, filters: (
+        bird,
+        media_type,
+        filters.fetch_key(media_type),
+    )
+)
 async def _get_urls(
     session: aiohttp.ClientSession,
     bird: str,
     media_type: str,
     filters: Filter,
-    retries: int = 0,
 ):
     """Returns a list of urls to Macaulay Library media.
 
     The amount of urls returned is specified in `COUNT`.
     Media URLs are fetched using Macaulay Library's internal JSON API,
-    with `CATALOG_URL`. Raises a `GenericError` if fails.\n
+    with `CATALOG_URL`, in pages of `PAGE_SIZE` and stored in the catalog index.
+    Urls are returned after the first page, and the rest are indexed in the background.
+    Later calls choose different media from the index. Raises a `GenericError` if fails.\n
     Some urls may return an error code of 476 (because it is still being processed),
     if so, ignore that url.
 
@@ -481,118 +768,139 @@ async def _get_urls(
     """
     logger.info(f"getting file urls for {bird}")
     taxon_code = (await get_taxon(bird, session))[0]
-    catalog_url = filters.url(taxon_code, media_type)
-    async with session.get(catalog_url) as catalog_response:
-        if catalog_response.status != 200:
-            if retries >= 3:
-                logger.info("Retried more than 3 times. Aborting...")
-                raise GenericError(
-                    f"An http error code of {catalog_response.status} occurred "
-                    + f"while fetching {catalog_url} for a {'image'if media_type=='p' else 'song'} for {bird}",
-                    code=201,
-                )
-            retries += 1
-            logger.info(f"An HTTP error occurred; Retries: {retries}; Sleeping: {1.5**retries}")
-            await asyncio.sleep(1.5**retries)
-            urls = await _get_urls(session, bird, media_type, filters, retries)
-            return urls
+    loop = asyncio.get_running_loop()
+    urls = await loop.run_in_executor(
+        None, catalog_index.urls, taxon_code, media_type, filters
+    )
+    if urls is None:
+        logger.info("catalog query not indexed")
+        catalog_url = filters.url(taxon_code, media_type, PAGE_SIZE)
+        catalog_data = await http_client.get_json(catalog_url, session)
+        items = catalog_data["results"]["content"]
+        cursor = catalog_data["results"].get("nextCursorMark")
+        complete = len(items) < PAGE_SIZE or not cursor
+        await loop.run_in_executor(
+            None, catalog_index.add, taxon_code, media_type, filters, items, complete
+        )
+        urls = await loop.run_in_executor(
+            None, catalog_index.urls, taxon_code, media_type, filters
+        )
+        if not complete and MAX_PAGES > 1:
+            # later calls use the rest of the pages, so don't wait for them
+            asyncio.ensure_future(
+                _index_pages(session, taxon_code, media_type, filters, items, cursor)
+            )
+    if not urls:
+        raise GenericError("No urls found.", code=100)
+    return urls
+
 
-        catalog_data = await catalog_response.json()
+async def _index_pages(session, taxon_code, media_type, filters, items, cursor):
+    """Fetches the rest of the pages of a catalog query and indexes them.
+
+    The query is only marked complete once every result is indexed.
+    """
+    items = list(items)
+    complete = False
+    for _ in range(1, MAX_PAGES):
+        catalog_url = filters.url(taxon_code, media_type, PAGE_SIZE, cursor)
+        try:
+            catalog_data = await http_client.get_json(catalog_url, session)
+        except GenericError as e:
+            # keep the pages we already have
+            logger.info(f"stopped indexing {taxon_code}: {e}")
+            break
         content = catalog_data["results"]["content"]
-        urls = (
-            [data["mediaUrl"] for data in content]
-            if filters.large or media_type == "a"
-            else [data["previewUrl"] for data in content]
-        )
-        if not urls:
-            raise GenericError("No urls found.", code=100)
-        return urls
+        items += content
+        cursor = catalog_data["results"].get("nextCursorMark")
+        if len(content) < PAGE_SIZE or not cursor:
+            complete = True
+            break
+    await asyncio.get_running_loop().run_in_executor(
+        None, catalog_index.add, taxon_code, media_type, filters, items, complete
+    )
 
 
-async def _download_helper(path, url, session, sem):
+async def _download_helper(path, url, session, max_size=MAX_FILESIZE):
     """Downloads media from the given URL.
 
-    Returns the file path to the downloaded item.
+    Returns a tuple of the file path, content type, and size
+    of the downloaded item, or None if the download failed.
+    Downloads wait for a slot from the shared download scheduler.
 
     `path` (str) - path with filename of location to download, no extension\n
     `url` (str) - url to the item to be downloaded\n
-    `session` (aiohttp ClientSession)
+    `session` (aiohttp ClientSession)\n
+    `max_size` (int) - largest file size to download, in bytes
     """
-    async with sem:
-        try:
-            async with session.get(url) as response:
-                media_size = response.headers.get("content-length")
-                if (
-                    response.status != 200
-                    or media_size is None
-                    or int(media_size) > MAX_FILESIZE
-                ):
-                    logger.info(f"FAIL: status: {response.status}; size: {media_size}")
-                    logger.info(url)
-                    return None
-
-                # from https://stackoverflow.com/questions/29674905/convert-content-type-header-into-file-extension
-                content_type = (
-                    response.headers["content-type"].partition(";")[0].strip()
-                )
-                if content_type.partition("/")[0] == "image":
-                    try:
-                        ext = valid_types["images"][content_type]
-                    except KeyError:
-                        raise GenericError(
-                            f"No valid extensions found. Content-Type: {content_type}"
-                        )
-
-                elif content_type.partition("/")[0] == "audio":
-                    try:
-                        ext = valid_types["songs"][content_type]
-                    except KeyError:
-                        raise GenericError(
-                            f"No valid extensions found. Content-Type: {content_type}"
+    breaker = upstream_health.breaker(urllib.parse.urlsplit(url).hostname)
+    async with download_scheduler.slot():
+        if not breaker.allow():
+            logger.info(f"skipping {url}, host is unavailable")
+            return None
+        with breaker.request():
+            try:
+                start = time.perf_counter()
+                async with session.get(url) as response:
+                    if response.status >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    # the content length is optional,
+                    # the size is checked while downloading
+                    media_size = response.headers.get("content-length")
+                    if response.status != 200 or (
+                        media_size is not None and int(media_size) > max_size
+                    ):
+                        logger.info(
+                            f"FAIL: status: {response.status}; size: {media_size}"
                         )
-                else:
-                    raise GenericError("Invalid content-type.")
-
-                filename = f"{path}.{ext}"
-                # from https://stackoverflow.com/questions/38358521/alternative-of-urllib-urlretrieve-in-python-3-5
-                with open(filename, "wb") as out_file:
-                    block_size = 1024 * 8
-                    while True:
-                        block = await response.content.read(
-                            block_size
-                        )  # pylint: disable=no-member
-                        if not block:
-                            break
-                        out_file.write(block)
-                return filename
-
-        except aiohttp.ClientError as e:
-            logger.info(f"Client Error with url {url} and path {path}")
-            capture_exception(e)
-            raise
-
+                        logger.info(url)
+                        return None
 
-def rotate_cache():
-    """Deletes a random selection of cached birds."""
-    logger.info("Rotating cache items")
-    items = []
-    with contextlib.suppress(FileNotFoundError):
-        items += map(
-            lambda x: f"bot_files/cache/images/{x}/",
-            os.listdir("bot_files/cache/images/"),
-        )
-    with contextlib.suppress(FileNotFoundError):
-        items += map(
-            lambda x: f"bot_files/cache/songs/{x}/",
-            os.listdir("bot_files/cache/songs/"),
-        )
-    logger.info(f"num birds: {len(items)}")
-    delete = random.choices(
-        items, k=math.ceil(len(items) * 0.05)
-    )  # choose 5% of the items to delete
-    for directory in delete:
-        shutil.rmtree(directory)
-        logger.info(f"{directory} removed")
+                    # from https://stackoverflow.com/questions/29674905/convert-content-type-header-into-file-extension
+                    content_type = (
+                        response.headers["content-type"].partition(";")[0].strip()
+                    )
+                    if content_type.partition("/")[0] == "image":
+                        try:
+                            ext = valid_types["images"][content_type]
+                        except KeyError:
+                            raise GenericError(
+                                "No valid extensions found. "
+                                + f"Content-Type: {content_type}"
+                            )
+
+                    elif content_type.partition("/")[0] == "audio":
+                        try:
+                            ext = valid_types["songs"][content_type]
+                        except KeyError:
+                            raise GenericError(
+                                "No valid extensions found. "
+                                + f"Content-Type: {content_type}"
+                            )
+                    else:
+                        raise GenericError("Invalid content-type.")
+
+                    filename = f"{path}.{ext}"
+                    size = await stream_to_file(response, filename, max_size)
+                    if size is None:
+                        logger.info(url)
+                        return None
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.info(f"Client Error with url {url} and path {path}: {e!r}")
+                breaker.record_failure()
+                capture_exception(e)
+                return None
+
+    elapsed = time.perf_counter() - start
+    cache_stats.record_download(size, elapsed)
+    logger.info(
+        f"downloaded {size} bytes in {elapsed:.2f}s "
+        + f"({size / 1024 / max(elapsed, 0.001):.0f} KiB/s): {filename}"
+    )
+    return (filename, content_type, size)
 
 
 def spellcheck(worda, wordb, cutoff=3):
@@ -29,6 +29,8 @@ from dotenv import find_dotenv, load_dotenv
 from sentry_sdk.integrations.aiohttp import AioHttpIntegration
 from sentry_sdk.integrations.redis import RedisIntegration
 
+from bot.async_redis import AsyncRedis
+
 load_dotenv(find_dotenv(), verbose=True)
 
 # define database for one connection
@@ -40,6 +42,10 @@ if os.getenv("SCIOLY_ID_BOT_LOCAL_REDIS") == "true":
 else:
     database = redis.from_url(os.environ["REDIS_URL"])
 
+# the bot uses async_database so commands don't block the event loop,
+# the web app uses database
+async_database = AsyncRedis(database)
+
 
 def before_sentry_send(event, hint):
     """Fingerprint certain events before sending to Sentry."""
@@ -157,9 +163,6 @@ if os.getenv("SCIOLY_ID_BOT_USE_SENTRY") != "false":
 # custom list format (set):
 #   custom.list:user_id : [validated birds, ...]
 
-# cooldown rate limit format:
-#   cooldown:global : 0
-
 
 #  states = {
 #          state name:
@@ -264,22 +267,23 @@ def _wiki_urls():
     return urls
 
 
-def get_wiki_url(ctx, bird=None):
+async def get_wiki_url(ctx, bird=None):
     logger.info("fetching wiki url")
     if bird is None:
         bird = ctx
-        user_id = 0
-        channel_id = 0
+        # not in a channel, so previews are always enabled
+        preview = True
     else:
-        user_id = ctx.author.id
-        channel_id = ctx.channel.id
+        pipe = async_database.pipeline(transaction=False)
+        pipe.hget(f"session.data:{ctx.author.id}", "wiki")
+        pipe.exists(f"race.data:{ctx.channel.id}")
+        wiki, race = await pipe.execute()
+        preview = not (wiki == b"" or race)
 
     try:
         bird = string.capwords(bird.replace("-", " "))
         url = wikipedia_urls[bird]
-        if database.hget(f"session.data:{user_id}", "wiki") == b"" or database.exists(
-            f"race.data:{channel_id}"
-        ):
+        if not preview:
             logger.info("found in cache, disabling preview")
             return f"<{url}>"
         logger.info("found in cache")
@@ -287,9 +291,7 @@ def get_wiki_url(ctx, bird=None):
     except KeyError:
         logger.info(f"{bird} not found in wikipedia url cache, falling back")
         page = wikipedia.page(bird)
-        if database.hget(f"session.data:{user_id}", "wiki") == b"" or database.exists(
-            f"race.data:{channel_id}"
-        ):
+        if not preview:
             logger.info("disabling preview")
             return f"<{page.url}>"
         return page.url
@@ -309,6 +311,61 @@ def _alpha_codes():
     return lookup
 
 
+def _common_names():
+    """Maps lowercase scientific names to common names.
+
+    `alpha.txt` and `sciListMaster.txt` list the same birds in the same order.
+    Hyphens are kept, like the names `bird_setup` counts frequencies for.
+    """
+    logger.info("Working on common names")
+    with open("bot/data/alpha.txt", "r") as f:
+        birds = [string.capwords(bird.strip()) for bird, _ in csv.reader(f)]
+    lookup = {sci.lower(): bird for bird, sci in zip(birds, sciListMaster)}
+    logger.info("Done with common names")
+    return lookup
+
+
+def taxonomy_key(bird: str) -> str:
+    """Normalizes a common name, scientific name, or alpha code for lookups."""
+    return " ".join(bird.replace("-", " ").lower().split())
+
+
+def _taxonomy():
+    """Loads the bundled taxonomy table.
+
+    The table is generated by `python -m bot.taxonomy` and maps
+    common names, scientific names, and alpha codes to a row of
+    (common name, scientific name, taxon code, alpha code).
+    Taxon codes may be blank if they haven't been fetched from eBird.
+    """
+    logger.info("Working on taxonomy table")
+    lookup = {}
+    version = None
+    try:
+        with open("bot/data/taxonomy.csv", "r") as f:
+            lines = []
+            for line in f:
+                if line.startswith("# version:"):
+                    version = line.split(":", 1)[1].strip()
+                elif not line.startswith("#"):
+                    lines.append(line)
+            for row in csv.DictReader(lines):
+                for name in (row["common"], row["scientific"], row["alpha"]):
+                    if name:
+                        lookup.setdefault(taxonomy_key(name), row)
+    except FileNotFoundError:
+        logger.info("taxonomy table not found")
+    missing = {row["common"] for row in lookup.values() if not row["taxon_code"]}
+    if missing:
+        # these birds are looked up from eBird when they are used
+        logger.info(
+            f"{len(missing)} birds without taxon codes, "
+            + "run python -m bot.taxonomy to fetch them"
+        )
+    logger.info(f"Done with taxonomy table, version {version}")
+    return lookup, version
+
+
 def _nats_lists():
     """Converts txt files of national bird data into lists."""
     filenames = ("birdList", "songBirds", "sciListMaster", "memeList")
@@ -397,6 +454,8 @@ birdListMaster = _all_birds()
 taxons = _taxons()
 wikipedia_urls = _wiki_urls()
 alpha_codes = _alpha_codes()
+common_names = _common_names()
+taxonomy, taxonomy_version = _taxonomy()
 logger.info(f"National Lengths: {len(birdList)}, {len(songBirds)}")
 logger.info(f"Master Lengths: {len(birdListMaster)}, {len(sciListMaster)}")
 logger.info("Done importing data!")
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import urllib.parse
 from typing import Union, Dict, Tuple
 from collections.abc import Iterable
 
@@ -143,10 +144,14 @@ class Filter:
                 raise ValueError(f"{item[1]} contains invalid {item[0]} values.")
         return True
 
-    def url(self, taxon_code: str, media_type: str) -> str:
+    def url(
+        self, taxon_code: str, media_type: str, count: int = COUNT, cursor: str = None
+    ) -> str:
         """Generate the search url based on the filters.
 
-        `media_type` is all, p (pictures), a (audio), v (video)
+        `media_type` is all, p (pictures), a (audio), v (video)\n
+        `count` is the number of results per page\n
+        `cursor` is the cursor mark of the page to fetch, from a previous page
         """
         self._validate()
         url_parameter_names = {
@@ -160,7 +165,9 @@ class Filter:
             "quality": "&qua={}",
         }
         url = CATALOG_URL
-        url += f"&taxonCode={taxon_code}&mediaType={media_type}&count={COUNT}"
+        url += f"&taxonCode={taxon_code}&mediaType={media_type}&count={count}"
+        if cursor:
+            url += f"&initialCursorMark={urllib.parse.quote(cursor)}"
 
         for item in self.__dict__.items():
             if (
@@ -170,7 +177,7 @@ class Filter:
             ):
                 # disable invalid filters on certain media types
                 continue
-            for value in item[1]:
+            for value in sorted(item[1]):
                 if value in ("env", "peo") and item[0] == "sounds":
                     # two sound filters have 'tag' as the url parameter
                     url += url_parameter_names["tags"].format(value)
@@ -194,6 +201,31 @@ class Filter:
                 out[indexes[title][name] - 1] = "1"
         return int("".join(reversed(out)), 2)
 
+    def fetch_key(self, media_type: str) -> int:
+        """Convert filters into an integer representation for caching media.
+
+        Only filters that change the catalog query for the media type are kept,
+        so filter combinations that fetch the same media share a cache entry.
+        Presentation options (bw, vc) are always removed, as well as
+        sounds for images, and tags and large for songs.
+
+        `media_type` is images/songs, or p (pictures)/a (audio) like in `url`
+        """
+        ignored = {"bw", "vc"}
+        if media_type in ("images", "p"):
+            ignored.add("sounds")
+        elif media_type in ("songs", "a"):
+            ignored.update(("tags", "large"))
+        else:
+            raise ValueError(f"{media_type} is not a valid media type.")
+
+        canonical = self.from_int(self.to_int())
+        for option in ignored:
+            canonical.__dict__[option] = (
+                False if option in self._boolean_options else set()
+            )
+        return canonical.to_int()
+
     @classmethod
     def from_int(cls, number: int):
         """Convert an int to a filter object."""
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import collections
 import datetime
 import difflib
 import itertools
@@ -21,12 +22,64 @@ import os
 import pickle
 import random
 import string
+import time
+from typing import Optional, Tuple
 
 import discord
 from discord.ext import commands
 
-from bot.data import (GenericError, birdList, birdListMaster, database, logger,
-                      sciListMaster, songBirds, states, taxons)
+from bot.data import (GenericError, async_database, birdList, birdListMaster,
+                      logger, sciListMaster, songBirds, states, taxons)
+from bot.network import upstream_health
+
+
+# channels and users that were set up recently are skipped by
+# channel_setup and user_setup for KNOWN_TTL seconds
+KNOWN_TTL = int(os.getenv("SCIOLY_ID_BOT_KNOWN_TTL", 600))
+KNOWN_SIZE = int(os.getenv("SCIOLY_ID_BOT_KNOWN_SIZE", 10000))
+
+
+class KnownEntities:
+    """Bounded in-process cache of channels and users that are already set up.
+
+    Entries expire after `ttl` seconds, and the least recently used
+    entries are removed once there are more than `max_size`.
+    Keys are tuples, such as ("channel", channel_id).
+    """
+
+    def __init__(self, ttl: int = KNOWN_TTL, max_size: int = KNOWN_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expires = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: tuple) -> bool:
+        expires = self._expires.get(key)
+        if expires is None or expires < time.monotonic():
+            self._expires.pop(key, None)
+            self.misses += 1
+            return False
+        self._expires.move_to_end(key)
+        self.hits += 1
+        return True
+
+    def add(self, key: tuple):
+        self._expires[key] = time.monotonic() + self.ttl
+        self._expires.move_to_end(key)
+        while len(self._expires) > self.max_size:
+            self._expires.popitem(last=False)
+
+    def invalidate(self, *prefix):
+        """Removes entries with keys starting with `prefix`."""
+        for key in [key for key in self._expires if key[: len(prefix)] == prefix]:
+            del self._expires[key]
+
+    def info(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._expires)}
+
+
+known_entities = KnownEntities()
 
 
 async def channel_setup(ctx):
@@ -34,27 +87,34 @@ async def channel_setup(ctx):
 
     `ctx` - Discord context object
     """
+    if ("channel", ctx.channel.id) in known_entities:
+        return
     logger.info("checking channel setup")
-    if not database.exists(f"channel:{ctx.channel.id}"):
-        database.hset(
+    pipe = async_database.pipeline(transaction=False)
+    pipe.exists(f"channel:{ctx.channel.id}")
+    pipe.zadd("score:global", {str(ctx.channel.id): 0}, nx=True)
+    if ctx.guild is not None:
+        pipe.zadd("channels:global", {f"{ctx.guild.id}:{ctx.channel.id}": 0})
+    channel_exists = (await pipe.execute())[0]
+
+    if not channel_exists:
+        await async_database.hset(
             f"channel:{ctx.channel.id}",
             mapping={"bird": "", "answered": 1, "prevB": "", "prevJ": 20},
         )
         # true = 1, false = 0, index 0 is last arg, prevJ is 20 to define as integer
         logger.info("channel data added")
         await ctx.send("Ok, setup! I'm all ready to use!")
-
-    if database.zscore("score:global", str(ctx.channel.id)) is None:
-        database.zadd("score:global", {str(ctx.channel.id): 0})
-        logger.info("channel score added")
-
-    if ctx.guild is not None:
-        database.zadd("channels:global", {f"{ctx.guild.id}:{ctx.channel.id}": 0})
+    known_entities.add(("channel", ctx.channel.id))
 
 
 async def user_setup(ctx):
     """Sets up a new discord user for score tracking.
 
+    Users that were set up recently are skipped, and custom list roles
+    are checked once for each server. Daily and server scores are added
+    when the user first answers, or by `server_score_setup`.
+
     `ctx` - Discord context object or user id
     """
     if isinstance(ctx, (str, int)):
@@ -65,34 +125,28 @@ async def user_setup(ctx):
         user_id = str(ctx.author.id)
         guild = ctx.guild
 
+    keys = [("user", user_id)]
+    if guild is not None:
+        keys.append(("server", user_id, guild.id))
+    if all(key in known_entities for key in keys):
+        return
+
     logger.info("checking user data")
-    if database.zscore("users:global", user_id) is None:
-        database.zadd("users:global", {user_id: 0})
+    pipe = async_database.pipeline(transaction=False)
+    pipe.zadd("users:global", {user_id: 0}, nx=True)
+    pipe.zadd("streak:global", {user_id: 0}, nx=True)
+    pipe.zadd("streak.max:global", {user_id: 0}, nx=True)
+    if guild is not None:
+        pipe.exists(f"custom.list:{user_id}")
+    results = await pipe.execute()
+
+    if results[0]:
         logger.info("user global added")
         if ctx is not None:
             await ctx.send("Welcome <@" + user_id + ">!")
 
-    date = str(datetime.datetime.now(datetime.timezone.utc).date())
-    if database.zscore(f"daily.score:{date}", user_id) is None:
-        database.zadd(f"daily.score:{date}", {user_id: 0})
-        logger.info("user daily added")
-
-    # Add streak
-    if (database.zscore("streak:global", user_id) is None) or (
-        database.zscore("streak.max:global", user_id) is None
-    ):
-        database.zadd("streak:global", {user_id: 0})
-        database.zadd("streak.max:global", {user_id: 0})
-        logger.info("added streak")
-
     if guild is not None:
-        global_score = database.zscore("users:global", str(ctx.author.id))
-        database.zadd(
-            f"users.server:{ctx.guild.id}", {str(ctx.author.id): global_score}
-        )
-        logger.info("synced scores")
-
-        if not database.exists(f"custom.list:{ctx.author.id}"):
+        if not results[3]:
             role_ids = [role.id for role in ctx.author.roles]
             role_names = [role.name.lower() for role in ctx.author.roles]
             if set(role_names).intersection(set(states["CUSTOM"]["aliases"])):
@@ -103,12 +157,35 @@ async def user_setup(ctx):
                 )
                 logger.info("synced roles")
 
+    for key in keys:
+        known_entities.add(key)
+
+
+async def server_score_setup(ctx):
+    """Adds the user to the server leaderboard with their global score.
+
+    Users already on the leaderboard are skipped.
 
-def bird_setup(ctx, bird: str):
+    `ctx` - Discord context object
+    """
+    user_id = str(ctx.author.id)
+    global_score = await async_database.zscore("users:global", user_id)
+    await async_database.zadd(
+        f"users.server:{ctx.guild.id}", {user_id: global_score or 0}, nx=True
+    )
+    logger.info("synced scores")
+
+
+async def bird_setup(ctx, bird: str, frequency: int = 0):
     """Sets up a new bird for incorrect tracking.
 
+    The bird is added to the leaderboards with a score of 0 if it isn't
+    already there, using one pipelined request (and one more if the user
+    has a session).
+
     `ctx` - Discord context object or user id\n
-    `bird` - bird to setup
+    `bird` - bird to setup\n
+    `frequency` (int) - amount to increment the bird's frequency by
     """
     if isinstance(ctx, (str, int)):
         user_id = ctx
@@ -118,64 +195,30 @@ def bird_setup(ctx, bird: str):
         guild = ctx.guild
 
     logger.info("checking bird data")
-    if database.zscore("incorrect:global", string.capwords(bird)) is not None:
-        logger.info("bird global ok")
-    else:
-        database.zadd("incorrect:global", {string.capwords(bird): 0})
-        logger.info("bird global added")
-
-    if database.zscore(f"incorrect.user:{user_id}", string.capwords(bird)) is not None:
-        logger.info("incorrect bird user ok")
-    else:
-        database.zadd(f"incorrect.user:{user_id}", {string.capwords(bird): 0})
-        logger.info("incorrect bird user added")
-
-    if database.zscore(f"correct.user:{user_id}", string.capwords(bird)) is not None:
-        logger.info("correct bird user ok")
-    else:
-        database.zadd(f"correct.user:{user_id}", {string.capwords(bird): 0})
-        logger.info("correct bird user added")
-
+    bird = string.capwords(bird)
     date = str(datetime.datetime.now(datetime.timezone.utc).date())
-    if database.zscore(f"daily.incorrect:{date}", string.capwords(bird)) is not None:
-        logger.info("bird daily ok")
-    else:
-        database.zadd(f"daily.incorrect:{date}", {string.capwords(bird): 0})
-        logger.info("bird daily added")
-
-    if database.zscore("frequency.bird:global", string.capwords(bird)) is not None:
-        logger.info("bird freq global ok")
-    else:
-        database.zadd("frequency.bird:global", {string.capwords(bird): 0})
-        logger.info("bird freq global added")
-
+    keys = [
+        "incorrect:global",
+        f"incorrect.user:{user_id}",
+        f"correct.user:{user_id}",
+        f"daily.incorrect:{date}",
+    ]
     if guild is not None:
-        logger.info("no dm")
-        if (
-            database.zscore(f"incorrect.server:{ctx.guild.id}", string.capwords(bird))
-            is not None
-        ):
-            logger.info("bird server ok")
-        else:
-            database.zadd(
-                f"incorrect.server:{ctx.guild.id}", {string.capwords(bird): 0}
-            )
-            logger.info("bird server added")
+        keys.append(f"incorrect.server:{guild.id}")
+
+    pipe = async_database.pipeline(transaction=False)
+    for key in keys:
+        pipe.zadd(key, {bird: 0}, nx=True)
+    if frequency:
+        pipe.zincrby("frequency.bird:global", frequency, bird)
     else:
-        logger.info("dm context")
+        pipe.zadd("frequency.bird:global", {bird: 0}, nx=True)
+    pipe.exists(f"session.data:{user_id}")
+    session_active = (await pipe.execute())[-1]
 
-    if database.exists(f"session.data:{user_id}"):
+    if session_active:
         logger.info("session in session")
-        if (
-            database.zscore(f"session.incorrect:{user_id}", string.capwords(bird))
-            is not None
-        ):
-            logger.info("bird session ok")
-        else:
-            database.zadd(f"session.incorrect:{user_id}", {string.capwords(bird): 0})
-            logger.info("bird session added")
-    else:
-        logger.info("no session")
+        await async_database.zadd(f"session.incorrect:{user_id}", {bird: 0}, nx=True)
 
 
 def check_state_role(ctx) -> list:
@@ -212,7 +255,9 @@ async def send_leaderboard(
         page = 1
 
     entry_count = (
-        int(database.zcard(database_key)) if database_key is not None else data.count()
+        int(await async_database.zcard(database_key))
+        if database_key is not None
+        else data.count()
     )
     page = (page * 10) - 10
 
@@ -227,7 +272,7 @@ async def send_leaderboard(
     leaderboard_list = (
         map(
             lambda x: (x[0].decode("utf-8"), x[1]),
-            database.zrevrangebyscore(
+            await async_database.zrevrangebyscore(
                 database_key, "+inf", "-inf", page, items_per_page, True
             ),
         )
@@ -245,7 +290,7 @@ async def send_leaderboard(
     await ctx.send(embed=embed)
 
 
-def build_id_list(
+async def build_id_list(
     user_id=None, taxon=None, roles=None, state=None, media="images"
 ) -> list:
     """Generates an ID list based on given arguments
@@ -273,15 +318,13 @@ def build_id_list(
         raise GenericError("Invalid media type", code=990)
 
     custom_list = []
-    if (
-        user_id
-        and "CUSTOM" in state_roles
-        and database.exists(f"custom.list:{user_id}")
-        and not database.exists(f"custom.confirm:{user_id}")
-    ):
-        custom_list = [
-            bird.decode("utf-8") for bird in database.smembers(f"custom.list:{user_id}")
-        ]
+    if user_id and "CUSTOM" in state_roles:
+        pipe = async_database.pipeline(transaction=False)
+        pipe.exists(f"custom.confirm:{user_id}")
+        pipe.smembers(f"custom.list:{user_id}")
+        confirming, members = await pipe.execute()
+        if not confirming:
+            custom_list = [bird.decode("utf-8") for bird in members]
 
     birds = []
     if taxon:
@@ -311,7 +354,7 @@ def build_id_list(
     return birds
 
 
-def session_increment(ctx, item: str, amount: int):
+async def session_increment(ctx, item: str, amount: int):
     """Increments the value of a database hash field by `amount`.
 
     `ctx` - Discord context object or user id\n
@@ -324,105 +367,155 @@ def session_increment(ctx, item: str, amount: int):
     else:
         user_id = ctx.author.id
 
-    if database.exists(f"session.data:{user_id}"):
+    if await async_database.exists(f"session.data:{user_id}"):
         logger.info("session active")
         logger.info(f"incrementing {item} by {amount}")
-        value = int(database.hget(f"session.data:{user_id}", item))
-        value += int(amount)
-        database.hset(f"session.data:{user_id}", item, str(value))
+        await async_database.hincrby(f"session.data:{user_id}", item, int(amount))
     else:
         logger.info("session not active")
 
 
-def incorrect_increment(ctx, bird: str, amount: int):
-    """Increments the value of an incorrect bird by `amount`.
-
-    `ctx` - Discord context object or user id\n
-    `bird` - bird that was incorrect\n
-    `amount` (int) - amount to increment by, usually 1
-    """
-    if isinstance(ctx, (str, int)):
-        user_id = ctx
-        guild = None
-    else:
-        user_id = ctx.author.id
-        guild = ctx.guild
-
-    logger.info(f"incrementing incorrect {bird} by {amount}")
-    date = str(datetime.datetime.now(datetime.timezone.utc).date())
-    database.zincrby("incorrect:global", amount, string.capwords(str(bird)))
-    database.zincrby(f"incorrect.user:{user_id}", amount, string.capwords(str(bird)))
-    database.zincrby(f"daily.incorrect:{date}", amount, string.capwords(str(bird)))
-    if guild is not None:
-        logger.info("no dm")
-        database.zincrby(
-            f"incorrect.server:{ctx.guild.id}", amount, string.capwords(str(bird))
-        )
-    else:
-        logger.info("dm context")
-    if database.exists(f"session.data:{user_id}"):
-        logger.info("session in session")
-        database.zincrby(
-            f"session.incorrect:{user_id}", amount, string.capwords(str(bird))
-        )
-    else:
-        logger.info("no session")
-
-
-def score_increment(ctx, amount: int):
-    """Increments the score of a user by `amount`.
-
-    `ctx` - Discord context object\n
-    `amount` (int) - amount to increment by, usually 1
+# records an answer in one round trip, see record_answer
+ANSWER_SCRIPT = """
+local state, bird, user, member = KEYS[1], ARGV[1], ARGV[2], ARGV[3]
+local result, in_guild, reset = ARGV[4], ARGV[5] == "1", ARGV[6] == "1"
+local has_user = user ~= ""
+local in_session = has_user and redis.call("EXISTS", KEYS[8]) == 1
+local in_race = in_guild and redis.call("EXISTS", KEYS[16]) == 1
+local score, race_score = -1, -1
+
+if reset then
+    redis.call("HSET", state, "bird", "", "answered", "1")
+end
+
+if has_user then
+    -- scores are added the first time they're needed
+    redis.call("ZADD", KEYS[14], "NX", 0, user)
+    if in_guild and not redis.call("ZSCORE", KEYS[15], user) then
+        redis.call("ZADD", KEYS[15], redis.call("ZSCORE", KEYS[13], user) or 0, user)
+    end
+end
+
+if has_user and result ~= "skip" then
+    -- make sure the bird is in each leaderboard
+    for _, key in ipairs({KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6]}) do
+        redis.call("ZADD", key, "NX", 0, bird)
+    end
+    if in_guild then
+        redis.call("ZADD", KEYS[7], "NX", 0, bird)
+    end
+    if in_session then
+        redis.call("ZADD", KEYS[9], "NX", 0, bird)
+    end
+end
+
+if result == "correct" and has_user then
+    if in_session then
+        redis.call("HINCRBY", KEYS[8], "correct", 1)
+    end
+    local streak = tonumber(redis.call("ZINCRBY", KEYS[10], 1, user))
+    if streak > tonumber(redis.call("ZSCORE", KEYS[11], user) or 0) then
+        redis.call("ZADD", KEYS[11], streak, user)
+    end
+    redis.call("ZINCRBY", KEYS[4], 1, bird)
+    redis.call("ZINCRBY", KEYS[12], 1, member)
+    score = redis.call("ZINCRBY", KEYS[13], 1, user)
+    redis.call("ZINCRBY", KEYS[14], 1, user)
+    if in_guild then
+        redis.call("ZINCRBY", KEYS[15], 1, user)
+        if in_race then
+            redis.call("ZINCRBY", KEYS[17], 1, user)
+            race_score = redis.call("ZREVRANGE", KEYS[17], 0, 0, "WITHSCORES")[2]
+        end
+    end
+elseif result == "incorrect" then
+    redis.call("ZINCRBY", KEYS[2], 1, bird)
+    if has_user then
+        redis.call("ZADD", KEYS[10], 0, user)
+        redis.call("ZINCRBY", KEYS[3], 1, bird)
+        redis.call("ZINCRBY", KEYS[5], 1, bird)
+        if in_guild then
+            redis.call("ZINCRBY", KEYS[7], 1, bird)
+        end
+        if in_session then
+            redis.call("HINCRBY", KEYS[8], "incorrect", 1)
+            redis.call("ZINCRBY", KEYS[9], 1, bird)
+        end
+    end
+elseif result == "skip" and has_user then
+    redis.call("ZADD", KEYS[10], 0, user)
+end
+
+return {tostring(score), tostring(race_score)}
+"""
+_answer_script = async_database.register_script(ANSWER_SCRIPT)
+
+
+async def record_answer(
+    ctx, bird: str, result: str, state: str = None, reset: bool = True
+) -> Tuple[Optional[int], Optional[int]]:
+    """Records the result of an answer with one Redis call.
+
+    This updates the bird leaderboards (like `bird_setup`), scores, streaks,
+    sessions, daily and server stats, and race scores, and resets the current bird.
+    Returns a tuple of the user's total score and the highest race score,
+    which are None if they weren't changed.
+
+    `ctx` - Discord context object or user id (0 if not logged in)\n
+    `bird` - the bird that was answered\n
+    `result` (str) - correct, incorrect, or skip\n
+    `state` (str) - database key of the hash with the current bird,
+    the channel by default\n
+    `reset` (bool) - whether to reset the current bird
     """
     if isinstance(ctx, (str, int)):
-        user_id = str(ctx)
-        guild = None
+        user_id = str(ctx) if int(ctx) != 0 else ""
+        guild_id = ""
         channel_id = ""
     else:
         user_id = str(ctx.author.id)
-        guild = ctx.guild
+        guild_id = str(ctx.guild.id) if ctx.guild is not None else ""
         channel_id = str(ctx.channel.id)
+    if state is None:
+        state = f"channel:{channel_id}"
 
-    logger.info(f"incrementing score by {amount}")
+    logger.info(f"recording {result} answer")
+    bird = string.capwords(str(bird))
     date = str(datetime.datetime.now(datetime.timezone.utc).date())
-    database.zincrby("score:global", amount, channel_id)
-    database.zincrby("users:global", amount, user_id)
-    database.zincrby(f"daily.score:{date}", amount, user_id)
-    if guild is not None:
-        logger.info("no dm")
-        database.zincrby(f"users.server:{ctx.guild.id}", amount, user_id)
-        if database.exists(f"race.data:{ctx.channel.id}"):
-            logger.info("race in session")
-            database.zincrby(f"race.scores:{ctx.channel.id}", amount, user_id)
-    else:
-        logger.info("dm context")
-
-
-def streak_increment(ctx, amount: int):
-    """Increments the streak of a user by `amount`.
-
-    `ctx` - Discord context object or user id\n
-    `amount` (int) - amount to increment by, usually 1.
-    If amount is None, the streak is ended.
-    """
-    if isinstance(ctx, (str, int)):
-        user_id = str(ctx)
-    else:
-        user_id = str(ctx.author.id)
-
-    if amount is not None:
-        # increment streak and update max
-        database.zincrby("streak:global", amount, user_id)
-        if database.zscore("streak:global", user_id) > database.zscore(
-            "streak.max:global", user_id
-        ):
-            database.zadd(
-                "streak.max:global",
-                {user_id: database.zscore("streak:global", user_id)},
-            )
-    else:
-        database.zadd("streak:global", {user_id: 0})
+    keys = [
+        state,
+        "incorrect:global",
+        f"incorrect.user:{user_id}",
+        f"correct.user:{user_id}",
+        f"daily.incorrect:{date}",
+        "frequency.bird:global",
+        f"incorrect.server:{guild_id}",
+        f"session.data:{user_id}",
+        f"session.incorrect:{user_id}",
+        "streak:global",
+        "streak.max:global",
+        "score:global",
+        "users:global",
+        f"daily.score:{date}",
+        f"users.server:{guild_id}",
+        f"race.data:{channel_id}",
+        f"race.scores:{channel_id}",
+    ]
+    args = [
+        bird,
+        user_id,
+        channel_id,
+        result,
+        "1" if guild_id else "0",
+        "1" if reset else "0",
+    ]
+    score, race_score = (
+        int(float(value)) for value in await _answer_script(keys=keys, args=args)
+    )
+    return (
+        score if score >= 0 else None,
+        race_score if race_score >= 0 else None,
+    )
 
 
 async def drone_attack(ctx):
@@ -584,17 +677,27 @@ async def backup_all():
     to a specified discord channel.
     """
     logger.info("Starting Backup")
-    logger.info("Creating Dump")
-    keys = (key.decode("utf-8") for key in database.keys())
-    dump = ((database.dump(key), key) for key in keys)
-    logger.info("Finished Dump")
-    logger.info("Writing To File")
-    os.makedirs("bot_files/backups", exist_ok=True)
-    with open("bot_files/backups/dump.dump", "wb") as f:
-        with open("bot_files/backups/keys.txt", "w") as k:
-            for item, key in dump:
-                pickle.dump(item, f)
-                k.write(f"{key}\n")
+
+    def write_backup():
+        # runs on a redis worker thread, since it reads every key
+        database = async_database.client
+        logger.info("Creating Dump")
+        keys = (
+            key.decode("utf-8")
+            for key in database.keys()
+            if not key.startswith(b"taxonomy.")  # cached lookups aren't backed up
+        )
+        dump = ((database.dump(key), key) for key in keys)
+        logger.info("Finished Dump")
+        logger.info("Writing To File")
+        os.makedirs("bot_files/backups", exist_ok=True)
+        with open("bot_files/backups/dump.dump", "wb") as f:
+            with open("bot_files/backups/keys.txt", "w") as k:
+                for item, key in dump:
+                    pickle.dump(item, f)
+                    k.write(f"{key}\n")
+
+    await async_database.run(write_backup)
     logger.info("Backup Finished")
 
 
@@ -642,8 +745,7 @@ class CustomCooldown:
                 "check",
                 "skip",
             )
-            and database.exists("cooldown:global")
-            and int(database.get("cooldown:global")) > 1
+            and not upstream_health.healthy()
         ):
             bucket = self.rate_limit_mapping.get_bucket(ctx.message)
 
@@ -0,0 +1,229 @@
+# http_cache.py | on disk cache of json api responses
+# Copyright (C) 2019-2020  EraserBird, person_v1.32, hmmm
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+from bot.data import logger
+
+HTTP_CACHE_DIR = "bot_files/cache/http"
+HTTP_CACHE_SIZE = int(
+    os.getenv("SCIOLY_ID_BOT_HTTP_CACHE_SIZE", 50 * 1024 ** 2)
+)  # 50mb
+# responses are used without revalidating for FRESH_TIME seconds (unless the
+# server sends a max-age), then served stale while revalidating for STALE_TIME
+FRESH_TIME = int(os.getenv("SCIOLY_ID_BOT_HTTP_CACHE_FRESH", 3600))  # 1 hour
+STALE_TIME = int(os.getenv("SCIOLY_ID_BOT_HTTP_CACHE_STALE", 86400))  # 1 day
+LOW_WATERMARK = 0.75  # fraction of the size cap kept after evicting
+
+# cached response format (json file named by the hash of the url):
+#   {
+#       "url": "https://search.macaulaylibrary.org/...",
+#       "etag": '"abc123"' or None,
+#       "last_modified": "Wed, 21 Oct 2015 07:28:00 GMT" or None,
+#       "fetched": 1600000000.0, (time the response was last validated)
+#       "max_age": 3600, (seconds the response is fresh for)
+#       "no_cache": False, (whether the response must be revalidated before use)
+#       "body": decoded json response
+#   }
+
+
+def _max_age(cache_control: str) -> int:
+    """Returns the seconds a response is fresh for from its Cache-Control header."""
+    if "no-cache" in cache_control:
+        return 0
+    match = re.search(r"max-age=(\d+)", cache_control)
+    return int(match.group(1)) if match else FRESH_TIME
+
+
+class ResponseCache:
+    """On disk cache of JSON responses from the eBird and Macaulay APIs.
+
+    Responses are stored with their ETag and Last-Modified headers, so stale
+    responses can be revalidated with a conditional request. The least
+    recently used responses are deleted when the cache is over `max_size`.
+    The cache directory is shared by the bot and web workers.
+    """
+
+    def __init__(self, directory: str = HTTP_CACHE_DIR, max_size: int = HTTP_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _path(self, url: str) -> str:
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return f"{self.directory}/{name}.json"
+
+    def get(self, url: str) -> Optional[dict]:
+        """Returns the cached response for a url, or None."""
+        path = self._path(url)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(path)  # eviction uses the modified time
+        return entry
+
+    @staticmethod
+    def age(entry: dict, now: float = None) -> float:
+        return (now or time.time()) - entry["fetched"]
+
+    @staticmethod
+    def is_fresh(entry: dict, now: float = None) -> bool:
+        return ResponseCache.age(entry, now) < entry["max_age"]
+
+    @staticmethod
+    def is_usable(entry: dict, now: float = None) -> bool:
+        """Returns True if the response is fresh or can be served while revalidating.
+
+        Responses sent with `no-cache` are never served without revalidating.
+        """
+        if entry.get("no_cache"):
+            return False
+        return ResponseCache.age(entry, now) < entry["max_age"] + STALE_TIME
+
+    @staticmethod
+    def conditional_headers(entry: Optional[dict]) -> Dict[str, str]:
+        """Returns headers to revalidate a cached response."""
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, url: str, body, headers) -> Optional[dict]:
+        """Stores a response, returns the new entry or None if it can't be cached.
+
+        `headers` - the response headers
+        """
+        cache_control = headers.get("cache-control", "")
+        if "no-store" in cache_control:
+            return None
+        entry = {
+            "url": url,
+            "etag": headers.get("etag"),
+            "last_modified": headers.get("last-modified"),
+            "fetched": time.time(),
+            "max_age": _max_age(cache_control),
+            "no_cache": "no-cache" in cache_control,
+            "body": body,
+        }
+        self._write(entry)
+        return entry
+
+    def refresh(self, entry: dict, headers) -> dict:
+        """Marks a cached response as valid after a 304 Not Modified response."""
+        entry = dict(
+            entry,
+            etag=headers.get("etag") or entry.get("etag"),
+            fetched=time.time(),
+            max_age=_max_age(headers.get("cache-control", "")),
+            no_cache="no-cache" in headers.get("cache-control", ""),
+        )
+        self.revalidated += 1
+        self._write(entry)
+        return entry
+
+    def _write(self, entry: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(entry["url"])
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        data = json.dumps(entry).encode("utf-8")
+        if len(data) > self.max_size:
+            return
+        try:
+            old_size = os.stat(path).st_size
+        except OSError:
+            old_size = 0
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data) - old_size
+        if self.size() > self.max_size:
+            self.evict()
+
+    def size(self) -> int:
+        """Returns the size of the cache in bytes."""
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._scan())
+            return self._size
+
+    def _scan(self):
+        """Yields (path, size, modified time) of cached responses."""
+        with contextlib.suppress(FileNotFoundError):
+            with os.scandir(self.directory) as entries:
+                for item in entries:
+                    if not item.name.endswith(".json"):
+                        continue
+                    with contextlib.suppress(FileNotFoundError):
+                        stat = item.stat()
+                        yield (item.path, stat.st_size, stat.st_mtime)
+
+    def evict(self) -> int:
+        """Deletes the least recently used responses.
+
+        Responses are deleted until the cache is under the low watermark.
+        Returns the number of bytes freed.
+        """
+        with self._lock:
+            files = sorted(self._scan(), key=lambda item: item[2])
+            size = sum(item[1] for item in files)
+            freed = 0
+            for path, file_size, _ in files:
+                if size - freed <= self.max_size * LOW_WATERMARK:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                freed += file_size
+                self.evicted += 1
+            self._size = size - freed
+        logger.info(f"evicted {freed} bytes of http responses")
+        return freed
+
+    def info(self) -> dict:
+        return {
+            "hits": self.hits,
+            "stale": self.stale,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "size": self.size(),
+        }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,245 @@
+# ingest.py | processing for newly downloaded media
+# Copyright (C) 2019-2020  EraserBird, person_v1.32, hmmm
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import subprocess
+from typing import Optional, Tuple
+
+import eyed3
+from PIL import Image, ImageOps
+
+from bot.data import logger
+
+MAX_FILESIZE = 6000000  # limit media to 6mb
+
+# images larger than this (in pixels) on either side are scaled down
+IMAGE_MAX_DIMENSION = int(os.getenv("SCIOLY_ID_BOT_IMAGE_MAX_DIMENSION", 1600))
+JPEG_QUALITY = int(os.getenv("SCIOLY_ID_BOT_JPEG_QUALITY", 85))
+
+# audio is only trimmed, capped, or transcoded if these are set
+TRIM_SILENCE = os.getenv("SCIOLY_ID_BOT_AUDIO_TRIM_SILENCE") == "true"
+AUDIO_MAX_DURATION = int(os.getenv("SCIOLY_ID_BOT_AUDIO_MAX_DURATION", 0))  # seconds
+WAV_TRANSCODE_SIZE = int(os.getenv("SCIOLY_ID_BOT_WAV_TRANSCODE_SIZE", 0))  # bytes
+# removes silences longer than 2 seconds
+SILENCE_FILTER = (
+    "silenceremove=start_periods=1:start_threshold=-50dB:"
+    + "stop_periods=-1:stop_duration=2:stop_threshold=-50dB"
+)
+
+# ingest results are tuples of:
+# (path, content type, size, extra manifest fields)
+IngestResult = Tuple[str, str, int, dict]
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def optimize_image(path: str, content_type: str, size: int) -> Optional[IngestResult]:
+    """Downsizes, recompresses, and strips metadata from a downloaded image.
+
+    Images are scaled to fit in `IMAGE_MAX_DIMENSION` and saved as JPEG,
+    or PNG if they have transparency. Animated GIFs are replaced by their
+    first frame. The original is kept if it is already a small JPEG
+    without EXIF data. Returns None if the image can't be read.
+
+    `path` (str) - path to the downloaded image\n
+    `content_type` (str) - MIME type of the image\n
+    `size` (int) - size of the downloaded image
+    """
+    try:
+        with Image.open(path) as original:
+            animated = getattr(original, "is_animated", False)
+            has_exif = bool(original.info.get("exif"))
+            image = ImageOps.exif_transpose(original)
+            resize = max(image.size) > IMAGE_MAX_DIMENSION
+            if resize:
+                image.thumbnail(
+                    (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS
+                )
+            if (
+                content_type == "image/jpeg"
+                and not (resize or has_exif)
+                and size <= MAX_FILESIZE
+            ):
+                return (path, content_type, size, {"original_size": size})
+
+            transparent = image.mode in ("RGBA", "LA") or (
+                image.mode == "P" and "transparency" in image.info
+            )
+            stem = path.rsplit(".", 1)[0]
+            temp_path = f"{stem}.{os.getpid()}.tmp"
+            if transparent and not animated:
+                new_type, new_path = "image/png", f"{stem}.png"
+                image.save(temp_path, "png", optimize=True)
+            else:
+                new_type, new_path = "image/jpeg", f"{stem}.jpg"
+                image.convert("RGB").save(
+                    temp_path,
+                    "jpeg",
+                    quality=JPEG_QUALITY,
+                    optimize=True,
+                    progressive=True,
+                )
+    except (OSError, ValueError) as e:
+        logger.info(f"could not optimize {path}: {e}")
+        _remove(path)
+        return None
+
+    new_size = os.stat(temp_path).st_size
+    if new_size >= size and content_type == new_type and not (resize or has_exif):
+        # recompressing didn't help
+        _remove(temp_path)
+        new_type, new_path, new_size = content_type, path, size
+    else:
+        os.replace(temp_path, new_path)
+        if new_path != path:
+            _remove(path)
+
+    if new_size > MAX_FILESIZE:
+        logger.info(f"{new_path} too large after optimizing: {new_size}")
+        _remove(new_path)
+        return None
+
+    logger.info(f"optimized {path}: {size} -> {new_size} bytes")
+    return (new_path, new_type, new_size, {"original_size": size})
+
+
+def probe_audio(path: str) -> dict:
+    """Returns the codec, bitrate, and duration of an audio file.
+
+    The codec and bitrate are calculated the same way as
+    `discord.FFmpegOpusAudio.probe`, so they can be passed to
+    `FFmpegOpusAudio` directly. Returns an empty dict if ffprobe fails.
+    """
+    args = [
+        "ffprobe",
+        "-v",
+        "quiet",
+        "-print_format",
+        "json",
+        "-show_streams",
+        "-show_format",
+        "-select_streams",
+        "a:0",
+        path,
+    ]
+    try:
+        data = json.loads(subprocess.check_output(args, timeout=20))
+        stream = data["streams"][0]
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError, KeyError) as e:
+        logger.info(f"could not probe {path}: {e}")
+        return {}
+    bitrate = int(stream.get("bit_rate", 0))
+    return {
+        "codec": stream.get("codec_name"),
+        "bitrate": max(round(bitrate / 1000), 512),
+        "duration": float(stream.get("duration") or data["format"].get("duration") or 0),
+    }
+
+
+def _remove_tags(path: str) -> bool:
+    """Removes ID3 tags, which can contain the name of the bird."""
+    try:
+        audio_file = eyed3.load(path)
+    except (OSError, ValueError) as e:
+        logger.info(f"could not read tags from {path}: {e}")
+        return False
+    if audio_file is not None and audio_file.tag is not None:
+        audio_file.tag.remove(path)
+    return True
+
+
+def process_audio(path: str, content_type: str, size: int) -> Optional[IngestResult]:
+    """Removes spoilers from a downloaded song and records its properties.
+
+    Tags are removed, and if configured, long silences are trimmed,
+    songs are cut to `AUDIO_MAX_DURATION`, and WAV files larger than
+    `WAV_TRANSCODE_SIZE` are converted to MP3 with ffmpeg.
+    The codec, bitrate, and duration are probed and stored
+    so they don't need to be probed again when playing in voice.
+
+    `path` (str) - path to the downloaded song\n
+    `content_type` (str) - MIME type of the song\n
+    `size` (int) - size of the downloaded song
+    """
+    transcode = (
+        content_type == "audio/wav" and WAV_TRANSCODE_SIZE and size > WAV_TRANSCODE_SIZE
+    )
+    new_path, new_type = path, content_type
+    stripped = False
+    if TRIM_SILENCE or AUDIO_MAX_DURATION or transcode:
+        stem = path.rsplit(".", 1)[0]
+        if transcode or content_type == "audio/mpeg":
+            new_path, new_type, codec = f"{stem}.mp3", "audio/mpeg", "libmp3lame"
+        else:
+            new_path, codec = f"{stem}.wav", "pcm_s16le"
+        temp_path = f"{stem}.{os.getpid()}.tmp"
+        args = ["ffmpeg", "-v", "error", "-y", "-i", path, "-map_metadata", "-1"]
+        if TRIM_SILENCE:
+            args += ["-af", SILENCE_FILTER]
+        if AUDIO_MAX_DURATION:
+            args += ["-t", str(AUDIO_MAX_DURATION)]
+        args += ["-codec:a", codec, "-f", new_path.rsplit(".", 1)[1], temp_path]
+        try:
+            subprocess.run(args, check=True, timeout=120)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.info(f"could not process {path}: {e}")
+            _remove(temp_path)
+            new_path, new_type = path, content_type
+        else:
+            os.replace(temp_path, new_path)
+            if new_path != path:
+                _remove(path)
+            stripped = True
+
+    if not stripped and new_type == "audio/mpeg":
+        stripped = _remove_tags(new_path)
+    elif new_type != "audio/mpeg":
+        stripped = True  # wav files don't have id3 tags
+
+    new_size = os.stat(new_path).st_size
+    if new_size > MAX_FILESIZE:
+        logger.info(f"{new_path} too large after processing: {new_size}")
+        _remove(new_path)
+        return None
+
+    metadata = {"original_size": size, "tags_removed": stripped}
+    metadata.update(probe_audio(new_path))
+    logger.info(f"processed {path}: {metadata}")
+    return (new_path, new_type, new_size, metadata)
+
+
+def ingest_media(path: str, content_type: str, size: int) -> Optional[IngestResult]:
+    """Processes a downloaded file before it is added to the cache.
+
+    This runs once per file, so work that would otherwise be
+    repeated on every send is done here. Returns None if the
+    file should be discarded.
+
+    `path` (str) - path to the downloaded file\n
+    `content_type` (str) - MIME type of the file\n
+    `size` (int) - size of the downloaded file
+    """
+    if content_type.startswith("image/"):
+        return optimize_image(path, content_type, size)
+    if content_type.startswith("audio/"):
+        return process_audio(path, content_type, size)
+    return (path, content_type, size, {"original_size": size})
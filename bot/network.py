@@ -0,0 +1,475 @@
+# network.py | shared http client
+# Copyright (C) 2019-2020  EraserBird, person_v1.32, hmmm
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import os
+import random
+import time
+import urllib.parse
+from typing import Callable, Dict, Hashable, Optional, Set
+
+import aiohttp
+
+from bot.data import GenericError, logger
+from bot.http_cache import response_cache
+
+CONNECTION_LIMIT = int(os.getenv("SCIOLY_ID_BOT_HTTP_CONNECTION_LIMIT", 100))
+PER_HOST_LIMIT = int(os.getenv("SCIOLY_ID_BOT_HTTP_PER_HOST_LIMIT", 20))
+DNS_CACHE_TTL = 300  # seconds
+KEEPALIVE_TIMEOUT = 30  # seconds
+TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10, sock_read=30)
+
+# a host's circuit breaker opens after FAILURE_THRESHOLD failures in a row,
+# and stays open for OPEN_TIME seconds, doubling up to MAX_OPEN_TIME
+FAILURE_THRESHOLD = int(os.getenv("SCIOLY_ID_BOT_HTTP_FAILURE_THRESHOLD", 5))
+OPEN_TIME = 30.0
+MAX_OPEN_TIME = 300.0
+# retries allowed for all requests made by one command
+RETRY_BUDGET = int(os.getenv("SCIOLY_ID_BOT_HTTP_RETRY_BUDGET", 4))
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_MAX = 8.0  # seconds
+# downloads are read in chunks that grow from MIN_CHUNK to MAX_CHUNK bytes
+# while the connection keeps them full, and written to disk every WRITE_SIZE bytes
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 1024 * 1024
+WRITE_SIZE = 1024 * 1024
+
+
+class CircuitBreaker:
+    """Stops sending requests to a host that keeps failing.
+
+    The breaker is closed while requests succeed. After `FAILURE_THRESHOLD`
+    failures in a row it opens, and requests fail immediately.
+    Once the open time has passed, one trial request is allowed (half open).
+    If it succeeds the breaker closes, otherwise it opens for twice as long.
+    Requests that were allowed should be sent inside `request()`, so a trial
+    that ends without a result still reopens the breaker.
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.state = "closed"
+        self.failures = 0
+        self.total_failures = 0
+        self.opened_at = 0.0
+        self.open_time = OPEN_TIME
+        self._trial = False
+
+    def allow(self) -> bool:
+        """Returns True if a request can be sent to the host."""
+        if self.state == "open" and self.retry_in() == 0:
+            logger.info(f"circuit breaker for {self.host} half open")
+            self.state = "half-open"
+            self._trial = False
+        if self.state == "half-open" and not self._trial:
+            self._trial = True
+            return True
+        return self.state == "closed"
+
+    @contextlib.contextmanager
+    def request(self):
+        """Context manager around a request the breaker allowed.
+
+        If this is the trial request and it ends without recording a success
+        or failure, for example if it was cancelled or raised an unexpected
+        error, it is recorded as a failure.
+        """
+        trial = self.state == "half-open" and self._trial
+        try:
+            yield
+        finally:
+            if trial and self.state == "half-open":
+                logger.info(f"trial request to {self.host} ended without a result")
+                self.record_failure()
+
+    def retry_in(self) -> float:
+        """Returns the number of seconds until the breaker allows a trial request."""
+        if self.state != "open":
+            return 0.0
+        return max(self.opened_at + self.open_time - time.monotonic(), 0.0)
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"circuit breaker for {self.host} closed")
+        self.state = "closed"
+        self.failures = 0
+        self.open_time = OPEN_TIME
+
+    def record_failure(self):
+        self.failures += 1
+        self.total_failures += 1
+        if self.state == "half-open":
+            self.open_time = min(self.open_time * 2, MAX_OPEN_TIME)
+            self._open()
+        elif self.state == "closed" and self.failures >= FAILURE_THRESHOLD:
+            self._open()
+
+    def _open(self):
+        logger.info(f"circuit breaker for {self.host} open for {self.open_time}s")
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
+    def info(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "total_failures": self.total_failures,
+            "retry_in": round(self.retry_in(), 1),
+        }
+
+
+class UpstreamHealth:
+    """Tracks the circuit breakers of the hosts the bot fetches from."""
+
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker(host)
+        return self._breakers[host]
+
+    def healthy(self, host: Optional[str] = None) -> bool:
+        """Returns False if the host (or any host, if not given) is failing."""
+        if host is not None:
+            return host not in self._breakers or self._breakers[host].state == "closed"
+        return all(breaker.state == "closed" for breaker in self._breakers.values())
+
+    def info(self) -> dict:
+        return {host: breaker.info() for host, breaker in self._breakers.items()}
+
+
+class RetryBudget:
+    """Limits the number of retries for all requests made by a command.
+
+    A new budget is set at the start of each command (and web request)
+    with `retry_budget.set(RetryBudget())`. Tasks started by the command
+    share the same budget.
+    """
+
+    def __init__(self, retries: int = RETRY_BUDGET):
+        self.remaining = retries
+
+    def spend(self) -> bool:
+        """Uses one retry, returns False if there are none left."""
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+retry_budget: contextvars.ContextVar = contextvars.ContextVar("retry_budget")
+
+
+def backoff(attempt: int) -> float:
+    """Returns a delay for a retry with exponential backoff and full jitter."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class HTTPClient:
+    """Manages one long-lived aiohttp session per process.
+
+    Connections to eBird, Macaulay, and the media CDN are pooled and
+    kept alive between commands, and DNS results are cached.
+    The session is created on first use in the running event loop,
+    and a new one is made if the event loop changes.
+    """
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._revalidating: Set[str] = set()
+
+    def session(self) -> aiohttp.ClientSession:
+        """Returns the shared session, creating it if needed.
+
+        This must be called from a running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            if self._session is not None and not self._session.closed:
+                logger.info("event loop changed, replacing http session")
+                self._discard()
+            logger.info("creating http session")
+            connector = aiohttp.TCPConnector(
+                limit=CONNECTION_LIMIT,
+                limit_per_host=PER_HOST_LIMIT,
+                ttl_dns_cache=DNS_CACHE_TTL,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=TIMEOUT)
+            self._loop = loop
+        return self._session
+
+    def _discard(self):
+        """Closes the session of the previous event loop."""
+        session, loop = self._session, self._loop
+        self._session = None
+        self._loop = None
+        if loop is not None and loop.is_running():
+            # the loop is still running in another thread
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+            return
+        # the loop has stopped, so drop the connections without it
+        connector = session.connector
+        session.detach()
+        if connector is not None:
+            asyncio.ensure_future(connector.close())
+
+    async def get_json(
+        self, url: str, session: aiohttp.ClientSession = None, cache: bool = True
+    ):
+        """Fetches and decodes a JSON response.
+
+        Responses are cached on disk. Fresh responses are returned without a
+        request, and stale responses are returned while they are revalidated
+        in the background. Server errors are retried with backoff while the
+        command's retry budget and the host's circuit breaker allow, and a
+        stale response is returned if the request fails. Raises a
+        `GenericError` with code 201 if the request fails.
+
+        `url` (str) - url to fetch\n
+        `session` (optional) - an aiohttp client session\n
+        `cache` (bool) - whether to use the response cache
+        """
+        loop = asyncio.get_running_loop()
+        entry = None
+        if cache:
+            entry = await loop.run_in_executor(None, response_cache.get, url)
+        if entry is not None and response_cache.is_fresh(entry):
+            response_cache.hits += 1
+            return entry["body"]
+        if entry is not None and response_cache.is_usable(entry):
+            response_cache.stale += 1
+            if url not in self._revalidating:
+                self._revalidating.add(url)
+                asyncio.ensure_future(self._revalidate(url, entry))
+            return entry["body"]
+
+        response_cache.misses += 1
+        try:
+            return await self._fetch_json(url, session, entry, cache)
+        except GenericError:
+            if entry is None:
+                raise
+            logger.info(f"request failed, using stale response for {url}")
+            return entry["body"]
+
+    async def _revalidate(self, url: str, entry: dict):
+        # background requests don't retry
+        retry_budget.set(RetryBudget(0))
+        try:
+            await self._fetch_json(url, None, entry)
+        except GenericError as e:
+            logger.info(f"revalidating {url} failed: {e}")
+        finally:
+            self._revalidating.discard(url)
+
+    async def _fetch_json(
+        self,
+        url: str,
+        session: Optional[aiohttp.ClientSession],
+        entry: Optional[dict],
+        cache: bool = True,
+    ):
+        """Fetches a JSON response and stores it in the response cache.
+
+        If `entry` is a cached response, a conditional request is sent
+        and the cached response is returned if it hasn't changed.
+        """
+        if session is None:
+            session = self.session()
+        loop = asyncio.get_running_loop()
+        host = urllib.parse.urlsplit(url).hostname
+        breaker = upstream_health.breaker(host)
+        budget = retry_budget.get(None) or RetryBudget()
+        headers = response_cache.conditional_headers(entry)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise GenericError(
+                    f"{host} is unavailable, retrying in {breaker.retry_in():.0f}s",
+                    code=201,
+                )
+            status = None
+            error = None
+            with breaker.request():
+                try:
+                    async with session.get(url, headers=headers) as response:
+                        status = response.status
+                        if status == 304 and entry is not None:
+                            breaker.record_success()
+                            logger.info(f"cached response still valid: {url}")
+                            await loop.run_in_executor(
+                                None, response_cache.refresh, entry, response.headers
+                            )
+                            return entry["body"]
+                        if status == 200:
+                            data = await response.json()
+                            breaker.record_success()
+                            if cache:
+                                await loop.run_in_executor(
+                                    None,
+                                    response_cache.store,
+                                    url,
+                                    data,
+                                    response.headers,
+                                )
+                            return data
+                # ValueError is raised for invalid JSON
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logger.info(f"error fetching {url}: {e!r}")
+                    error = e
+
+                if error is None and status < 500 and status != 429:
+                    # the host is up, but retrying won't help
+                    breaker.record_success()
+                    raise GenericError(
+                        f"An http error code of {status} occurred while fetching {url}",
+                        code=201,
+                    )
+                breaker.record_failure()
+            if not budget.spend():
+                logger.info("retry budget used up")
+                if error is not None:
+                    reason = f"An error ({error!r})"
+                else:
+                    reason = f"An http error code of {status}"
+                raise GenericError(f"{reason} occurred while fetching {url}", code=201)
+            delay = backoff(attempt)
+            attempt += 1
+            logger.info(f"An HTTP error occurred; Retries: {attempt}; Sleeping: {delay}")
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        """Closes the shared session and its connections."""
+        if self._session is not None and not self._session.closed:
+            logger.info("closing http session")
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+
+upstream_health = UpstreamHealth()
+http_client = HTTPClient()
+
+
+async def stream_to_file(
+    response: aiohttp.ClientResponse, filename: str, max_size: int
+) -> Optional[int]:
+    """Saves the body of a response to a file, returns the size or None if too large.
+
+    The body is written to a temporary file which is renamed when the
+    download finishes, so a failed download never leaves a partial file.
+    Downloads stop as soon as they are larger than `max_size` bytes,
+    whether or not the server sent a Content-Length. Disk writes are
+    run in the default executor.
+
+    `response` - an aiohttp response with the status already checked\n
+    `filename` (str) - path to save the file\n
+    `max_size` (int) - largest file size to download, in bytes
+    """
+    loop = asyncio.get_running_loop()
+    temp_path = f"{filename}.{os.getpid()}.part"
+    out_file = await loop.run_in_executor(None, open, temp_path, "wb")
+    size = 0
+    chunk_size = MIN_CHUNK
+    buffer = bytearray()
+    done = False
+    try:
+        while True:
+            block = await response.content.read(chunk_size)
+            if not block:
+                break
+            size += len(block)
+            if size > max_size:
+                logger.info(f"download larger than {max_size} bytes, stopping")
+                return None
+            if len(block) == chunk_size:
+                chunk_size = min(chunk_size * 2, MAX_CHUNK)
+            buffer += block
+            if len(buffer) >= WRITE_SIZE:
+                await loop.run_in_executor(None, out_file.write, bytes(buffer))
+                buffer.clear()
+        if buffer:
+            await loop.run_in_executor(None, out_file.write, bytes(buffer))
+        await loop.run_in_executor(None, out_file.close)
+        os.replace(temp_path, filename)
+        done = True
+        return size
+    finally:
+        if not done:
+            out_file.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one call.
+
+    The first caller starts the call in a task, and later callers with the
+    same key await the same task until it finishes. The task is shielded,
+    so cancelling one caller doesn't cancel the call for the others.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    def _done(self, key: Hashable, task: asyncio.Future):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # mark the exception as retrieved
+
+    async def do(self, key: Hashable, func: Callable, *args, **kwds):
+        """Calls `func(*args, **kwds)`, or waits for a call with the same key."""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwds))
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        else:
+            logger.info(f"waiting for in progress call: {key}")
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def info(self) -> dict:
+        return {"in_flight": len(self._calls), "coalesced": self.coalesced}
+
+
+def single_flight(key: Callable[..., Hashable]):
+    """Decorator that coalesces concurrent calls of a coroutine function.
+
+    `key` is called with the function's arguments and returns
+    the key that identifies duplicate calls.
+    """
+
+    def wrapper(func):
+        async def wrapped(*args, **kwds):
+            return await flights.do(
+                (func.__qualname__, key(*args, **kwds)), func, *args, **kwds
+            )
+
+        return functools.update_wrapper(wrapped, func)
+
+    return wrapper
+
+
+flights = SingleFlight()
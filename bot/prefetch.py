@@ -0,0 +1,170 @@
+# prefetch.py | background media prefetching
+# Copyright (C) 2019-2020  EraserBird, person_v1.32, hmmm
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import time
+from typing import Iterator, List, Tuple
+
+from sentry_sdk import capture_exception
+
+from bot.cache import cache_key, cache_stats, media_manifest, over_budget
+from bot.core import download_media, get_sciname
+from bot.data import (GenericError, birdList, database, goatsuckers, logger,
+                      screech_owls, songBirds, states)
+from bot.filters import Filter
+from bot.scheduler import BACKGROUND, download_priority
+
+PREFETCH_BATCH = int(os.getenv("SCIOLY_ID_BOT_PREFETCH_BATCH", 10))  # birds per run
+PREFETCH_CONCURRENCY = int(os.getenv("SCIOLY_ID_BOT_PREFETCH_CONCURRENCY", 2))
+PREFETCH_BANDWIDTH = int(
+    os.getenv("SCIOLY_ID_BOT_PREFETCH_BANDWIDTH", 1024 * 1024)
+)  # bytes per second
+TOP_BIRDS = 50  # number of popular birds to consider
+TOP_FILTERS = 3  # number of popular filter combinations to consider
+
+
+def _candidate_birds(media_type: str) -> List[str]:
+    """Returns birds likely to be requested next, most likely first."""
+    if media_type == "songs":
+        listed = set(songBirds).union(
+            *(state["songBirds"] for state in states.values())
+        )
+    else:
+        listed = set(birdList).union(*(state["birdList"] for state in states.values()))
+
+    popular = [
+        bird.decode("utf-8")
+        for bird in database.zrevrange("frequency.bird:global", 0, TOP_BIRDS - 1)
+    ]
+    special = goatsuckers + screech_owls if media_type == "images" else screech_owls
+
+    birds = []
+    seen = set()
+    for bird in popular + special + sorted(listed):
+        if bird in seen or bird == "Screech Owl":
+            # screech owl is a genus, send_bird picks a species
+            continue
+        seen.add(bird)
+        birds.append(bird)
+    return birds
+
+
+def _candidate_filters(media_type: str) -> List[Filter]:
+    """Returns the filter combinations used the most for a media type."""
+    used = [
+        Filter.from_int(filter_int)
+        for (media, filter_int), _ in cache_stats.filters.most_common()
+        if media == media_type
+    ][:TOP_FILTERS]
+    return used or [Filter()]
+
+
+def candidates() -> Iterator[Tuple[str, str, Filter]]:
+    """Yields (bird, media type, filters) tuples to prefetch, most likely first."""
+    for media_type in ("images", "songs"):
+        filter_list = _candidate_filters(media_type)
+        for bird in _candidate_birds(media_type):
+            for filters in filter_list:
+                yield (bird, media_type, filters)
+
+
+class Prefetcher:
+    """Keeps the media cache warm for birds that are likely to be requested.
+
+    At most `PREFETCH_CONCURRENCY` downloads run at once, and downloads
+    are spaced out to stay under `PREFETCH_BANDWIDTH` bytes per second.
+    Prefetching pauses while interactive downloads are in progress,
+    runs at background priority in the download scheduler,
+    and stops once the cache is over budget.
+    """
+
+    def __init__(self):
+        self._sem = None
+        self._next_start = 0.0
+        self.prefetched = 0
+        self.bytes = 0
+
+    async def _wait_turn(self):
+        while True:
+            delay = self._next_start - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif cache_stats.downloading:
+                # yield to interactive downloads
+                await asyncio.sleep(1)
+            else:
+                return
+
+    async def _prefetch_one(self, sciBird: str, media_type: str, filters: Filter):
+        async with self._sem:
+            await self._wait_turn()
+            key = cache_key(media_type, sciBird, filters.fetch_key(media_type))
+            if key in media_manifest:
+                return
+            logger.info(f"prefetching {media_type} for {sciBird}")
+            try:
+                filenames = await download_media(sciBird, media_type, filters)
+            except GenericError as e:
+                logger.info(f"prefetch failed: {e}")
+                return
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception(e)
+                capture_exception(e)
+                return
+            size = sum(
+                media_manifest.entry(filename)["size"]
+                for filename in filenames
+                if media_manifest.entry(filename) is not None
+            )
+            self.prefetched += 1
+            self.bytes += size
+            self._next_start = (
+                max(self._next_start, time.monotonic()) + size / PREFETCH_BANDWIDTH
+            )
+
+    async def run(self, batch: int = PREFETCH_BATCH):
+        """Prefetches up to `batch` uncached bird and filter combinations."""
+        logger.info("prefetching media")
+        # interactive downloads get download slots first
+        download_priority.set(BACKGROUND)
+        if over_budget():
+            logger.info("cache over budget, not prefetching")
+            return
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+        loop = asyncio.get_running_loop()
+        items = await loop.run_in_executor(None, lambda: list(candidates()))
+        tasks = []
+        for bird, media_type, filters in items:
+            if len(tasks) >= batch:
+                break
+            try:
+                sciBird = await get_sciname(bird)
+            except GenericError:
+                sciBird = bird
+            key = cache_key(media_type, sciBird, filters.fetch_key(media_type))
+            if key in media_manifest:
+                continue
+            tasks.append(self._prefetch_one(sciBird, media_type, filters))
+        await asyncio.gather(*tasks)
+        logger.info(f"prefetched {len(tasks)} items")
+
+    def info(self) -> dict:
+        return {"prefetched": self.prefetched, "bytes": self.bytes}
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,197 @@
+# scheduler.py | fair scheduling of media downloads
+# Copyright (C) 2019-2020  EraserBird, person_v1.32, hmmm
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import os
+from typing import Deque, Dict, Hashable, Optional, Tuple
+
+from bot.data import logger
+
+# media downloads running at once in each process
+DOWNLOAD_CONCURRENCY = int(os.getenv("SCIOLY_ID_BOT_DOWNLOAD_CONCURRENCY", 10))
+
+# priorities, lower runs first
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = ("interactive", "background")
+
+# who downloads are for, as a (guild, channel) tuple. Set at the
+# start of each command, and tasks started by the command inherit it.
+download_owner: contextvars.ContextVar = contextvars.ContextVar(
+    "download_owner", default=(None, None)
+)
+download_priority: contextvars.ContextVar = contextvars.ContextVar(
+    "download_priority", default=INTERACTIVE
+)
+# the batch download waiting downloads belong to, so joining a batch
+# with a higher priority can raise it with `FairScheduler.promote`
+download_group: contextvars.ContextVar = contextvars.ContextVar(
+    "download_group", default=None
+)
+
+
+class FairScheduler:
+    """Limits the number of downloads running at once, and shares them fairly.
+
+    Downloads wait for a slot once `limit` are running. Waiting downloads
+    with a higher priority always start first. Within a priority, guilds
+    take turns, and channels in a guild take turns, so one channel
+    downloading a lot of media doesn't delay everyone else.
+    Waiting downloads in a group can be moved to a higher priority
+    with `promote()`.
+    """
+
+    def __init__(self, limit: int = DOWNLOAD_CONCURRENCY):
+        self.limit = limit
+        self.active = 0
+        self.waited = 0
+        self.promoted = 0
+        # priority: {guild: {channel: waiting futures}}
+        self._queues = [collections.OrderedDict() for _ in PRIORITY_NAMES]
+        # waiting future: (group, priority, owner)
+        self._waiters: Dict[asyncio.Future, Tuple[Hashable, int, Tuple]] = {}
+
+    def _waiting(self) -> int:
+        return sum(
+            len(waiters)
+            for queue in self._queues
+            for channels in queue.values()
+            for waiters in channels.values()
+        )
+
+    def _next(self) -> Optional[asyncio.Future]:
+        """Removes and returns the next waiting download."""
+        for queue in self._queues:
+            while queue:
+                guild, channels = next(iter(queue.items()))
+                channel, waiters = next(iter(channels.items()))
+                future = waiters.popleft()
+                if waiters:
+                    channels.move_to_end(channel)
+                else:
+                    del channels[channel]
+                if channels:
+                    queue.move_to_end(guild)
+                else:
+                    del queue[guild]
+                if not future.done():
+                    return future
+        return None
+
+    def _remove(self, priority: int, owner: Tuple[Hashable, Hashable], future):
+        guild, channel = owner
+        channels = self._queues[priority].get(guild, {})
+        waiters: Deque = channels.get(channel, collections.deque())
+        with contextlib.suppress(ValueError):
+            waiters.remove(future)
+        if not waiters:
+            channels.pop(channel, None)
+        if not channels:
+            self._queues[priority].pop(guild, None)
+
+    def _enqueue(self, priority: int, owner: Tuple[Hashable, Hashable], future):
+        guild, channel = owner
+        channels = self._queues[priority].setdefault(guild, collections.OrderedDict())
+        channels.setdefault(channel, collections.deque()).append(future)
+
+    def _wake(self):
+        while self.active < self.limit:
+            future = self._next()
+            if future is None:
+                return
+            self.active += 1
+            future.set_result(None)
+
+    async def acquire(self, owner: Tuple[Hashable, Hashable] = None, priority: int = None):
+        """Waits for a download slot.
+
+        `owner` and `priority` default to the values set for the current command.
+        """
+        if owner is None:
+            owner = download_owner.get()
+        if priority is None:
+            priority = download_priority.get()
+        if self.active < self.limit and not self._waiting():
+            self.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(priority, owner, future)
+        self._waiters[future] = (download_group.get(), priority, owner)
+        self.waited += 1
+        logger.info(f"waiting for a download slot: {self.info()['queued']}")
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was given to this download before it was cancelled
+                self.release()
+            else:
+                # the priority may have changed while waiting
+                self._remove(self._waiters[future][1], owner, future)
+            raise
+        finally:
+            self._waiters.pop(future, None)
+
+    def promote(self, group: Hashable, priority: int) -> int:
+        """Moves waiting downloads in a group to a higher priority.
+
+        Returns the number of downloads moved.
+        """
+        moved = 0
+        for future, (other, current, owner) in list(self._waiters.items()):
+            if other != group or current <= priority or future.done():
+                continue
+            self._remove(current, owner, future)
+            self._enqueue(priority, owner, future)
+            self._waiters[future] = (group, priority, owner)
+            moved += 1
+        self.promoted += moved
+        return moved
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, owner: Tuple[Hashable, Hashable] = None, priority: int = None):
+        """Async context manager that holds a download slot."""
+        await self.acquire(owner, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def info(self) -> dict:
+        queued = {
+            name: sum(
+                len(waiters) for channels in queue.values() for waiters in channels.values()
+            )
+            for name, queue in zip(PRIORITY_NAMES, self._queues)
+        }
+        return {
+            "active": self.active,
+            "limit": self.limit,
+            "queued": queued,
+            "waited": self.waited,
+            "promoted": self.promoted,
+        }
+
+
+download_scheduler = FairScheduler()
@@ -0,0 +1,130 @@
+# taxonomy.py | builds the bundled taxonomy table
+# Copyright (C) 2019-2020  EraserBird, person_v1.32, hmmm
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Builds `bot/data/taxonomy.csv` from the bundled lists and eBird.
+
+Usage: python -m bot.taxonomy [--offline]
+
+With `--offline`, the table is rebuilt from `alpha.txt` and
+`sciListMaster.txt`, keeping taxon codes from the existing table.
+Otherwise, the eBird taxonomy is downloaded in one request
+to fill in taxon codes and names for every bird in `birdListMaster`.
+"""
+
+import asyncio
+import csv
+import datetime
+import string
+import sys
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from bot.data import (alpha_codes, birdListMaster, logger, taxonomy,
+                      taxonomy_key, taxonomy_version)
+
+TAXONOMY_PATH = "bot/data/taxonomy.csv"
+EBIRD_TAXONOMY_URL = "https://api.ebird.org/v2/ref/taxonomy/ebird?fmt=json&cat=species"
+EBIRD_VERSIONS_URL = "https://api.ebird.org/v2/ref/taxa-versions"
+FIELDS = ("common", "scientific", "taxon_code", "alpha")
+
+
+def _local_rows() -> List[Dict[str, str]]:
+    """Returns table rows from the bundled alpha code and scientific name lists."""
+    rows = []
+    # sciListMaster is capitalized, so read the original names
+    with open("bot/data/sciListMaster.txt", "r") as f:
+        sci_names = [line.strip() for line in f]
+    with open("bot/data/alpha.txt", "r") as f:
+        for (bird, code), sci in zip(csv.reader(f), sci_names):
+            existing = taxonomy.get(taxonomy_key(sci), {})
+            rows.append(
+                {
+                    "common": bird.strip(),
+                    "scientific": sci,
+                    "taxon_code": existing.get("taxon_code", ""),
+                    "alpha": code.strip().upper(),
+                }
+            )
+    return rows
+
+
+async def _fetch_ebird():
+    """Returns the eBird species taxonomy and its version."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(EBIRD_TAXONOMY_URL) as response:
+            response.raise_for_status()
+            data = await response.json()
+        async with session.get(EBIRD_VERSIONS_URL) as response:
+            response.raise_for_status()
+            versions = await response.json()
+    version = next(
+        (str(item["authorityVer"]) for item in versions if item.get("latest")), None
+    )
+    return data, version
+
+
+def build(offline: bool = False) -> Optional[str]:
+    """Writes the taxonomy table and returns its version."""
+    rows = _local_rows()
+    version = taxonomy_version
+    if not offline:
+        logger.info("fetching ebird taxonomy")
+        data, ebird_version = asyncio.run(_fetch_ebird())
+        by_name = {}
+        for item in data:
+            by_name[taxonomy_key(item["sciName"])] = item
+            by_name.setdefault(taxonomy_key(item["comName"]), item)
+
+        for row in rows:
+            item = by_name.get(taxonomy_key(row["scientific"])) or by_name.get(
+                taxonomy_key(row["common"])
+            )
+            if item is None:
+                logger.info(f"{row['common']} not found in ebird taxonomy")
+                continue
+            row["scientific"] = item["sciName"]
+            row["taxon_code"] = item["speciesCode"]
+
+        # birds in the lists that aren't in alpha.txt
+        known = {taxonomy_key(row["common"]) for row in rows}
+        for bird in sorted(birdListMaster):
+            item = by_name.get(taxonomy_key(bird))
+            if taxonomy_key(bird) in known or item is None:
+                continue
+            rows.append(
+                {
+                    "common": item["comName"],
+                    "scientific": item["sciName"],
+                    "taxon_code": item["speciesCode"],
+                    "alpha": alpha_codes.get(string.capwords(bird), ""),
+                }
+            )
+        version = f"ebird-{ebird_version}-{datetime.date.today().isoformat()}"
+
+    missing = [row["common"] for row in rows if not row["taxon_code"]]
+    logger.info(f"{len(rows)} birds, {len(missing)} without taxon codes")
+    with open(TAXONOMY_PATH, "w", newline="") as f:
+        f.write("# generated by python -m bot.taxonomy, do not edit\n")
+        f.write(f"# version: {version or 'local'}\n")
+        writer = csv.DictWriter(f, fieldnames=FIELDS, lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    return version
+
+
+if __name__ == "__main__":
+    print(f"taxonomy version: {build(offline='--offline' in sys.argv)}")
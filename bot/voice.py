@@ -15,12 +15,31 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
+import mmap
+import os
+import struct
+import threading
 from typing import Optional
 
 import discord
 import discord.utils
+from sentry_sdk import capture_exception
 
-from bot.data import logger, database
+from bot.cache import media_manifest, variant_path
+from bot.data import logger, async_database
+
+# opus packet store format:
+# header: magic (4 bytes), number of packets (uint32)
+# index: number of packets + 1 offsets (uint32) from the start of the packet data
+# data: opus packets, each 20ms of audio
+PACKET_MAGIC = b"OPK1"
+HEADER = struct.Struct("<4sI")
+OFFSET = struct.Struct("<I")
+
+# streamed songs keep 10 seconds of packets ahead and 30 seconds behind
+BUFFER_PACKETS = 50 * 10
+SEEK_BACK_PACKETS = 50 * 30
 
 
 async def _send(ctx, silent, message: str):
@@ -42,7 +61,7 @@ async def get_voice_client(
             )
             return None
 
-    current_voice = database.get(f"voice.server:{ctx.guild.id}")
+    current_voice = await async_database.get(f"voice.server:{ctx.guild.id}")
     if current_voice is not None and current_voice.decode("utf-8") != str(
         ctx.channel.id
     ):
@@ -89,6 +108,13 @@ async def get_voice_client(
     return client
 
 
+def _time_remaining(t: Optional[int]) -> str:
+    """Formats the seconds left in a song, which are None if the length is unknown."""
+    if t is None:
+        return "time remaining unknown"
+    return f"{t//3600:0>2}:{(t//60)%60:0>2}:{t%60:0>2} remaining"
+
+
 async def play(ctx, filename: Optional[str], silent: bool = False):
     logger.info("voice: playing")
 
@@ -101,13 +127,11 @@ async def play(ctx, filename: Optional[str], silent: bool = False):
         await _send(
             ctx,
             silent,
-            f"**Resumed playing.** `{t//3600:0>2}:{(t//60)%60:0>2}:{t%60:0>2} remaining`",
+            f"**Resumed playing.** `{_time_remaining(t)}`",
         )
         return True
     if filename:
-        # source = await discord.FFmpegOpusAudio.from_probe(filename)
-        # source = CustomAudio(filename)
-        source = await CustomFFmpegAudio.from_probe(filename)
+        source = await audio_source(filename)
         if client.is_playing():
             client.stop()
         client.play(source)
@@ -115,7 +139,7 @@ async def play(ctx, filename: Optional[str], silent: bool = False):
         await _send(
             ctx,
             silent,
-            f"**Playing...** `{t//3600:0>2}:{(t//60)%60:0>2}:{t%60:0>2} remaining`",
+            f"**Playing...** `{_time_remaining(t)}`",
         )
     else:
         await _send(ctx, silent, "**There's nothing playing!**")
@@ -180,9 +204,9 @@ async def rel_seek(ctx, seconds: Optional[int], silent: bool = False):
             ctx,
             silent,
             (
-                f"**Skipped {'forward' if seconds > 0 else 'back'} {abs(seconds)} seconds!** `{t//3600:0>2}:{(t//60)%60:0>2}:{t%60:0>2} remaining`"
+                f"**Skipped {'forward' if seconds > 0 else 'back'} {abs(seconds)} seconds!** `{_time_remaining(t)}`"
                 if seconds
-                else f"**Restarted from beginning.** `{t//3600:0>2}:{(t//60)%60:0>2}:{t%60:0>2} remaining`"
+                else f"**Restarted from beginning.** `{_time_remaining(t)}`"
             ),
         )
     else:
@@ -203,7 +227,7 @@ async def cleanup(bot):
     for client in bot.voice_clients:
         if len(client.channel.voice_states) == 1:
             logger.info("found empty")
-            current_voice = database.get(f"voice.server:{client.guild.id}")
+            current_voice = await async_database.get(f"voice.server:{client.guild.id}")
             if current_voice is not None:
                 logger.info("vc race")
                 bound_channel = client.guild.get_channel(int(current_voice))
@@ -214,20 +238,259 @@ async def cleanup(bot):
     logger.info("done cleaning!")
 
 
-class CustomFFmpegAudio(discord.FFmpegOpusAudio):
-    def __init__(self, filename, bitrate, codec):
-        super().__init__(filename, bitrate=bitrate, codec=codec)
-        self._data_list_ = list(self._packet_iter)
-        self._data_list_.append(b"")
+class CustomFFmpegAudio(discord.AudioSource):
+    """Streams a song from ffmpeg, buffering packets in a background thread.
+
+    Playback starts as soon as ffmpeg produces the first packets.
+    At most `BUFFER_PACKETS` packets are read ahead, and the last
+    `SEEK_BACK_PACKETS` played packets are kept for seeking backwards.
+    Seeking outside of the buffered packets restarts ffmpeg at the new position.
+
+    If `packet_path` is set, the packets are saved to a packet store
+    once ffmpeg finishes, unless it was restarted by seeking.
+
+    `duration` (float) - length of the song in seconds, if known.
+    Otherwise, the length is None until ffmpeg finishes.\n
+    `packet_path` (str) - where to save the packet store
+    """
+
+    def __init__(self, filename, bitrate, codec, duration=None, packet_path=None):
+        self.filename = filename
+        self.bitrate = bitrate
+        self.codec = codec
+        self._duration = duration
+        self._packet_path = packet_path
+        # every packet from the start of the song, if it is being saved
+        self._recorded = [] if packet_path else None
+        self._cond = threading.Condition()
+        self._ahead = collections.deque()
+        self._history = collections.deque(maxlen=SEEK_BACK_PACKETS)
+        self._cursor = 0  # index of the next packet to play
+        self._total = None  # number of packets, once ffmpeg finishes
+        self._eof = False
+        self._generation = 0
+        self._source = None
+        with self._cond:
+            self._start(0)
+
+    def _start(self, position: int):
+        """Restarts ffmpeg at a packet index. The lock must be held."""
+        self._generation += 1
+        if self._generation > 1:
+            # the packets from the restarted ffmpeg aren't all of the song
+            self._recorded = None
+        old_source = self._source
+        self._ahead.clear()
+        self._history.clear()
+        self._eof = False
+        self._cursor = position
+        self._source = discord.FFmpegOpusAudio(
+            self.filename,
+            bitrate=self.bitrate,
+            codec=self.codec,
+            before_options=f"-ss {position * 0.02:.2f}" if position else None,
+        )
+        threading.Thread(
+            target=self._reader,
+            args=(self._source, self._generation, position),
+            daemon=True,
+        ).start()
+        if old_source is not None:
+            old_source.cleanup()
+
+    def _reader(self, source, generation: int, index: int):
+        while True:
+            with self._cond:
+                while (
+                    len(self._ahead) >= BUFFER_PACKETS
+                    and self._generation == generation
+                ):
+                    self._cond.wait()
+                if self._generation != generation:
+                    return
+            try:
+                packet = source.read()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.info(f"error reading from ffmpeg: {e}")
+                packet = b""
+            with self._cond:
+                if self._generation != generation:
+                    return
+                if not packet:
+                    self._eof = True
+                    self._total = index
+                    recorded, self._recorded = self._recorded, None
+                    self._cond.notify_all()
+                    break
+                self._ahead.append(packet)
+                if self._recorded is not None:
+                    self._recorded.append(packet)
+                index += 1
+                self._cond.notify_all()
+        if recorded:
+            self._save(recorded)
+
+    def _save(self, packets):
+        try:
+            size = save_packets(self._packet_path, packets)
+        except Exception as e:  # pylint: disable=broad-except
+            capture_exception(e)
+            logger.exception(e)
+            return
+        media_manifest.add_variant(self.filename, "opus", size)
+        logger.info(f"saved opus packets for {self.filename}")
+
+    def _packets(self) -> Optional[int]:
+        """Returns the number of packets in the song, or None if it isn't known yet."""
+        if self._total is not None:
+            return self._total
+        if self._duration:
+            return round(self._duration * 50)
+        return None
+
+    def is_opus(self):
+        return True
+
+    @property
+    def length(self):
+        packets = self._packets()
+        if packets is None:
+            return None
+        return round((packets + 1) * 0.02)
+
+    @property
+    def remaining(self):
+        packets = self._packets()
+        if packets is None:
+            return None
+        return max(round((packets + 1 - self._cursor) * 0.02), 0)
+
+    def jump(self, seconds: Optional[int]):
+        with self._cond:
+            if seconds is None:
+                target = 0
+            else:
+                # each cursor tick is 20ms, convert seconds to 20ms chunks
+                target = max(self._cursor + seconds * 50, 0)
+            if self._total is not None:
+                target = min(target, self._total)
+
+            delta = target - self._cursor
+            if delta < 0 and -delta <= len(self._history):
+                for _ in range(-delta):
+                    self._ahead.appendleft(self._history.pop())
+                self._cursor = target
+            elif 0 <= delta <= len(self._ahead):
+                for _ in range(delta):
+                    self._history.append(self._ahead.popleft())
+                self._cursor = target
+            elif self._eof and delta > 0:
+                # skipped past the end
+                self._ahead.clear()
+                self._cursor = target
+            else:
+                self._start(target)
+            self._cond.notify_all()
+        return self
+
+    def read(self):
+        with self._cond:
+            while not self._ahead and not self._eof:
+                self._cond.wait()
+            if not self._ahead:
+                return b""
+            packet = self._ahead.popleft()
+            self._history.append(packet)
+            self._cursor += 1
+            self._cond.notify_all()
+            return packet
+
+    def cleanup(self):
+        with self._cond:
+            self._generation += 1
+            self._recorded = None
+            source, self._source = self._source, None
+            self._cond.notify_all()
+        if source is not None:
+            source.cleanup()
+
+
+def save_packets(path: str, packets) -> int:
+    """Saves opus packets to a packet store, returns the size of the store."""
+    offsets = [0]
+    for packet in packets:
+        offsets.append(offsets[-1] + len(packet))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(PACKET_MAGIC, len(packets)))
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        for packet in packets:
+            f.write(packet)
+    os.replace(temp_path, path)
+    return os.stat(path).st_size
+
+
+async def _probe(filename: str):
+    """Returns the codec, bitrate, and duration of a song."""
+    entry = media_manifest.entry(filename)
+    if entry is not None and entry.get("codec") and entry.get("bitrate"):
+        # use the values probed when the song was downloaded
+        return entry["codec"], entry["bitrate"], entry.get("duration")
+    codec, bitrate = await discord.FFmpegOpusAudio.probe(filename)
+    return codec, bitrate, None
+
+
+def _open_packets(path: str) -> Optional["PackedOpusAudio"]:
+    if not os.path.exists(path):
+        return None
+    return PackedOpusAudio(path)
+
+
+async def audio_source(filename: str):
+    """Returns an audio source for a cached song.
+
+    Songs are encoded to opus once and saved in the variant store,
+    so later plays don't need to run ffmpeg. The first time a song
+    is played, the packets are saved as they are streamed.
+    """
+    path = variant_path(filename, "opus")
+    loop = asyncio.get_running_loop()
+    source = await loop.run_in_executor(None, _open_packets, path)
+    if source is not None:
+        return source
+    codec, bitrate, duration = await _probe(filename)
+    return CustomFFmpegAudio(filename, bitrate, codec, duration, packet_path=path)
+
+
+class PackedOpusAudio(discord.AudioSource):
+    """Plays opus packets from a packet store created by `save_packets`.
+
+    The file is memory mapped, so sources playing the same
+    song share memory, and seeking is done by changing the index.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = HEADER.unpack_from(self._data, 0)
+        if magic != PACKET_MAGIC:
+            self._data.close()
+            raise ValueError(f"{path} is not an opus packet store")
+        self._index = HEADER.size
+        self._start = self._index + OFFSET.size * (self._count + 1)
         self._cursor = 0
 
+    def is_opus(self):
+        return True
+
     @property
     def length(self):
-        return round(len(self._data_list_) * 0.02)
+        return round((self._count + 1) * 0.02)
 
     @property
     def remaining(self):
-        return round((len(self._data_list_) - self._cursor) * 0.02)
+        return round((self._count + 1 - self._cursor) * 0.02)
 
     def jump(self, seconds: Optional[int]):
         if seconds is None:
@@ -235,14 +498,18 @@ class CustomFFmpegAudio(discord.FFmpegOpusAudio):
             return self
 
         seconds *= 50  # each cursor tick is 20ms, convert seconds to 20ms chunks
-        if self._cursor + seconds < 0:
-            self._cursor = 0
-        elif self._cursor + seconds > len(self._data_list_):
-            self._cursor = len(self._data_list_)
-        else:
-            self._cursor += seconds
+        self._cursor = min(max(self._cursor + seconds, 0), self._count + 1)
         return self
 
     def read(self):
+        if self._cursor >= self._count:
+            self._cursor = self._count + 1
+            return b""
+        position = self._index + OFFSET.size * self._cursor
+        start, end = struct.unpack_from("<II", self._data, position)
         self._cursor += 1
-        return self._data_list_[self._cursor - 1]
+        return self._data[self._start + start : self._start + end]
+
+    def cleanup(self):
+        self._data.close()
+        super().cleanup()
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import pytest
+
+from bot.async_redis import AsyncRedis
+from bot.data import database
+
+KEY = "test.async_redis"
+
+
+class TestAsyncRedis:
+    @pytest.yield_fixture(autouse=True)
+    def test_suite_cleanup_thing(self):
+        yield
+        database.delete(KEY, f"{KEY}:1", f"{KEY}:2")
+
+    def setup(self):
+        # pylint: disable=attribute-defined-outside-init
+        self.database = AsyncRedis(database, workers=2, timeout=5)
+
+    def test_command(self):
+        self.setup()
+        assert asyncio.run(self.database.set(KEY, "value"))
+        assert asyncio.run(self.database.get(KEY)) == b"value"
+
+    def test_pipeline(self):
+        self.setup()
+        pipe = self.database.pipeline(transaction=False)
+        pipe.set(KEY, 1)
+        pipe.incr(KEY)
+        assert len(pipe) == 2
+        assert asyncio.run(pipe.execute()) == [True, 2]
+
+    def test_script(self):
+        self.setup()
+        script = self.database.register_script(
+            "return redis.call('INCRBY', KEYS[1], ARGV[1])"
+        )
+        assert asyncio.run(script(keys=[KEY], args=[3])) == 3
+
+    def test_scan_keys(self):
+        self.setup()
+        database.set(f"{KEY}:1", 1)
+        database.set(f"{KEY}:2", 2)
+        keys = asyncio.run(self.database.scan_keys(f"{KEY}:*"))
+        assert sorted(keys) == [f"{KEY}:1".encode(), f"{KEY}:2".encode()]
+
+    def test_loop_not_blocked(self):
+        self.setup()
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        async def wait():
+            ticker = asyncio.ensure_future(tick())
+            await self.database.run(time.sleep, 0.2)
+            ticker.cancel()
+
+        asyncio.run(wait())
+        assert ticks > 5
@@ -0,0 +1,222 @@
+import os
+import time
+
+import pytest
+
+import bot.cache
+from bot.cache import (KeyLock, MediaManifest, cache_key, clean_staging,
+                       evict_cache, eviction_order, media_entry, media_manifest,
+                       variant_path)
+from bot.data import database
+
+
+class TestManifest:
+    @pytest.fixture(autouse=True)
+    def setup_manifest(self, tmp_path):
+        # pylint: disable=attribute-defined-outside-init
+        self.manifest = MediaManifest(str(tmp_path / "manifest.json"), owner=True)
+        self.path = str(tmp_path / "0.jpg")
+        with open(self.path, "wb") as f:
+            f.write(b"\xff" * 100)
+
+    def test_entry_from_disk(self):
+        entry = media_entry(self.path)
+        assert entry["size"] == 100
+        assert entry["extension"] == "jpg"
+        assert entry["content_type"] == "image/jpeg"
+
+    def test_set_and_get(self):
+        key = cache_key("images", "Branta canadensis", 123)
+        assert self.manifest.get(key) is None
+
+        self.manifest.set(key, [media_entry(self.path, "image/jpeg", 100)])
+        assert key in self.manifest
+        assert self.manifest.get(key)[0]["path"] == self.path
+        assert self.manifest.entry(self.path)["size"] == 100
+
+        self.manifest.remove(key)
+        assert self.manifest.get(key) is None
+        assert self.manifest.entry(self.path) is None
+
+    def test_save_and_load(self):
+        key = cache_key("songs", "Branta canadensis", 0)
+        self.manifest.set(key, [media_entry(self.path, "image/jpeg", 100)])
+        self.manifest.save()
+        assert os.path.exists(self.manifest.path)
+
+        loaded = MediaManifest(self.manifest.path)
+        loaded.load()
+        assert loaded.get(key) == self.manifest.get(key)
+        assert loaded.entry(self.path)["content_type"] == "image/jpeg"
+
+    def test_loads_on_first_use(self):
+        key = cache_key("songs", "Branta canadensis", 0)
+        self.manifest.set(key, [media_entry(self.path, "image/jpeg", 100)])
+        self.manifest.save()
+
+        loaded = MediaManifest(self.manifest.path)
+        assert key in loaded
+        assert loaded.total_size == 100
+
+    def test_save_not_owner(self):
+        self.manifest.owner = False
+        self.manifest.set(cache_key("images", "Branta canadensis", 0), [])
+        self.manifest.save()
+        assert not os.path.exists(self.manifest.path)
+
+    def test_find_missing(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(bot.cache, "CACHE_DIR", str(tmp_path))
+        key = cache_key("images", "Branta canadensis", 0)
+        os.makedirs(tmp_path / key)
+        kept = str(tmp_path / key / "1.jpg")
+        with open(kept, "wb") as f:
+            f.write(b"\xff" * 10)
+        removed = media_entry(str(tmp_path / key / "0.jpg"), "image/jpeg", 100)
+        self.manifest.set(key, [removed, media_entry(kept)])
+
+        assert [entry["path"] for entry in self.manifest.find(key)] == [kept]
+        assert self.manifest.entry(removed["path"]) is None
+
+        os.remove(kept)
+        assert self.manifest.find(key) == []
+        assert key not in self.manifest
+
+    def test_find_populating(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(bot.cache, "CACHE_DIR", str(tmp_path))
+        monkeypatch.setattr(bot.cache, "LOCK_DIR", str(tmp_path / "locks"))
+        key = cache_key("images", "Branta canadensis", 0)
+        os.makedirs(tmp_path / key)
+        with open(tmp_path / key / "0.jpg", "wb") as f:
+            f.write(b"\xff" * 10)
+
+        lock = KeyLock(key)
+        assert lock.acquire()
+        assert self.manifest.find(key) == []
+        assert len(self.manifest.scan(key, store=False)) == 1
+        assert key not in self.manifest
+        lock.release()
+        assert len(self.manifest.find(key)) == 1
+        assert key in self.manifest
+
+    def test_variants(self, tmp_path):
+        key = cache_key("images", "Branta canadensis", 0)
+        self.manifest.set(key, [media_entry(self.path, "image/jpeg", 100)])
+        assert not self.manifest.has_variant(self.path, "bw")
+        assert variant_path(self.path, "bw") == str(tmp_path / ".variants" / "0.bw.png")
+
+        self.manifest.add_variant(self.path, "bw", 50)
+        assert self.manifest.has_variant(self.path, "bw")
+        assert self.manifest.total_size == 150
+        assert self.manifest.remove(key) == 150
+        assert self.manifest.total_size == 0
+
+
+class TestEviction:
+    def test_eviction_order(self, tmp_path):
+        path = str(tmp_path / "0.jpg")
+        old_key = cache_key("images", "Mock birdus", 0)
+        new_key = cache_key("images", "Mock birdus", 1)
+        old_entry = media_entry(path, "image/jpeg", 100)
+        new_entry = media_entry(path + ".new", "image/jpeg", 100)
+        old_entry["last_served"] -= 3600 * 24
+        new_entry["hits"] = 5
+
+        media_manifest.set(old_key, [old_entry])
+        media_manifest.set(new_key, [new_entry])
+        try:
+            order = eviction_order()
+            assert order.index(old_key) < order.index(new_key)
+        finally:
+            media_manifest.remove(old_key)
+            media_manifest.remove(new_key)
+
+    def test_hyphenated_frequency(self, tmp_path):
+        path = str(tmp_path / "0.jpg")
+        shown_key = cache_key("images", "Dendrocygna autumnalis", 0)
+        other_key = cache_key("images", "Dendrocygna bicolor", 0)
+        media_manifest.set(shown_key, [media_entry(path, "image/jpeg", 100)])
+        media_manifest.set(other_key, [media_entry(path + ".1", "image/jpeg", 100)])
+        bird = "Black-bellied Whistling-duck"
+        database.zincrby("frequency.bird:global", 50, bird)
+        try:
+            order = eviction_order()
+            assert order.index(other_key) < order.index(shown_key)
+        finally:
+            database.zincrby("frequency.bird:global", -50, bird)
+            media_manifest.remove(shown_key)
+            media_manifest.remove(other_key)
+
+
+    def test_evict_removes_lock(self, tmp_path, monkeypatch):
+        manifest = MediaManifest(str(tmp_path / "manifest.json"), owner=True)
+        monkeypatch.setattr(bot.cache, "media_manifest", manifest)
+        monkeypatch.setattr(bot.cache, "CACHE_DIR", str(tmp_path))
+        monkeypatch.setattr(bot.cache, "LOCK_DIR", str(tmp_path / "locks"))
+        monkeypatch.setattr(bot.cache, "CACHE_BUDGET", 100)
+        key = cache_key("images", "Mock birdus", 0)
+        os.makedirs(tmp_path / key)
+        path = str(tmp_path / key / "0.jpg")
+        with open(path, "wb") as f:
+            f.write(b"\xff" * 200)
+        manifest.set(key, [media_entry(path)])
+        lock = KeyLock(key)
+        assert lock.acquire()
+        lock.release()
+
+        assert evict_cache() == 200
+        assert not os.path.exists(tmp_path / key)
+        assert not os.path.exists(lock.path)
+
+
+class TestKeyLock:
+    def test_lock(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(bot.cache, "LOCK_DIR", str(tmp_path))
+        key = cache_key("images", "Branta canadensis", 123)
+        lock = KeyLock(key)
+        other = KeyLock(key)
+        assert not other.populating()
+        assert lock.acquire()
+        assert other.populating()
+        assert not other.acquire()
+        lock.release()
+        assert not other.populating()
+        assert other.acquire()
+        other.release()
+
+    def test_remove(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(bot.cache, "LOCK_DIR", str(tmp_path))
+        key = cache_key("images", "Branta canadensis", 123)
+        lock = KeyLock(key)
+        assert not lock.populating()
+        assert not os.path.exists(lock.path)
+        assert lock.acquire()
+        lock.release(remove=True)
+        assert not os.path.exists(lock.path)
+
+    def test_acquire_removed_file(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(bot.cache, "LOCK_DIR", str(tmp_path))
+        key = cache_key("images", "Branta canadensis", 123)
+        lock = KeyLock(key)
+        other = KeyLock(key)
+        assert lock.acquire()
+        lock.release(remove=True)
+        assert other.acquire()
+        assert os.path.exists(other.path)
+        assert KeyLock(key).populating()
+        other.release()
+
+    def test_clean_stale_locks(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(bot.cache, "LOCK_DIR", str(tmp_path / "locks"))
+        monkeypatch.setattr(bot.cache, "STAGING_DIR", str(tmp_path / "staging"))
+        held = KeyLock(cache_key("images", "Branta canadensis", 0))
+        stale = KeyLock(cache_key("images", "Branta canadensis", 1))
+        assert held.acquire()
+        assert stale.acquire()
+        stale.release()
+        old = time.time() - 7 * 86400
+        for lock in (held, stale):
+            os.utime(lock.path, (old, old))
+        clean_staging()
+        assert os.path.exists(held.path)
+        assert not os.path.exists(stale.path)
+        held.release()
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+import bot.core
+from bot.catalog import PAGE_SIZE, CatalogIndex
+from bot.filters import Filter
+
+
+def items(start, stop, rating=4):
+    return [
+        {
+            "assetId": i,
+            "mediaUrl": f"https://example.com/{i}/large",
+            "previewUrl": f"https://example.com/{i}/preview",
+            "rating": rating,
+        }
+        for i in range(start, stop)
+    ]
+
+
+class TestCatalogIndex:
+    @pytest.fixture(autouse=True)
+    def setup_index(self, tmp_path):
+        # pylint: disable=attribute-defined-outside-init
+        self.index = CatalogIndex(str(tmp_path / "catalog.sqlite3"))
+
+    def test_not_indexed(self):
+        assert self.index.urls("baleag", "p", Filter()) is None
+
+    def test_least_recently_used(self):
+        self.index.add("baleag", "p", Filter(), items(0, 25))
+        first = self.index.urls("baleag", "p", Filter())
+        second = self.index.urls("baleag", "p", Filter())
+        assert len(first) == len(second) == 10
+        assert not set(first) & set(second)
+        assert first[0] == "https://example.com/0/preview"
+
+    def test_large(self):
+        self.index.add("baleag", "p", Filter(), items(0, 5))
+        urls = self.index.urls("baleag", "p", Filter(large=True))
+        assert urls[0].endswith("/large")
+
+    def test_superset(self):
+        self.index.add(
+            "baleag", "p", Filter(), items(0, 5, 3) + items(5, 10, 5), complete=True
+        )
+        urls = self.index.urls("baleag", "p", Filter(quality="5"))
+        assert len(urls) == 5
+        assert all(int(url.split("/")[3]) >= 5 for url in urls)
+        # a broader query can't be answered by a narrower one
+        assert self.index.urls("baleag", "p", Filter(quality="2 3 4 5")) is None
+        # other filters need their own query
+        assert self.index.urls("baleag", "p", Filter(age="a")) is None
+
+    def test_incomplete_superset(self):
+        # the matching results may be on pages that weren't fetched
+        self.index.add("baleag", "p", Filter(), items(0, 5, 5))
+        assert self.index.urls("baleag", "p", Filter(quality="3")) is None
+
+    def test_empty_superset(self):
+        self.index.add("baleag", "p", Filter(), items(0, 5, 5), complete=True)
+        assert self.index.urls("baleag", "p", Filter(quality="3")) is None
+        assert self.index.misses == 1
+
+
+class TestGetUrls:
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self, tmp_path, monkeypatch):
+        # pylint: disable=attribute-defined-outside-init
+        self.index = CatalogIndex(str(tmp_path / "catalog.sqlite3"))
+        self.requests = []
+        self.release = None
+
+        async def get_taxon(bird, session=None):
+            return ("baleag", bird)
+
+        async def get_json(url, session=None):
+            self.requests.append(url)
+            page = len(self.requests) - 1
+            if page > 0:
+                await self.release.wait()
+            return {
+                "results": {
+                    "content": items(page * PAGE_SIZE, (page + 1) * PAGE_SIZE),
+                    "nextCursorMark": f"page{page + 1}" if page < 1 else None,
+                }
+            }
+
+        monkeypatch.setattr(bot.core, "get_taxon", get_taxon)
+        monkeypatch.setattr(bot.core.http_client, "get_json", get_json)
+        monkeypatch.setattr(bot.core, "catalog_index", self.index)
+        monkeypatch.setattr(bot.core, "MAX_PAGES", 3)
+
+    def test_first_page_then_background(self):
+        async def run():
+            self.release = asyncio.Event()
+            urls = await bot.core._get_urls(None, "Bald Eagle", "p", Filter())
+            assert len(urls) == 10  # before the second page has loaded
+            db = self.index._connect()  # pylint: disable=protected-access
+            assert db.execute("SELECT total, complete FROM queries").fetchone() == (
+                PAGE_SIZE,
+                0,
+            )
+            self.release.set()
+            for _ in range(50):
+                await asyncio.sleep(0.01)
+                if db.execute("SELECT complete FROM queries").fetchone()[0]:
+                    break
+            return db.execute("SELECT total, complete FROM queries").fetchone()
+
+        assert asyncio.run(run()) == (PAGE_SIZE * 2, 1)
+        assert "initialCursorMark=page1" in self.requests[1]
@@ -81,3 +81,36 @@ class TestCheck:
             self.ctx.messages[2].content
             == f"Sorry, the bird was actually {test_word.lower()}."
         )
+
+    def test_check_records_correct(self):
+        self.setup(guild=True)
+        test_word = "Canada Goose"
+        database.hset(f"channel:{self.ctx.channel.id}", "bird", test_word)
+
+        coroutine = self.cog.check.callback(  # pylint: disable=no-member
+            self.cog, self.ctx, arg=test_word
+        )
+        asyncio.run(coroutine)
+        user_id = str(self.ctx.author.id)
+        assert database.hget(f"channel:{self.ctx.channel.id}", "bird") == b""
+        assert database.zscore("users:global", user_id) == 1
+        assert database.zscore("streak:global", user_id) == 1
+        assert database.zscore("streak.max:global", user_id) == 1
+        assert database.zscore(f"correct.user:{user_id}", test_word) == 1
+        assert database.zscore(f"users.server:{self.ctx.guild.id}", user_id) == 1
+
+    def test_check_records_incorrect(self):
+        self.setup(guild=True)
+        test_word = "Canada Goose"
+        database.hset(f"channel:{self.ctx.channel.id}", "bird", test_word)
+        database.zadd("streak:global", {str(self.ctx.author.id): 3})
+
+        coroutine = self.cog.check.callback(  # pylint: disable=no-member
+            self.cog, self.ctx, arg=test_word * 2
+        )
+        asyncio.run(coroutine)
+        user_id = str(self.ctx.author.id)
+        assert database.hget(f"channel:{self.ctx.channel.id}", "bird") == b""
+        assert database.zscore("streak:global", user_id) == 0
+        assert database.zscore(f"incorrect.user:{user_id}", test_word) == 1
+        assert database.zscore(f"incorrect.server:{self.ctx.guild.id}", test_word) == 1
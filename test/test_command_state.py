@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import discord_mock as mock
+from bot.command_state import CommandState
+from bot.data import database
+
+
+class TestCommandState:
+    @pytest.yield_fixture(autouse=True)
+    def test_suite_cleanup_thing(self):
+        yield
+        database.delete(
+            f"channel:{self.ctx.channel.id}",
+            f"race.data:{self.ctx.channel.id}",
+            f"session.data:{self.ctx.author.id}",
+        )
+
+    def setup(self):
+        # pylint: disable=attribute-defined-outside-init
+        self.ctx = mock.Context(mock.Bot())
+        database.hset(
+            f"channel:{self.ctx.channel.id}",
+            mapping={"bird": "Canada Goose", "answered": 0, "prevB": "", "prevJ": 20},
+        )
+
+    def test_load_channel(self):
+        self.setup()
+        state = asyncio.run(CommandState.load(self.ctx))
+        assert state.channel.bird == "Canada Goose"
+        assert state.channel.answered == 0
+        assert state.channel.prevJ == 20
+        assert state.race is None
+        assert state.session is None
+
+    def test_load_race_session(self):
+        self.setup()
+        database.hset(
+            f"race.data:{self.ctx.channel.id}",
+            mapping={"limit": 5, "filter": 3, "media": "songs", "strict": "strict"},
+        )
+        database.hset(
+            f"session.data:{self.ctx.author.id}", mapping={"total": 2, "wiki": ""}
+        )
+        state = asyncio.run(CommandState.load(self.ctx))
+        assert state.race.limit == 5
+        assert state.race.filter == 3
+        assert state.race.media == "songs"
+        assert state.race.strict
+        assert not state.race.alpha
+        assert state.session.total == 2
+        assert not state.session.wiki
+
+    def test_slots(self):
+        self.setup()
+        state = asyncio.run(CommandState.load(self.ctx))
+        with pytest.raises(AttributeError):
+            state.channel.unknown = 1
+
+    def test_save(self):
+        self.setup()
+        database.hset(f"session.data:{self.ctx.author.id}", "total", 2)
+        state = asyncio.run(CommandState.load(self.ctx))
+        state.channel.update(bird="Bald Eagle", answered=1)
+        state.session.increment("total")
+        database.hincrby(f"session.data:{self.ctx.author.id}", "total", 1)
+        asyncio.run(state.save())
+        assert database.hget(f"channel:{self.ctx.channel.id}", "bird") == b"Bald Eagle"
+        assert database.hget(f"channel:{self.ctx.channel.id}", "answered") == b"1"
+        assert database.hget(f"session.data:{self.ctx.author.id}", "total") == b"4"
+
+    def test_apply(self):
+        self.setup()
+        state = asyncio.run(CommandState.load(self.ctx))
+        state.channel.update(bird="Bald Eagle")
+        state.channel.apply(bird="")
+        asyncio.run(state.save())
+        assert state.channel.bird == ""
+        assert database.hget(f"channel:{self.ctx.channel.id}", "bird") == b"Canada Goose"
@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+import pytest
+
+import bot.cache
+import bot.core
+from bot.cache import media_manifest
+from bot.core import download_media
+from bot.filters import Filter
+from bot.scheduler import BACKGROUND, INTERACTIVE, download_priority
+
+BIRD = "Mock bird"
+
+
+class TestProgressiveDownload:
+    @pytest.fixture(autouse=True)
+    def mock_download(self, monkeypatch, tmp_path):
+        # pylint: disable=attribute-defined-outside-init
+        self.delays = [0.0] + [0.2] * 4
+        self.finished = 0
+
+        async def _get_urls(session, bird, media_type, filters):
+            return [f"https://example.com/{i}" for i in range(len(self.delays))]
+
+        async def _download_helper(path, url, session, max_size):
+            await asyncio.sleep(self.delays[int(url.rsplit("/", 1)[1])])
+            self.finished += 1
+            with open(f"{path}.jpg", "wb") as f:
+                f.write(b"\xff" * 100)
+            return (f"{path}.jpg", "image/jpeg", 100)
+
+        def ingest_media(path, content_type, size):
+            return (path, content_type, size, {})
+
+        monkeypatch.setattr(bot.core, "_get_urls", _get_urls)
+        monkeypatch.setattr(bot.core, "_download_helper", _download_helper)
+        monkeypatch.setattr(bot.core, "ingest_media", ingest_media)
+        monkeypatch.setattr(bot.core, "over_budget", lambda: False)
+        monkeypatch.setattr(media_manifest, "save", lambda: None)
+        monkeypatch.setattr(bot.cache, "LOCK_DIR", str(tmp_path / "locks"))
+        monkeypatch.setattr(
+            bot.core, "staging_directory", lambda key: f"{tmp_path}/staging/"
+        )
+        self.directory = f"{tmp_path}/media/"
+        self.key = bot.core.cache_key("images", BIRD, Filter().fetch_key("images"))
+        yield
+        media_manifest.remove(self.key)
+
+    def download(self, progressive):
+        return download_media(
+            BIRD, "images", Filter(), self.directory, progressive=progressive
+        )
+
+    def test_returns_first_file(self):
+        async def run():
+            first = await self.download(True)
+            assert first == [f"{self.directory}0.jpg"]
+            assert self.finished == 1
+            assert len(media_manifest.get(self.key)) == 1
+            return await self.download(False)
+
+        filenames = asyncio.run(run())
+        assert len(filenames) == 5
+        assert self.finished == 5
+        assert [entry["path"] for entry in media_manifest.get(self.key)] == filenames
+
+    def test_waits_for_all(self):
+        filenames = asyncio.run(self.download(False))
+        assert filenames == [f"{self.directory}{i}.jpg" for i in range(5)]
+
+    def test_all_failed(self, monkeypatch):
+        async def _download_helper(path, url, session, max_size):
+            return None
+
+        monkeypatch.setattr(bot.core, "_download_helper", _download_helper)
+        assert asyncio.run(self.download(True)) == []
+
+    def test_moves_files_from_staging(self, tmp_path):
+        filenames = asyncio.run(self.download(False))
+        assert sorted(os.listdir(self.directory)) == [f"{i}.jpg" for i in range(5)]
+        assert all(os.path.exists(filename) for filename in filenames)
+        assert not os.path.exists(f"{tmp_path}/staging")
+
+    def test_joining_raises_priority(self, monkeypatch):
+        promoted = []
+        monkeypatch.setattr(
+            bot.core.download_scheduler,
+            "promote",
+            lambda group, priority: promoted.append((group.key, priority)),
+        )
+
+        async def prefetch():
+            download_priority.set(BACKGROUND)
+            await self.download(True)
+            return bot.core._downloads[self.key]
+
+        async def run():
+            download = await asyncio.ensure_future(prefetch())
+            assert download.priority == BACKGROUND
+            await self.download(False)
+            return download
+
+        assert asyncio.run(run()).priority == INTERACTIVE
+        assert promoted == [(self.key, INTERACTIVE)]
@@ -0,0 +1,24 @@
+from bot.filters import Filter
+
+
+class TestFetchKey:
+    def test_ignores_presentation(self):
+        assert Filter(bw=True, vc=True).fetch_key("images") == Filter().fetch_key("images")
+        assert Filter(bw=True).fetch_key("songs") == Filter().fetch_key("songs")
+
+    def test_ignores_other_media_filters(self):
+        assert Filter(sounds="s").fetch_key("images") == Filter().fetch_key("images")
+        assert Filter(tags="mul").fetch_key("songs") == Filter().fetch_key("songs")
+        assert Filter(large=True).fetch_key("songs") == Filter().fetch_key("songs")
+
+    def test_keeps_query_filters(self):
+        assert Filter(large=True).fetch_key("images") != Filter().fetch_key("images")
+        assert Filter(tags="mul").fetch_key("p") != Filter().fetch_key("p")
+        assert Filter(sounds="s").fetch_key("a") != Filter().fetch_key("a")
+        assert Filter(age="a").fetch_key("songs") != Filter().fetch_key("songs")
+
+    def test_same_query(self):
+        for media_type, url_type in (("images", "p"), ("songs", "a")):
+            for filters in (Filter(sounds="s", tags="mul", bw=True), Filter(age="j")):
+                canonical = Filter.from_int(filters.fetch_key(media_type))
+                assert canonical.url("x", url_type) == filters.url("x", url_type)
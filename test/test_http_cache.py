@@ -0,0 +1,68 @@
+import os
+import time
+
+import pytest
+
+from bot.http_cache import FRESH_TIME, STALE_TIME, ResponseCache
+
+URL = "https://search.macaulaylibrary.org/api/v1/search?taxonCode=baleag"
+
+
+class TestResponseCache:
+    @pytest.fixture(autouse=True)
+    def setup_cache(self, tmp_path):
+        # pylint: disable=attribute-defined-outside-init
+        self.cache = ResponseCache(str(tmp_path / "http"), 1024 ** 2)
+
+    def test_store_and_get(self):
+        assert self.cache.get(URL) is None
+        headers = {"etag": '"abc"', "last-modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+        self.cache.store(URL, {"results": [1, 2]}, headers)
+        entry = self.cache.get(URL)
+        assert entry["body"] == {"results": [1, 2]}
+        assert entry["max_age"] == FRESH_TIME
+        assert self.cache.conditional_headers(entry) == {
+            "If-None-Match": '"abc"',
+            "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT",
+        }
+
+    def test_cache_control(self):
+        assert self.cache.store(URL, [], {"cache-control": "no-store"}) is None
+        assert self.cache.get(URL) is None
+        entry = self.cache.store(URL, [], {"cache-control": "public, max-age=60"})
+        assert entry["max_age"] == 60
+        entry = self.cache.store(URL, [], {"cache-control": "no-cache"})
+        assert not self.cache.is_fresh(entry)
+        assert not self.cache.is_usable(entry)
+        entry = self.cache.refresh(entry, {"cache-control": "max-age=60"})
+        assert self.cache.is_usable(entry)
+
+    def test_freshness(self):
+        entry = self.cache.store(URL, [], {})
+        now = time.time()
+        assert self.cache.is_fresh(entry, now)
+        assert not self.cache.is_fresh(entry, now + FRESH_TIME + 1)
+        assert self.cache.is_usable(entry, now + FRESH_TIME + 1)
+        assert not self.cache.is_usable(entry, now + FRESH_TIME + STALE_TIME + 1)
+
+    def test_refresh(self):
+        entry = self.cache.store(URL, [1], {"etag": '"abc"'})
+        entry["fetched"] -= FRESH_TIME * 2
+        entry = self.cache.refresh(entry, {})
+        assert self.cache.is_fresh(entry)
+        assert self.cache.get(URL)["etag"] == '"abc"'
+        assert self.cache.revalidated == 1
+
+    def test_evicts_least_recently_used(self):
+        self.cache.max_size = 2500
+        for i in range(5):
+            self.cache.store(f"{URL}{i}", "x" * 100, {})
+            path = self.cache._path(f"{URL}{i}")  # pylint: disable=protected-access
+            os.utime(path, (i, i))
+        self.cache.get(f"{URL}0")  # marks the first response as recently used
+        for i in range(5, 10):
+            self.cache.store(f"{URL}{i}", "x" * 100, {})
+        assert self.cache.size() <= 2500
+        assert self.cache.evicted > 0
+        assert self.cache.get(f"{URL}0") is not None
+        assert self.cache.get(f"{URL}1") is None
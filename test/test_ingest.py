@@ -0,0 +1,80 @@
+import os
+import shutil
+import wave
+
+from PIL import Image
+
+from bot.ingest import IMAGE_MAX_DIMENSION, ingest_media
+
+
+class TestOptimizeImage:
+    def test_resize(self, tmp_path):
+        path = str(tmp_path / "0.png")
+        Image.new("RGB", (IMAGE_MAX_DIMENSION * 2, IMAGE_MAX_DIMENSION)).save(path)
+        size = os.stat(path).st_size
+
+        new_path, content_type, new_size, metadata = ingest_media(path, "image/png", size)
+        assert new_path == str(tmp_path / "0.jpg")
+        assert content_type == "image/jpeg"
+        assert metadata["original_size"] == size
+        assert not os.path.exists(path)
+        with Image.open(new_path) as image:
+            assert max(image.size) == IMAGE_MAX_DIMENSION
+
+    def test_strip_exif(self, tmp_path):
+        path = str(tmp_path / "0.jpg")
+        exif = Image.Exif()
+        exif[0x010E] = "Branta canadensis"  # image description
+        Image.new("RGB", (100, 100)).save(path, exif=exif)
+
+        new_path, _, _, _ = ingest_media(path, "image/jpeg", os.stat(path).st_size)
+        assert new_path == path
+        with Image.open(new_path) as image:
+            assert not image.info.get("exif")
+
+    def test_animated_gif(self, tmp_path):
+        path = str(tmp_path / "0.gif")
+        frames = [Image.new("RGB", (100, 100), color) for color in ("red", "blue")]
+        frames[0].save(path, save_all=True, append_images=frames[1:])
+
+        new_path, content_type, _, _ = ingest_media(path, "image/gif", os.stat(path).st_size)
+        assert content_type == "image/jpeg"
+        with Image.open(new_path) as image:
+            assert not getattr(image, "is_animated", False)
+
+    def test_small_jpeg_unchanged(self, tmp_path):
+        path = str(tmp_path / "0.jpg")
+        Image.new("RGB", (100, 100)).save(path)
+        size = os.stat(path).st_size
+        assert ingest_media(path, "image/jpeg", size) == (
+            path,
+            "image/jpeg",
+            size,
+            {"original_size": size},
+        )
+
+    def test_invalid(self, tmp_path):
+        path = str(tmp_path / "0.jpg")
+        with open(path, "wb") as f:
+            f.write(b"not an image")
+        assert ingest_media(path, "image/jpeg", 12) is None
+        assert not os.path.exists(path)
+
+
+class TestProcessAudio:
+    def test_wav(self, tmp_path):
+        path = str(tmp_path / "0.wav")
+        with wave.open(path, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(8000)
+            f.writeframes(b"\x00\x00" * 8000)
+        size = os.stat(path).st_size
+
+        new_path, content_type, new_size, metadata = ingest_media(path, "audio/wav", size)
+        assert (new_path, content_type, new_size) == (path, "audio/wav", size)
+        assert metadata["tags_removed"]
+        assert metadata["original_size"] == size
+        if shutil.which("ffprobe"):
+            assert metadata["codec"] == "pcm_s16le"
+            assert metadata["duration"] == 1.0
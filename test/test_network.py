@@ -0,0 +1,258 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+import bot.network
+from bot.network import (FAILURE_THRESHOLD, CircuitBreaker, HTTPClient,
+                         RetryBudget, SingleFlight, UpstreamHealth, backoff,
+                         stream_to_file)
+
+
+class TestSingleFlight:
+    def setup(self):
+        # pylint: disable=attribute-defined-outside-init
+        self.flights = SingleFlight()
+        self.calls = 0
+
+    async def fetch(self, value):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        if value is None:
+            raise ValueError("no value")
+        return value
+
+    async def run_many(self, *items):
+        return await asyncio.gather(
+            *(self.flights.do(key, self.fetch, value) for key, value in items),
+            return_exceptions=True,
+        )
+
+    def test_coalesces_same_key(self):
+        self.setup()
+        results = asyncio.run(self.run_many(("a", 1), ("a", 1), ("a", 1)))
+        assert results == [1, 1, 1]
+        assert self.calls == 1
+        assert self.flights.info() == {"in_flight": 0, "coalesced": 2}
+
+    def test_different_keys(self):
+        self.setup()
+        results = asyncio.run(self.run_many(("a", 1), ("b", 2)))
+        assert results == [1, 2]
+        assert self.calls == 2
+
+    def test_shares_errors(self):
+        self.setup()
+        results = asyncio.run(self.run_many(("a", None), ("a", None)))
+        assert all(isinstance(result, ValueError) for result in results)
+        assert self.calls == 1
+
+    def test_cancel_one_caller(self):
+        self.setup()
+
+        async def run():
+            first = asyncio.ensure_future(self.flights.do("a", self.fetch, 1))
+            second = asyncio.ensure_future(self.flights.do("a", self.fetch, 1))
+            await asyncio.sleep(0)
+            first.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await first
+            return await second
+
+        assert asyncio.run(run()) == 1
+        assert self.calls == 1
+
+
+class TestCircuitBreaker:
+    def setup(self):
+        # pylint: disable=attribute-defined-outside-init
+        self.breaker = CircuitBreaker("example.com")
+
+    def fail(self, times=FAILURE_THRESHOLD):
+        for _ in range(times):
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        self.setup()
+        self.fail(FAILURE_THRESHOLD - 1)
+        assert self.breaker.allow()
+        self.fail(1)
+        assert self.breaker.state == "open"
+        assert not self.breaker.allow()
+        assert self.breaker.retry_in() > 0
+
+    def test_success_resets_failures(self):
+        self.setup()
+        self.fail(FAILURE_THRESHOLD - 1)
+        self.breaker.record_success()
+        self.fail(FAILURE_THRESHOLD - 1)
+        assert self.breaker.state == "closed"
+
+    def test_half_open_allows_one_trial(self):
+        self.setup()
+        self.breaker.open_time = 0.0
+        self.fail()
+        assert self.breaker.allow()
+        assert self.breaker.state == "half-open"
+        assert not self.breaker.allow()
+        self.breaker.record_success()
+        assert self.breaker.state == "closed"
+        assert self.breaker.allow()
+
+    def test_failed_trial_reopens_longer(self):
+        self.setup()
+        self.fail()
+        self.breaker.opened_at -= self.breaker.open_time
+        open_time = self.breaker.open_time
+        assert self.breaker.allow()
+        self.breaker.record_failure()
+        assert self.breaker.state == "open"
+        assert self.breaker.open_time == open_time * 2
+
+    def test_trial_without_result(self):
+        self.setup()
+        self.fail()
+        self.breaker.opened_at -= self.breaker.open_time
+        assert self.breaker.allow()
+        with pytest.raises(ValueError):
+            with self.breaker.request():
+                raise ValueError("invalid json")
+        assert self.breaker.state == "open"
+
+    def test_request_after_result(self):
+        self.setup()
+        self.breaker.open_time = 0.0
+        self.fail()
+        assert self.breaker.allow()
+        with pytest.raises(OSError):
+            with self.breaker.request():
+                self.breaker.record_success()
+                raise OSError("disk full")
+        assert self.breaker.state == "closed"
+        assert self.breaker.failures == 0
+
+    def test_upstream_health(self):
+        self.setup()
+        health = UpstreamHealth()
+        assert health.healthy()
+        breaker = health.breaker("example.com")
+        assert health.breaker("example.com") is breaker
+        for _ in range(FAILURE_THRESHOLD):
+            breaker.record_failure()
+        assert not health.healthy()
+        assert not health.healthy("example.com")
+        assert health.healthy("example.org")
+        assert health.info()["example.com"]["state"] == "open"
+
+
+class TestHTTPClient:
+    @pytest.fixture(autouse=True)
+    def setup_client(self):
+        # pylint: disable=attribute-defined-outside-init
+        self.client = HTTPClient()
+        yield
+        asyncio.run(self.client.close())
+
+    def test_reuses_session(self):
+        async def run():
+            return self.client.session(), self.client.session()
+
+        first, second = asyncio.run(run())
+        assert first is second
+
+    def test_replaced_on_loop_change(self):
+        async def run():
+            return self.client.session()
+
+        first = asyncio.run(run())
+        second = asyncio.run(run())
+        assert first is not second
+        assert first.closed
+        assert not second.closed
+
+    def test_closed_on_running_loop(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+
+        async def run():
+            return self.client.session()
+
+        try:
+            first = asyncio.run_coroutine_threadsafe(run(), loop).result()
+            second = asyncio.run(run())
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result()
+            assert first is not second
+            assert first.closed
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def test_close(self):
+        async def run():
+            session = self.client.session()
+            await self.client.close()
+            return session, self.client.session()
+
+        first, second = asyncio.run(run())
+        assert first.closed
+        assert first is not second
+
+
+class TestRetryBudget:
+    def test_spend(self):
+        budget = RetryBudget(2)
+        assert budget.spend()
+        assert budget.spend()
+        assert not budget.spend()
+        assert budget.remaining == 0
+
+    def test_backoff(self):
+        for attempt in range(10):
+            delay = backoff(attempt)
+            assert 0 <= delay <= bot.network.BACKOFF_MAX
+            assert delay <= bot.network.BACKOFF_BASE * 2 ** attempt
+
+
+class FakeContent:
+    def __init__(self, data, fail=False):
+        self.data = data
+        self.fail = fail
+
+    async def read(self, size):
+        block, self.data = self.data[:size], self.data[size:]
+        if not block and self.fail:
+            raise ConnectionResetError("disconnected")
+        return block
+
+
+class FakeResponse:
+    def __init__(self, data, fail=False):
+        self.content = FakeContent(data, fail)
+
+
+class TestStreamToFile:
+    def test_download(self, tmp_path):
+        filename = str(tmp_path / "0.jpg")
+        data = os.urandom(3 * 1024 * 1024 + 5)
+        size = asyncio.run(stream_to_file(FakeResponse(data), filename, len(data)))
+        assert size == len(data)
+        with open(filename, "rb") as f:
+            assert f.read() == data
+        assert os.listdir(tmp_path) == ["0.jpg"]
+
+    def test_too_large(self, tmp_path):
+        filename = str(tmp_path / "0.jpg")
+        size = asyncio.run(stream_to_file(FakeResponse(b"x" * 1000), filename, 999))
+        assert size is None
+        assert os.listdir(tmp_path) == []
+
+    def test_disconnect(self, tmp_path):
+        filename = str(tmp_path / "0.jpg")
+        with pytest.raises(ConnectionResetError):
+            asyncio.run(
+                stream_to_file(FakeResponse(b"x" * 1000, fail=True), filename, 2000)
+            )
+        assert os.listdir(tmp_path) == []
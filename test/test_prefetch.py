@@ -0,0 +1,100 @@
+import asyncio
+import collections
+
+import pytest
+
+import bot.prefetch
+from bot.cache import cache_stats, media_entry, media_manifest
+from bot.data import database
+from bot.filters import Filter
+from bot.prefetch import PREFETCH_BANDWIDTH, Prefetcher, candidates
+
+POPULAR = ("Mock Bird A", "Mock Bird B")
+
+
+class TestCandidates:
+    @pytest.fixture(autouse=True)
+    def setup_stats(self, monkeypatch):
+        monkeypatch.setattr(cache_stats, "filters", collections.Counter())
+        database.zadd(
+            "frequency.bird:global",
+            {"Screech Owl": 1000, POPULAR[0]: 900, POPULAR[1]: 800},
+        )
+        yield
+        database.zrem("frequency.bird:global", "Screech Owl", *POPULAR)
+
+    def test_popular_first(self):
+        birds = bot.prefetch._candidate_birds("images")
+        assert birds[:2] == list(POPULAR)
+        assert "Screech Owl" not in birds
+        assert len(birds) == len(set(birds))
+
+    def test_default_filter(self):
+        filters = bot.prefetch._candidate_filters("images")
+        assert [f.to_int() for f in filters] == [Filter().to_int()]
+        bird, media_type, filters = next(candidates())
+        assert (bird, media_type) == (POPULAR[0], "images")
+        assert filters.to_int() == Filter().to_int()
+
+    def test_used_filters(self):
+        cache_stats.filters[("songs", Filter(sounds="s").to_int())] += 2
+        songs = bot.prefetch._candidate_filters("songs")
+        assert [f.to_int() for f in songs] == [Filter(sounds="s").to_int()]
+
+
+class TestPrefetcher:
+    @pytest.fixture(autouse=True)
+    def setup_prefetcher(self, monkeypatch, tmp_path):
+        # pylint: disable=attribute-defined-outside-init
+        self.prefetcher = Prefetcher()
+        self.prefetcher._sem = asyncio.Semaphore(1)
+        self.sleeps = []
+        self.downloads = []
+        self.path = str(tmp_path / "0.jpg")
+        self.now = 1000.0
+        sleep = asyncio.sleep
+
+        async def fake_sleep(delay, *args):
+            self.sleeps.append(delay)
+            self.now += delay
+            if cache_stats.downloading:
+                cache_stats.downloading -= 1
+            await sleep(0)
+
+        async def download_media(bird, media_type, filters):
+            self.downloads.append(bird)
+            return [self.path]
+
+        monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+        monkeypatch.setattr(bot.prefetch.time, "monotonic", lambda: self.now)
+        monkeypatch.setattr(bot.prefetch, "download_media", download_media)
+        monkeypatch.setattr(cache_stats, "downloading", 0)
+        monkeypatch.setattr(
+            media_manifest,
+            "entry",
+            lambda path: media_entry(path, "image/jpeg", PREFETCH_BANDWIDTH * 2),
+        )
+
+    def prefetch(self, bird):
+        return self.prefetcher._prefetch_one(bird, "images", Filter())
+
+    def test_bandwidth_spacing(self):
+        async def run():
+            await self.prefetch("Mock birdus")
+            assert not self.sleeps
+            await self.prefetch("Mock birdus secundus")
+
+        asyncio.run(run())
+        assert self.downloads == ["Mock birdus", "Mock birdus secundus"]
+        # the first download was 2 seconds of bandwidth
+        assert self.sleeps == [2]
+        assert self.prefetcher.info() == {
+            "prefetched": 2,
+            "bytes": PREFETCH_BANDWIDTH * 4,
+        }
+
+    def test_yields_to_interactive(self):
+        cache_stats.downloading = 2
+        asyncio.run(self.prefetch("Mock birdus"))
+        assert self.sleeps == [1, 1]
+        assert self.downloads == ["Mock birdus"]
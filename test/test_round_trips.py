@@ -0,0 +1,146 @@
+import asyncio
+import datetime
+import string
+
+import pytest
+import redis
+
+import discord_mock as mock
+from bot.command_state import CommandState
+from bot.data import database
+from bot.functions import (bird_setup, channel_setup, known_entities,
+                           record_answer, server_score_setup, user_setup)
+
+BIRD = "Canada Goose"
+
+
+def legacy_bird_setup(user_id, guild_id, bird):
+    """The old bird_setup, which checked each leaderboard before adding the bird."""
+    bird = string.capwords(bird)
+    for key in (
+        "incorrect:global",
+        f"incorrect.user:{user_id}",
+        f"correct.user:{user_id}",
+        "daily.incorrect:0000-00-00",
+        "frequency.bird:global",
+        f"incorrect.server:{guild_id}",
+    ):
+        if database.zscore(key, bird) is None:
+            database.zadd(key, {bird: 0})
+    if database.exists(f"session.data:{user_id}"):
+        if database.zscore(f"session.incorrect:{user_id}", bird) is None:
+            database.zadd(f"session.incorrect:{user_id}", {bird: 0})
+
+
+class TestRoundTrips:
+    @pytest.fixture(autouse=True)
+    def count_round_trips(self, monkeypatch):
+        # pylint: disable=attribute-defined-outside-init
+        self.round_trips = 0
+        send = redis.connection.Connection.send_packed_command
+
+        def counted(connection, *args, **kwds):
+            self.round_trips += 1
+            return send(connection, *args, **kwds)
+
+        monkeypatch.setattr(redis.connection.Connection, "send_packed_command", counted)
+
+        self.ctx = mock.Context(mock.Bot())
+        self.ctx.set_guild()
+        self.user_id = self.ctx.author.id
+        self.date = str(datetime.datetime.now(datetime.timezone.utc).date())
+        yield
+        database.delete(
+            f"incorrect.user:{self.user_id}",
+            f"correct.user:{self.user_id}",
+            f"incorrect.server:{self.ctx.guild.id}",
+            f"session.data:{self.user_id}",
+            f"session.incorrect:{self.user_id}",
+            f"channel:{self.ctx.channel.id}",
+            f"race.data:{self.ctx.channel.id}",
+        )
+        database.zrem("users:global", str(self.user_id))
+        database.zrem("streak:global", str(self.user_id))
+        database.zrem("streak.max:global", str(self.user_id))
+        database.zrem("score:global", str(self.ctx.channel.id))
+        database.zrem(f"users.server:{self.ctx.guild.id}", str(self.user_id))
+        database.zrem(f"daily.score:{self.date}", str(self.user_id))
+        database.zrem(
+            "channels:global", f"{self.ctx.guild.id}:{self.ctx.channel.id}"
+        )
+
+    def measure(self, func, *args, **kwds):
+        self.round_trips = 0
+        func(*args, **kwds)
+        return self.round_trips
+
+    def test_bird_setup(self):
+        legacy = self.measure(legacy_bird_setup, self.user_id, self.ctx.guild.id, BIRD)
+        new = self.measure(asyncio.run, bird_setup(self.ctx, BIRD))
+        assert new == 1
+        assert legacy >= 7
+        assert database.zscore(f"incorrect.user:{self.user_id}", BIRD) == 0
+
+    def test_bird_setup_session(self):
+        database.hset(f"session.data:{self.user_id}", "correct", 0)
+        assert self.measure(asyncio.run, bird_setup(self.ctx, BIRD)) == 2
+        assert database.zscore(f"session.incorrect:{self.user_id}", BIRD) == 0
+
+    def test_bird_setup_frequency(self):
+        database.zadd("frequency.bird:global", {BIRD: 5})
+        assert self.measure(asyncio.run, bird_setup(self.ctx, BIRD, frequency=1)) == 1
+        assert database.zscore("frequency.bird:global", BIRD) == 6
+        database.zincrby("frequency.bird:global", -6, BIRD)
+
+    def test_record_answer(self):
+        asyncio.run(record_answer(self.ctx, BIRD, "incorrect"))  # loads the script
+        assert self.measure(asyncio.run, record_answer(self.ctx, BIRD, "correct")) == 1
+
+    def test_channel_setup(self):
+        assert self.measure(asyncio.run, channel_setup(self.ctx)) == 2
+        assert self.ctx.messages[-1].content == "Ok, setup! I'm all ready to use!"
+        assert self.measure(asyncio.run, channel_setup(self.ctx)) == 0
+
+    def test_user_setup(self):
+        assert self.measure(asyncio.run, user_setup(self.ctx)) == 1
+        assert self.measure(asyncio.run, user_setup(self.ctx)) == 0
+
+    def test_scores_added_on_answer(self):
+        asyncio.run(user_setup(self.ctx))
+        user_id = str(self.user_id)
+        assert database.zscore(f"daily.score:{self.date}", user_id) is None
+        assert database.zscore(f"users.server:{self.ctx.guild.id}", user_id) is None
+        database.zadd("users:global", {user_id: 5})
+        asyncio.run(record_answer(self.ctx, BIRD, "incorrect"))
+        assert database.zscore(f"daily.score:{self.date}", user_id) == 0
+        assert database.zscore(f"users.server:{self.ctx.guild.id}", user_id) == 5
+        asyncio.run(record_answer(self.ctx, BIRD, "correct"))
+        assert database.zscore(f"daily.score:{self.date}", user_id) == 1
+        assert database.zscore(f"users.server:{self.ctx.guild.id}", user_id) == 6
+
+    def test_server_score_setup(self):
+        user_id = str(self.user_id)
+        database.zadd("users:global", {user_id: 3})
+        asyncio.run(server_score_setup(self.ctx))
+        assert database.zscore(f"users.server:{self.ctx.guild.id}", user_id) == 3
+
+    def test_user_setup_invalidate(self):
+        asyncio.run(user_setup(self.ctx))
+        known_entities.invalidate("server", str(self.user_id))
+        assert self.measure(asyncio.run, user_setup(self.ctx)) == 1
+        assert len(self.ctx.messages) == 1  # welcomed once
+
+    def test_command_state(self):
+        database.hset(f"race.data:{self.ctx.channel.id}", "limit", 10)
+        database.hset(f"session.data:{self.user_id}", "total", 0)
+        state = None
+
+        def load():
+            nonlocal state
+            state = asyncio.run(CommandState.load(self.ctx))
+
+        assert self.measure(load) == 1
+        state.channel.update(bird=BIRD, prevB=BIRD, answered=0)
+        state.session.increment("total")
+        assert self.measure(asyncio.run, state.save()) == 1
+        assert database.hget(f"session.data:{self.user_id}", "total") == b"1"
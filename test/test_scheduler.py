@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+from bot.scheduler import BACKGROUND, INTERACTIVE, FairScheduler, download_group
+
+
+class TestFairScheduler:
+    def setup(self, limit=1):
+        # pylint: disable=attribute-defined-outside-init
+        self.scheduler = FairScheduler(limit)
+        self.order = []
+
+    async def download(self, name, owner, priority=INTERACTIVE):
+        async with self.scheduler.slot(owner, priority):
+            self.order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def run_many(self, *downloads):
+        # the first download holds the only slot while the rest queue up
+        blocker = asyncio.ensure_future(self.download("blocker", ("g", "c")))
+        await asyncio.sleep(0)
+        await asyncio.gather(blocker, *(self.download(*args) for args in downloads))
+
+    def test_limit(self):
+        self.setup(limit=2)
+        running = []
+
+        async def download():
+            async with self.scheduler.slot(("g", "c")):
+                running.append(self.scheduler.active)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            await asyncio.gather(*(download() for _ in range(6)))
+
+        asyncio.run(run())
+        assert max(running) == 2
+        assert self.scheduler.active == 0
+
+    def test_channels_take_turns(self):
+        self.setup()
+        asyncio.run(
+            self.run_many(
+                ("a1", ("g", "a")),
+                ("a2", ("g", "a")),
+                ("a3", ("g", "a")),
+                ("b1", ("g", "b")),
+            )
+        )
+        assert self.order == ["blocker", "a1", "b1", "a2", "a3"]
+
+    def test_guilds_take_turns(self):
+        self.setup()
+        asyncio.run(
+            self.run_many(
+                ("g1a", ("g1", "a")),
+                ("g1b", ("g1", "b")),
+                ("g2a", ("g2", "a")),
+            )
+        )
+        assert self.order == ["blocker", "g1a", "g2a", "g1b"]
+
+    def test_interactive_first(self):
+        self.setup()
+        asyncio.run(
+            self.run_many(
+                ("prefetch", (None, None), BACKGROUND),
+                ("command", ("g", "a"), INTERACTIVE),
+            )
+        )
+        assert self.order == ["blocker", "command", "prefetch"]
+
+    def test_cancel_waiting(self):
+        self.setup()
+
+        async def run():
+            blocker = asyncio.ensure_future(self.download("blocker", ("g", "c")))
+            await asyncio.sleep(0)
+            waiting = asyncio.ensure_future(self.download("cancelled", ("g", "a")))
+            await asyncio.sleep(0)
+            assert self.scheduler.info()["queued"]["interactive"] == 1
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+            await blocker
+
+        asyncio.run(run())
+        assert self.order == ["blocker"]
+        assert self.scheduler.info()["queued"]["interactive"] == 0
+        assert self.scheduler.active == 0
+
+    def test_promote(self):
+        self.setup()
+
+        async def grouped(name, owner, priority):
+            download_group.set("batch")
+            await self.download(name, owner, priority)
+
+        async def run():
+            blocker = asyncio.ensure_future(self.download("blocker", ("g", "c")))
+            await asyncio.sleep(0)
+            other = asyncio.ensure_future(self.download("other", (None, None), BACKGROUND))
+            joined = asyncio.ensure_future(grouped("joined", (None, None), BACKGROUND))
+            await asyncio.sleep(0)
+            assert self.scheduler.promote("batch", INTERACTIVE) == 1
+            assert self.scheduler.info()["queued"]["interactive"] == 1
+            await asyncio.gather(blocker, other, joined)
+
+        asyncio.run(run())
+        assert self.order == ["blocker", "joined", "other"]
+        assert self.scheduler.info()["promoted"] == 1
+
+    def test_cancel_promoted(self):
+        self.setup()
+
+        async def run():
+            blocker = asyncio.ensure_future(self.download("blocker", ("g", "c")))
+            await asyncio.sleep(0)
+            download_group.set("batch")
+            waiting = asyncio.ensure_future(self.download("cancelled", ("g", "a"), BACKGROUND))
+            await asyncio.sleep(0)
+            self.scheduler.promote("batch", INTERACTIVE)
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+            await blocker
+
+        asyncio.run(run())
+        assert self.order == ["blocker"]
+        assert self.scheduler.info()["queued"] == {"interactive": 0, "background": 0}
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+import bot.core
+from bot.core import cache, get_sciname, get_taxon
+from bot.data import GenericError, birdListMaster, database, taxonomy, taxonomy_key
+
+NAME = "_mock_lookup"
+
+
+class TestTaxonomyCache:
+    @pytest.yield_fixture(autouse=True)
+    def cleanup(self):
+        yield
+        for key in database.keys(f"taxonomy.*{NAME}*"):
+            database.delete(key)
+
+    def setup_lookup(self, max_size=10):
+        # pylint: disable=attribute-defined-outside-init
+        self.calls = 0
+
+        async def _mock_lookup(bird):
+            self.calls += 1
+            if bird == "Not A Bird":
+                raise GenericError("No taxon code found", code=111)
+            if bird == "Broken Bird":
+                raise GenericError("An http error occurred", code=201)
+            return (bird.lower(), bird)
+
+        return cache(max_size=max_size)(_mock_lookup)
+
+    def test_hit(self):
+        lookup = self.setup_lookup()
+        assert asyncio.run(lookup("Bald Eagle")) == ("bald eagle", "Bald Eagle")
+        assert asyncio.run(lookup("bald eagle")) == ("bald eagle", "Bald Eagle")
+        assert self.calls == 1
+        info = asyncio.run(lookup.cache_info())
+        assert info["hits"] == 1
+        assert info["misses"] == 1
+
+    def test_negative(self):
+        lookup = self.setup_lookup()
+        for _ in range(2):
+            with pytest.raises(GenericError) as e:
+                asyncio.run(lookup("Not A Bird"))
+            assert e.value.code == 111
+        assert self.calls == 1
+        assert asyncio.run(lookup.cache_info())["negative_hits"] == 1
+
+    def test_http_error_not_cached(self):
+        lookup = self.setup_lookup()
+        for _ in range(2):
+            with pytest.raises(GenericError):
+                asyncio.run(lookup("Broken Bird"))
+        assert self.calls == 2
+
+    def test_bounded(self):
+        lookup = self.setup_lookup(max_size=2)
+        for bird in ("Bird A", "Bird B", "Bird C"):
+            asyncio.run(lookup(bird))
+        assert asyncio.run(lookup.cache_info())["size"] == 2
+        asyncio.run(lookup("Bird C"))
+        assert self.calls == 3
+
+
+class TestTaxonomyTable:
+    def test_covers_lists(self):
+        missing = [
+            bird
+            for bird in birdListMaster
+            if bird != "Screech Owl" and taxonomy_key(bird) not in taxonomy
+        ]
+        assert not missing
+
+    def test_offline_sciname(self):
+        assert asyncio.run(get_sciname("Bald Eagle")) == "Haliaeetus leucocephalus"
+        assert asyncio.run(get_sciname("bald-eagle")) == "Haliaeetus leucocephalus"
+        assert asyncio.run(get_sciname("BAEA")) == "Haliaeetus leucocephalus"
+
+    def test_offline_taxon(self, monkeypatch):
+        async def get_json(url, session=None):
+            raise AssertionError(f"unexpected request to {url}")
+
+        monkeypatch.setattr(bot.core.http_client, "get_json", get_json)
+        assert asyncio.run(get_taxon("Bald Eagle")) == (
+            "baleag",
+            "Bald Eagle - Haliaeetus leucocephalus",
+        )
+        assert asyncio.run(get_taxon("BAEA"))[0] == "baleag"
@@ -0,0 +1,158 @@
+import os
+import struct
+import time
+
+import pytest
+
+import bot.voice
+from bot.voice import HEADER, PACKET_MAGIC, CustomFFmpegAudio, PackedOpusAudio
+
+PACKETS = [i.to_bytes(2, "big") for i in range(1000)]  # 20 seconds
+
+
+def write_store(path, packets):
+    offsets = [0]
+    for packet in packets:
+        offsets.append(offsets[-1] + len(packet))
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(PACKET_MAGIC, len(packets)))
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        for packet in packets:
+            f.write(packet)
+
+
+class TestPackedOpusAudio:
+    @pytest.fixture(autouse=True)
+    def setup_source(self, tmp_path):
+        # pylint: disable=attribute-defined-outside-init
+        self.packets = [bytes([i]) * (i + 1) for i in range(149)]
+        path = str(tmp_path / "0.opus.pkt")
+        write_store(path, self.packets)
+        self.source = PackedOpusAudio(path)
+
+    def test_read(self):
+        assert self.source.is_opus()
+        assert [self.source.read() for _ in range(149)] == self.packets
+        assert self.source.read() == b""
+        assert self.source.remaining == 0
+
+    def test_length(self):
+        assert self.source.length == 3
+        assert self.source.remaining == 3
+
+    def test_jump(self):
+        self.source.jump(1)
+        assert self.source.read() == self.packets[50]
+        self.source.jump(-5)
+        assert self.source.read() == self.packets[0]
+        self.source.jump(10)
+        assert self.source.read() == b""
+        self.source.jump(None)
+        assert self.source.read() == self.packets[0]
+
+    def test_cleanup(self):
+        self.source.cleanup()
+        assert self.source._data.closed  # pylint: disable=protected-access
+        self.source.cleanup()
+
+
+class MockFFmpegAudio:
+    """Produces numbered packets, starting at the -ss position."""
+
+    started = 0
+
+    def __init__(self, filename, bitrate, codec, before_options=None):
+        MockFFmpegAudio.started += 1
+        position = 0
+        if before_options:
+            position = round(float(before_options.split()[1]) * 50)
+        self._packets = iter(PACKETS[position:])
+
+    def read(self):
+        return next(self._packets, b"")
+
+    def cleanup(self):
+        pass
+
+
+class TestStreamingAudio:
+    @pytest.fixture(autouse=True)
+    def setup_source(self, monkeypatch):
+        # pylint: disable=attribute-defined-outside-init
+        MockFFmpegAudio.started = 0
+        monkeypatch.setattr(bot.voice.discord, "FFmpegOpusAudio", MockFFmpegAudio)
+        monkeypatch.setattr(bot.voice, "BUFFER_PACKETS", 100)
+        monkeypatch.setattr(bot.voice, "SEEK_BACK_PACKETS", 100)
+        self.source = CustomFFmpegAudio("song.mp3", 512, "mp3", duration=20.0)
+
+    def test_read(self):
+        assert [self.source.read() for _ in range(1000)] == PACKETS
+        assert self.source.read() == b""
+        assert self.source.remaining == 0
+        assert MockFFmpegAudio.started == 1
+
+    def test_length(self):
+        assert self.source.length == 20
+        assert self.source.remaining == 20
+
+    def test_unknown_length(self):
+        for duration in (None, 0):
+            source = CustomFFmpegAudio("song.mp3", 512, "mp3", duration=duration)
+            assert source.length is None
+            assert source.remaining is None
+            assert bot.voice._time_remaining(source.remaining) == "time remaining unknown"
+            assert [source.read() for _ in range(1000)] == PACKETS
+            assert source.read() == b""
+            assert source.length == 20
+            assert source.remaining == 0
+            source.cleanup()
+        assert bot.voice._time_remaining(3725) == "01:02:05 remaining"
+
+    def test_jump_in_buffer(self):
+        for _ in range(60):
+            self.source.read()
+        self.source.jump(-1)
+        assert self.source.read() == PACKETS[10]
+        assert MockFFmpegAudio.started == 1
+
+    def test_jump_restarts(self):
+        self.source.jump(10)
+        assert self.source.read() == PACKETS[500]
+        assert self.source.remaining == 10
+        self.source.jump(None)
+        assert self.source.read() == PACKETS[0]
+        assert MockFFmpegAudio.started == 3
+        self.source.cleanup()
+
+    def record(self, monkeypatch, tmp_path):
+        variants = []
+        monkeypatch.setattr(
+            bot.voice.media_manifest,
+            "add_variant",
+            lambda filename, variant, size: variants.append((filename, variant)),
+        )
+        path = str(tmp_path / "song.opus.pkt")
+        source = CustomFFmpegAudio("song.mp3", 512, "mp3", 20.0, packet_path=path)
+        return source, path, variants
+
+    def test_saves_packets(self, monkeypatch, tmp_path):
+        source, path, variants = self.record(monkeypatch, tmp_path)
+        started = MockFFmpegAudio.started
+        assert [source.read() for _ in range(1001)] == PACKETS + [b""]
+        for _ in range(100):
+            if variants:
+                break
+            time.sleep(0.01)
+        assert variants == [("song.mp3", "opus")]
+        packed = PackedOpusAudio(path)
+        assert [packed.read() for _ in range(1000)] == PACKETS
+        packed.cleanup()
+        assert MockFFmpegAudio.started == started
+
+    def test_restart_skips_save(self, monkeypatch, tmp_path):
+        source, path, variants = self.record(monkeypatch, tmp_path)
+        source.jump(10)
+        assert [source.read() for _ in range(501)] == PACKETS[500:] + [b""]
+        time.sleep(0.1)
+        assert not variants
+        assert not os.path.exists(path)
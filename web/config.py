@@ -1,14 +1,18 @@
 import asyncio
+import atexit
 import os
 import random
+import threading
 
 import sentry_sdk
-from flask import Flask, session
+from flask import Flask, _request_ctx_stack, has_request_context, session
 from sentry_sdk.integrations.flask import FlaskIntegration
 from sentry_sdk.integrations.redis import RedisIntegration
 
 from bot.data import database, logger
 from bot.functions import user_setup
+from bot.network import RetryBudget, http_client, retry_budget
+from bot.scheduler import download_owner
 
 sentry_sdk.init(
     release=f"{os.getenv('CURRENT_PLATFORM')} Release "
@@ -29,6 +33,56 @@ FRONTEND_URL = os.getenv("FRONTEND_URL")
 DATABASE_SESSION_EXPIRE = 172800  # 2 days
 
 
+# each worker runs coroutines on one event loop in a background thread,
+# so the shared http session can be reused between requests
+_worker_loop = None
+_worker_pid = None
+
+
+def _get_worker_loop():
+    global _worker_loop, _worker_pid
+    if _worker_loop is None or _worker_pid != os.getpid():
+        # the loop thread doesn't survive a fork, so make one per process
+        logger.info("starting worker event loop")
+        _worker_loop = asyncio.new_event_loop()
+        _worker_pid = os.getpid()
+        threading.Thread(target=_worker_loop.run_forever, daemon=True).start()
+    return _worker_loop
+
+
+async def _with_context(request_ctx, coro):
+    with request_ctx:
+        return await coro
+
+
+async def _with_request_state(coro, owner):
+    retry_budget.set(RetryBudget())
+    download_owner.set(owner)
+    return await coro
+
+
+def run_async(coro):
+    """Runs a coroutine on the worker event loop and returns the result.
+
+    The current request context is copied so coroutines can use the session.
+    """
+    owner = ("web", None)
+    if has_request_context():
+        coro = _with_context(_request_ctx_stack.top.copy(), coro)
+        owner = ("web", session.get("id"))
+    # each request gets its own retry budget for http requests,
+    # and media downloads are shared fairly between web sessions
+    coro = _with_request_state(coro, owner)
+    return asyncio.run_coroutine_threadsafe(coro, _get_worker_loop()).result()
+
+
+@atexit.register
+def _close_worker_loop():
+    if _worker_loop is not None and _worker_pid == os.getpid():
+        asyncio.run_coroutine_threadsafe(http_client.close(), _worker_loop).result(5)
+        _worker_loop.call_soon_threadsafe(_worker_loop.stop)
+
+
 @app.after_request  # enable CORS
 def after_request(response):
     header = response.headers
@@ -94,7 +148,7 @@ def update_web_user(user_data):
             "discriminator": str(user_data["discriminator"]),
         },
     )
-    asyncio.run(user_setup(user_id))
+    run_async(user_setup(user_id))
     tempScore = int(database.hget(f"web.session:{session_id}", "tempScore"))
     if tempScore not in (0, -1):
         database.zincrby("users:global", tempScore, int(user_id))
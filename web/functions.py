@@ -1,12 +1,11 @@
-import asyncio
 import random
-from functools import partial
 
 import eyed3
 from flask import abort
 from sentry_sdk import capture_exception
 
-from bot.core import _black_and_white, get_files, get_sciname, valid_types
+from bot.cache import media_manifest
+from bot.core import black_and_white, get_files, get_sciname, valid_types
 from bot.data import GenericError, birdList, database, logger, screech_owls
 from bot.filters import Filter
 from web.config import get_session_id
@@ -37,17 +36,16 @@ async def send_bird(bird: str, media_type: str, filters: Filter):
 
     if media_type == "images":
         if filters.bw:
-            loop = asyncio.get_running_loop()
-            file_stream = await loop.run_in_executor(
-                None, partial(_black_and_white, filename)
-            )
-        else:
-            file_stream = f"../{filename}"
+            filename = await black_and_white(filename)
+            ext = "png"
+        file_stream = f"../{filename}"
     elif media_type == "songs":
-        # remove spoilers in tag metadata
-        audioFile = eyed3.load(filename)
-        if audioFile is not None and audioFile.tag is not None:
-            audioFile.tag.remove(filename)
+        entry = media_manifest.entry(filename)
+        if entry is None or not entry.get("tags_removed"):
+            # remove spoilers in tag metadata, if not done when downloading
+            audioFile = eyed3.load(filename)
+            if audioFile is not None and audioFile.tag is not None:
+                audioFile.tag.remove(filename)
 
         file_stream = f"../{filename}"
 
@@ -1,4 +1,3 @@
-import asyncio
 import random
 import urllib.parse
 
@@ -8,7 +7,7 @@ from sentry_sdk import capture_exception
 from bot.data import birdList
 from bot.filters import Filter
 from web import practice, user
-from web.config import app, logger
+from web.config import app, logger, run_async
 from web.functions import get_media, get_sciname
 
 app.register_blueprint(practice.bp)
@@ -28,7 +27,7 @@ def bird_info():
     bird = random.choice(birdList)
     logger.info(f"bird: {bird}")
     content["bird"] = bird
-    content["sciName"] = asyncio.run(get_sciname(bird))
+    content["sciName"] = run_async(get_sciname(bird))
     content["imageURL"] = urllib.parse.quote(f"/image/{bird}")
     content["songURL"] = urllib.parse.quote(f"/song/{bird}")
     logger.info(f"{bird} sent!")
@@ -37,13 +36,13 @@ def bird_info():
 
 @app.route("/image/<string:bird>")
 def bird_image(bird):
-    path = asyncio.run(get_media(bird, "images", Filter()))
+    path = run_async(get_media(bird, "images", Filter()))
     return flask.send_file(f"../{path[0]}")
 
 
 @app.route("/song/<string:bird>")
 def bird_song(bird):
-    path = asyncio.run(get_media(bird, "songs", Filter()))
+    path = run_async(get_media(bird, "songs", Filter()))
     return flask.send_file(f"../{path[0]}")
 
 
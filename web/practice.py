@@ -1,23 +1,19 @@
-import asyncio
 import random
-import string
 
 import flask
 
 from bot.core import spellcheck
 from bot.data import birdList, get_wiki_url, songBirds
 from bot.filters import Filter
-from bot.functions import (bird_setup, incorrect_increment, score_increment,
-                           session_increment, streak_increment)
-from web.config import FRONTEND_URL, database, get_session_id, logger
+from bot.functions import bird_setup, record_answer, session_increment
+from web.config import FRONTEND_URL, database, get_session_id, logger, run_async
 from web.functions import get_sciname, send_bird
 
 bp = flask.Blueprint("practice", __name__, url_prefix="/practice")
 
 
 def increment_bird_frequency(bird, user_id):
-    bird_setup(user_id, bird)
-    database.zincrby("frequency.bird:global", 1, string.capwords(bird))
+    run_async(bird_setup(user_id, bird, frequency=1))
 
 
 @bp.route("/get", methods=["GET"])
@@ -52,7 +48,7 @@ def get_bird():
         currentBird = random.choice(id_list)
         user_id = int(database.hget(f"web.session:{session_id}", "user_id"))
         if user_id != 0:
-            session_increment(user_id, "total", 1)
+            run_async(session_increment(user_id, "total", 1))
             increment_bird_frequency(currentBird, user_id)
         prevB = database.hget(f"web.session:{session_id}", "prevB").decode("utf-8")
         while currentBird == prevB and len(id_list) > 1:
@@ -62,9 +58,9 @@ def get_bird():
         database.hset(f"web.session:{session_id}", "media_type", str(media_type))
         logger.info("currentBird: " + str(currentBird))
         database.hset(f"web.session:{session_id}", "answered", "0")
-        file_object, ext = asyncio.run(send_bird(currentBird, media_type, filters))
+        file_object, ext = run_async(send_bird(currentBird, media_type, filters))
     else:  # if no, give the same bird
-        file_object, ext = asyncio.run(
+        file_object, ext = run_async(
             send_bird(
                 database.hget(f"web.session:{session_id}", "bird").decode("utf-8"),
                 database.hget(f"web.session:{session_id}", "media_type").decode(
@@ -99,26 +95,24 @@ def check_bird():
     logger.info("currentBird: " + str(currentBird.lower().replace("-", " ")))
     logger.info("args: " + str(bird_guess.lower().replace("-", " ")))
 
-    sciBird = asyncio.run(get_sciname(currentBird))
+    sciBird = run_async(get_sciname(currentBird))
     if spellcheck(bird_guess, currentBird) or spellcheck(bird_guess, sciBird):
         logger.info("correct")
 
-        database.hset(f"web.session:{session_id}", "bird", "")
-        database.hset(f"web.session:{session_id}", "answered", "1")
+        run_async(
+            record_answer(
+                user_id, currentBird, "correct", state=f"web.session:{session_id}"
+            )
+        )
 
-        tempScore = int(database.hget(f"web.session:{session_id}", "tempScore"))
-        if user_id != 0:
-            bird_setup(user_id, currentBird)
-            score_increment(user_id, 1)
-            session_increment(user_id, "correct", 1)
-            streak_increment(user_id, 1)
-        elif tempScore >= 10:
-            logger.info("trial maxed")
-            flask.abort(403, "Sign in to continue")
-        else:
+        if user_id == 0:
+            tempScore = int(database.hget(f"web.session:{session_id}", "tempScore"))
+            if tempScore >= 10:
+                logger.info("trial maxed")
+                flask.abort(403, "Sign in to continue")
             database.hset(f"web.session:{session_id}", "tempScore", str(tempScore + 1))
 
-        url = get_wiki_url(currentBird)
+        url = run_async(get_wiki_url(currentBird))
         return {
             "guess": bird_guess,
             "answer": currentBird,
@@ -128,17 +122,13 @@ def check_bird():
         }
 
     logger.info("incorrect")
-    database.hset(f"web.session:{session_id}", "bird", "")
-    database.hset(f"web.session:{session_id}", "answered", "1")
-    database.zincrby("incorrect:global", 1, currentBird)
-
-    if user_id != 0:
-        bird_setup(user_id, currentBird)
-        incorrect_increment(user_id, currentBird, 1)
-        session_increment(user_id, "incorrect", 1)
-        streak_increment(user_id, None)  # reset streak
+    run_async(
+        record_answer(
+            user_id, currentBird, "incorrect", state=f"web.session:{session_id}"
+        )
+    )
 
-    url = get_wiki_url(currentBird)
+    url = run_async(get_wiki_url(currentBird))
     return {
         "guess": bird_guess,
         "answer": currentBird,
@@ -156,12 +146,14 @@ def skip_bird():
 
     currentBird = database.hget(f"web.session:{session_id}", "bird").decode("utf-8")
     if currentBird != "":  # check if there is bird
-        database.hset(f"web.session:{session_id}", "bird", "")
-        database.hset(f"web.session:{session_id}", "answered", "1")
-        if user_id != 0:
-            streak_increment(user_id, None)  # reset streak
-        scibird = asyncio.run(get_sciname(currentBird))
-        url = get_wiki_url(currentBird)  # sends wiki page
+        # resets the bird and streak
+        run_async(
+            record_answer(
+                user_id, currentBird, "skip", state=f"web.session:{session_id}"
+            )
+        )
+        scibird = run_async(get_sciname(currentBird))
+        url = run_async(get_wiki_url(currentBird))  # sends wiki page
     else:
         logger.info("bird is blank")
         flask.abort(406, "Bird is blank")
@@ -1,12 +1,11 @@
-import asyncio
 import urllib.parse
 from io import BytesIO
 
-import aiohttp
 import flask
 
 from bot.core import _black_and_white
-from web.config import logger
+from bot.network import http_client
+from web.config import logger, run_async
 
 bp = flask.Blueprint("tools", __name__, url_prefix="/tools")
 
@@ -30,20 +29,19 @@ def convert_bw():
         logger.info("invalid url")
         flask.abort(415, "invalid url")
 
-    image, content_type = asyncio.run(_bw_helper(url))
+    image, content_type = run_async(_bw_helper(url))
     return flask.send_file(image, mimetype=content_type)
 
 
 async def _bw_helper(url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                logger.info("invalid response")
-                flask.abort(response.status, "error fetching url")
-            if response.content_type not in valid_content_types:
-                logger.info("invalid content type")
-                flask.abort(415, "invalid content type")
-            return (
-                _black_and_white(BytesIO(await response.read())),
-                response.content_type,
-            )
+    async with http_client.session().get(url) as response:
+        if response.status != 200:
+            logger.info("invalid response")
+            flask.abort(response.status, "error fetching url")
+        if response.content_type not in valid_content_types:
+            logger.info("invalid content type")
+            flask.abort(415, "invalid content type")
+        return (
+            _black_and_white(BytesIO(await response.read())),
+            response.content_type,
+        )